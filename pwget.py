@@ -13,28 +13,119 @@ import urllib.request
 import urllib.parse
 import logging
 import io
+import codecs
 import getopt
 import os
 import datetime
 import http
 import time
 import collections
-from bs4 import BeautifulSoup
+import functools
+import html.parser
+import asyncio
+import concurrent.futures
+import threading
+import ssl
+import sqlite3
+import zlib
+import array
+import hashlib
+import math
+import heapq
+import http.client
+import contextlib
+import socket
+import cProfile
+import pstats
+import random
+import json
+import http.server
+import email.utils
+import queue
+import uuid
+import base64
+import tempfile
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import gzip
+import urllib.robotparser
+import xml.etree.ElementTree
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 #import pdb
 
 def usage():
     print('Recursively downloads from http urls matching a regexp:\n')
-    print('{0} [-r url_regex] url1 [url2] ... [urln]'.format(sys.argv[0]))
+    print('{0} [-r url_regex] [-i url_file] url1 [url2] ... [urln]'.format(sys.argv[0]))
+    print()
+    print('The http_proxy, https_proxy and no_proxy environment variables are honoured.')
     print()
     print('''Options:
     -v --verbose:       verbose execution
     -h --help:          this help
     -r --regex:         regex for urls to download
+    -i --input-file:    also crawl the urls listed in this file, one per line, '-' for
+                        stdin; read in batches as the crawl goes
+    --no-recurse:       only download the given urls, don't follow their links
+    --sitemaps:         also crawl the urls listed in the sitemaps of the seed hosts
+                        (found through robots.txt, or /sitemap.xml); with --mirror
+                        the ones whose lastmod is older than the local copy are skipped
     -c --cokiefile:     specify a cookie file to use
     -o --overwrite:     force overwritting of files
-    -m --mirror:        only download if size differs
-    -t --time:          time to sleep between requests in seconds (float)
+    -m --mirror:        only download changed files, using ETag / Last-Modified
+                        of the previous download, or the size
+    -t --time:          delay between two requests to the same host in seconds (float),
+                        lengthened for a host on 429/503, slow answers or Retry-After
+                        and shortened back to it while the host answers quickly
+    --min-delay:        never space the requests to a host by less than this (default 0)
+    --tries:            times a url is tried when it fails with a timeout, a connection
+                        error or a 408/429/5xx status, waiting longer every time (default 3)
+    --limit-rate:       max bytes per second over all downloads, with a k, m or g suffix
+    --host-limit-rate:  max bytes per second from each host
+    --limit-burst:      bytes that can be read at full speed after an idle time (default
+                        a second worth of the rate)
+    -j --jobs:          number of downloads to run in parallel (default 1)
+    --host-jobs:        max parallel downloads against the same host (default 4)
+    --pool-size:        max idle keep-alive connections kept per host (default 8)
+    --state-dir:        keep the crawl state in this directory, rerunning with the
+                        same directory resumes an interrupted crawl
+    --follow-tags:      tag:attribute list of links to follow (default a:href,iframe:src)
+    --continue:         resume partially downloaded files
+    --segments:         download large files over this many parallel connections
+    --segment-min-size: only files of at least this many bytes are segmented (default 8 MiB)
+    --keep-compressed:  save gzip/deflate/br encoded bodies as received instead of
+                        decompressing them
+    --fsync:            fsync the saved files in batches of this many, a file only counts
+                        as complete for --mirror/--continue once it is on disk
+    --warc:             archive the requests and responses into WARC files named after
+                        this one (gzipped per record if it ends with .gz) and index
+                        them in a .cdx file, instead of saving a file per url
+    --warc-max-size:    start a new WARC file past this many bytes (default 1 GiB)
+    --dedup:            store identical bodies once: later copies become hardlinks to
+                        the first file, or revisit records with --warc
+    --workers:          crawl with this many processes, each owning the hosts hashed
+                        to it and running its own --jobs; state, WARC, metrics and
+                        profile files get one per worker
+    --seen-set:         how seen urls are remembered without --state-dir: set (default),
+                        fingerprint (64 bit hashes, compact) or bloom[:capacity]
+                        (approximate, fixed size, may skip a few urls)
+    -l --level:         max number of links to follow from the seed urls
+    --order:            crawl order: bfs (shallow pages first, default), host (take
+                        turns between hosts), cheap (pages before archives and media)
+                        or fifo (discovery order)
+    --profile:          profile the crawl, worker threads included, into this file
+                        (pstats format) and print the slowest functions
+    --metrics:          publish live metrics (request and byte rates, frontier size,
+                        status codes, per host latency, the hosts past the first 100
+                        as "other"): to a file, JSON if it ends with .json and
+                        Prometheus text otherwise, or [host]:port to serve them at
+                        /metrics and /metrics.json
+    --metrics-interval: seconds between two writes of the metrics file (default 10)
     ''')
 
 
@@ -143,6 +234,82 @@ class ProgressBar:
         return str(self.progBar)
 
 
+class LinkExtractor(html.parser.HTMLParser):
+    """Collects the values of link attributes in a single pass over the html,
+    which can be fed in chunks, without building a document tree.
+    link_attrs maps a tag to the attributes holding links, by default a[href]
+    and iframe[src].
+
+    >>> e = LinkExtractor(); e.feed('<p><a class=x href="/a">a</a><iframe src=f.html>'); e.feed('</iframe><A HREF="b?x=1&amp;y=2"/><img src=i.png>'); e.links
+    ['/a', 'f.html', 'b?x=1&y=2']
+    >>> e = LinkExtractor(parse_link_attrs('img:src,a:href')); e.feed('<a href=a><img src=i.png>'); e.links
+    ['a', 'i.png']
+    """
+    DEFAULT_LINK_ATTRS = {'a': ('href',), 'iframe': ('src',)}
+
+    def __init__(self, link_attrs=None):
+        super(LinkExtractor, self).__init__(convert_charrefs=True)
+        self.link_attrs = link_attrs or LinkExtractor.DEFAULT_LINK_ATTRS
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        names = self.link_attrs.get(tag)
+        if names:
+            for (k, v) in attrs:
+                if v and k in names:
+                    self.links.append(v)
+
+
+class LinkTee(object):
+    """Feeds the chunks of an html body, as they are downloaded, through an
+    incremental decoder into a LinkExtractor, so the page is never held whole
+    in memory. Call it with b'' at the end of the body.
+
+    >>> t = LinkTee('http://h/', 'utf-8'); e = 'é'.encode()
+    >>> t(b'<a href="/caf' + e[:1]); t(e[1:] + b'">'); t(b''); t.links()
+    ['/café']
+    """
+    def __init__(self, url, encoding, link_attrs=None):
+        self.url = url
+        self.encoding = encoding
+        try:
+            self.decoder = codecs.getincrementaldecoder(encoding)()
+        except LookupError:
+            logging.error('Unknown charset "{0}" for "{1}", decoding as utf-8'.format(encoding, url))
+            self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.extractor = LinkExtractor(link_attrs)
+        self.failed = False
+
+    def __call__(self, chunk):
+        if self.failed:
+            return
+        try:
+            text = self.decoder.decode(chunk, final=not chunk)
+        except UnicodeDecodeError as e:
+            logging.error('Failed decoding "{0}" with charset "{1}": {2}'.format(self.url, self.encoding, str(e)))
+            self.failed = True
+            return
+        self.extractor.feed(text)
+        if not chunk:
+            self.extractor.close()
+
+    def links(self):
+        return self.extractor.links
+
+
+def parse_link_attrs(spec):
+    """Parses a tag:attr,tag:attr list as given to --follow-tags
+
+    >>> sorted(parse_link_attrs('a:href, img:src,link:href,img:srcset').items())
+    [('a', ('href',)), ('img', ('src', 'srcset')), ('link', ('href',))]
+    """
+    res = collections.defaultdict(tuple)
+    for item in spec.split(','):
+        (tag, attr) = item.strip().lower().split(':')
+        res[tag] += (attr,)
+    return dict(res)
+
+
 def url_to_localpath(u):
     res = os.path.join(u.netloc, urllib.parse.unquote(u.path[1:]))
     if u.query:
@@ -346,17 +513,87 @@ class Path:
         return ''.join(l)
 
 
+def normalize_path(s):
+    '''Same result as str() of a normalized Path(s), splitting the string once
+    and resolving .. against a stack instead of deleting from a list
+
+    >>> normalize_path('a/..//.//b//'), normalize_path('/a/b/..'), normalize_path('../a/../b'), normalize_path('/')
+    ('b/', '/a/', '../b', '/')
+    '''
+    if not s:
+        return s
+    slash_begin = s[0] == '/'
+    slash_end = len(s) > 1 and s[-1] == '/'
+    out = []
+    segs = s.split('/')
+    last = len(segs) - 1
+    while last >= 0 and not segs[last]:
+        last -= 1
+    for (i, seg) in enumerate(segs):
+        if not seg:
+            continue
+        if seg == '.':
+            if i == last:
+                slash_end = True
+        elif seg == '..' and out and out[-1] != '..':
+            out.pop()
+            if i == last:
+                slash_end = True
+        else:
+            out.append(seg)
+    if not out:
+        return '/' if slash_begin or slash_end else ''
+    res = '/'.join(out)
+    if slash_begin:
+        res = '/' + res
+    if slash_end:
+        res += '/'
+    return res
+
+
+@functools.lru_cache(maxsize=1 << 16)
 def normalize(url):
     '''Lowercases the authority part (netloc),
     Normalizes the path part (removing .. and .)
+    Results are cached, the same links appear on many pages of a site.
     '''
     x = urllib.parse.urlsplit(url)
-    path = Path(x[2])
-    path.normalize()
-    norm = urllib.parse.urlunparse((x[0], x[1].lower(), str(path), '', x[3], x[4]))
+    norm = urllib.parse.urlunparse((x[0], x[1].lower(), normalize_path(x[2]), '', x[3], x[4]))
     return norm
 
 
+def normalize_links(links):
+    '''Normalizes the links of a page, dropping repeated ones but keeping their
+    order, and the ones that aren't urls
+
+    >>> normalize_links(['http://H/a/../b', 'http://h/b', 'http://[x', 'http://H/a/../b', 'http://h/c'])
+    ['http://h/b', 'http://h/c']
+    '''
+    res = {}
+    for link in dict.fromkeys(links):
+        try:
+            res[normalize(link)] = None
+        except ValueError as e:
+            logging.warning('skipping link {0!r}: {1}'.format(link, e))
+    return list(res)
+
+
+def read_urls(lines):
+    '''The normalized urls of an --input-file, one per line, skipping blank lines,
+    # comments and the lines that aren't urls, which are logged. Lazy, lines can
+    be a file of any size.
+
+    >>> list(read_urls(['http://H/a/../b\\n', '\\n', '# seeds\\n', 'http://[oops/\\n', '  http://h/c  ']))
+    ['http://h/b', 'http://h/c']
+    '''
+    for (lineno, line) in enumerate(lines, 1):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            try:
+                yield normalize(line)
+            except ValueError as e:
+                logging.error('input line {0}: skipping {1!r}: {2}'.format(lineno, line, e))
+
 
 def humansize(nbytes):
     if nbytes:
@@ -392,6 +629,81 @@ class Rate(object):
 
         return self.prev_rate
 
+def parse_size(size):
+    """Bytes in a size or rate given as a number with an optional k, m or g
+    suffix, in powers of 1024
+
+    >>> parse_size('512'), parse_size('20k'), parse_size('1.5M')
+    (512, 20480, 1572864)
+    """
+    m = re.match(r'^\s*([\d.]+)\s*([kmg]?)\s*$', size, re.IGNORECASE)
+    if not m:
+        raise ValueError('invalid size: {0}'.format(size))
+    return int(float(m.group(1)) * (1 << (10 * ' kmg'.index(m.group(2).lower() or ' '))))
+
+class TokenBucket(object):
+    """Limits a flow of bytes to rate per second. Up to burst bytes (a second
+    worth by default) accumulate while idle, so a small page isn't delayed
+    after a pause. take() returns how long to sleep for the bytes just read;
+    the bucket can go into debt, so chunks larger than it still get through.
+    Used from several download threads.
+
+    >>> b = TokenBucket(1000, 500, now=0)
+    >>> b.take(400, now=0), b.take(400, now=0), b.take(100, now=1)
+    (0.0, 0.3, 0.0)
+    """
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.monotonic() if now is None else now
+        self.total = 0
+        self.waited = 0.0
+        # the effective rate since the bucket was made
+        self.average = Rate(0)
+        self.average(0)
+        self.lock = threading.Lock()
+
+    def take(self, nbytes, now=None):
+        with self.lock:
+            now = time.monotonic() if now is None else now
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.total += nbytes
+            self.waited += wait
+            return wait
+
+    def effective(self):
+        with self.lock:
+            return self.average(self.total)
+
+
+class LimitedReader(object):
+    """A response whose body is read through limit(nbytes), which sleeps as
+    long as the bandwidth limits require and returns the seconds slept, added
+    up in waited. Its other attributes are the response's."""
+    def __init__(self, response, limit):
+        self.response = response
+        self.limit = limit
+        self.waited = 0.0
+
+    def read(self, size=None):
+        data = self.response.read(size)
+        if data:
+            self.waited += self.limit(len(data))
+        return data
+
+    def readinto(self, buf):
+        nread = self.response.readinto(buf)
+        if nread:
+            self.waited += self.limit(nread)
+        return nread
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
 def xmkdir(d):
     rev_path_list = list()
     head = d
@@ -408,21 +720,381 @@ def xmkdir(d):
                 raise
 
 
+class DirectoryCache(object):
+    """Creates directories, remembering the ones known to exist so that
+    saving a file doesn't try os.mkdir on all its ancestors every time"""
+    def __init__(self):
+        self.known = set()
+
+    def makedirs(self, d):
+        if not d or d in self.known:
+            return
+        os.makedirs(d, exist_ok=True)
+        while d and d not in self.known:
+            self.known.add(d)
+            d = os.path.dirname(d)
+
+
+class DedupIndex(object):
+    """The first file each distinct body was saved to, by the size and sha256
+    digest of the body, for --dedup. Used from several download threads.
+
+    A file is only registered once it's written, and forgotten before it's
+    written again, so link() never makes a copy of a stale inode."""
+    def __init__(self):
+        self.paths = {}
+        # the key of each registered file
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.duplicates = 0
+        self.saved = 0
+
+    def add(self, key, path):
+        """Registers path for key = (size, digest), returns where an identical
+        body was saved before or None"""
+        with self.lock:
+            original = self.paths.setdefault(key, path)
+        return original if original != path else None
+
+    def link(self, key, path):
+        """Replaces path with a hardlink to the file registered for key, or
+        registers path if there is none. Returns whether path was linked. The
+        lookup and the link are done under the lock, so the file can't be
+        written again in between."""
+        with self.lock:
+            original = self.paths.get(key)
+            if original is not None and original != path:
+                tmp = path + '.pwget-link'
+                try:
+                    os.link(original, tmp)
+                    os.replace(tmp, path)
+                    return True
+                except OSError as e:
+                    # no hardlinks on this filesystem or the first copy is gone
+                    logging.warning('{0}: not linked to {1}: {2}'.format(path, original, e))
+                    self.keys.pop(original, None)
+            self.paths[key] = path
+            self.keys[path] = key
+            return False
+
+    def forget(self, path):
+        """Unregisters path, about to be written again"""
+        with self.lock:
+            key = self.keys.pop(path, None)
+            if key is not None:
+                del self.paths[key]
+
+    def linked(self, size):
+        with self.lock:
+            self.duplicates += 1
+            self.saved += size
+
+
+class PendingFile(object):
+    def __init__(self, path, url, offset):
+        self.path = path
+        self.url = url
+        self.offset = offset
+        self.file = None
+        self.error = None
+        self.seconds = 0.0
+        self.on_done = None
+        # (data, buffer) not submitted yet
+        self.chunks = []
+        self.buffered = 0
+        # the DedupIndex key of the body, to hardlink it to an identical file
+        self.dedup_key = None
+        self.linked = False
+        # whether the file was opened, and whether to keep it if aborted
+        self.opened = False
+        self.keep = False
+
+
+class WriteBehind(object):
+    """Writes the downloaded files from a background thread, so downloads
+    don't wait on the disk. Bodies are read into at most nbuffers reusable
+    buffers, a buffer comes back once its chunk is written: when the disk
+    lags buffer() blocks and downloads slow down to its speed. Chunks are
+    handed to the writer BUFFER_SIZE or max_held buffers at a time, a small
+    file in one go, so concurrent downloads need more than max_held - 1
+    buffers each.
+
+    With fsync_batch, files are fsynced and closed fsync_batch at a time and
+    their on_done callbacks only run once they are on disk.
+
+    A file closed with a dedup_key becomes a hardlink to the identical file
+    registered in dedup, without being written at all if it was small enough
+    to be still waiting in memory."""
+    BUFFER_SIZE = 64 << 10
+
+    def __init__(self, nbuffers=64, fsync_batch=0, instrumentation=None, on_error=None, dedup=None):
+        self.nbuffers = nbuffers
+        self.max_held = min(4, max(1, nbuffers // 2))
+        self.allocated = 0
+        self.free = queue.Queue()
+        self.jobs = queue.Queue(maxsize=nbuffers)
+        self.fsync_batch = fsync_batch
+        self.unsynced = []
+        self.instrumentation = instrumentation or Instrumentation()
+        self.on_error = on_error
+        self.dedup = dedup
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def buffer(self):
+        """A free buffer of BUFFER_SIZE bytes to read a chunk into"""
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.allocated < self.nbuffers:
+                self.allocated += 1
+                return bytearray(WriteBehind.BUFFER_SIZE)
+        return self.free.get()
+
+    def release(self, buf):
+        self.free.put(buf)
+
+    def submit(self, job):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='pwget-writer', daemon=True)
+                self.thread.start()
+        self.jobs.put(job)
+
+    def open(self, path, url=None, offset=0):
+        """A file to write from offset, truncated there"""
+        return PendingFile(path, url, offset)
+
+    def write(self, pending, data, buf=None):
+        """Appends data to pending, buf is released once data is written"""
+        if not data:
+            if buf is not None:
+                self.release(buf)
+            return
+        pending.chunks.append((data, buf))
+        pending.buffered += len(data)
+        if pending.buffered >= WriteBehind.BUFFER_SIZE or len(pending.chunks) >= self.max_held:
+            self.submit(('write', pending, pending.chunks))
+            pending.chunks = []
+            pending.buffered = 0
+
+    def abort(self, pending, buf=None, keep=False):
+        """Gives up on pending after a failed download: buf, the buffer being
+        read into, and the chunks not submitted yet are released. The file is
+        closed, and removed unless keep, if it was written to at all."""
+        if buf is not None:
+            self.release(buf)
+        for (_, b) in pending.chunks:
+            if b is not None:
+                self.release(b)
+        pending.chunks = []
+        pending.buffered = 0
+        pending.keep = keep
+        self.submit(('abort', pending, []))
+
+    def close(self, pending, on_done=None, dedup_key=None):
+        pending.on_done = on_done
+        pending.dedup_key = dedup_key
+        self.submit(('close', pending, pending.chunks))
+        pending.chunks = []
+
+    def flush(self):
+        """Waits until everything submitted is written, and fsynced with fsync_batch"""
+        if self.thread is None:
+            return
+        self.submit(('sync', None, []))
+        self.jobs.join()
+
+    def shutdown(self):
+        self.flush()
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            (op, pending, chunks) = job
+            cpu = time.thread_time()
+            try:
+                if op == 'sync':
+                    self.sync()
+                elif op == 'abort':
+                    self.discard(pending)
+                elif op == 'close' and pending.dedup_key and pending.file is None and self.link(pending):
+                    self.done(pending)
+                elif pending.error is None:
+                    start = time.perf_counter()
+                    if pending.file is None:
+                        if self.dedup:
+                            self.dedup.forget(pending.path)
+                        if not pending.offset:
+                            # truncating a file hardlinked by --dedup would change its
+                            # other copies too, the new content gets its own inode
+                            try:
+                                os.unlink(pending.path)
+                            except FileNotFoundError:
+                                pass
+                        pending.file = io.open(pending.path, 'r+b' if pending.offset else 'wb')
+                        pending.opened = True
+                        if pending.offset:
+                            pending.file.seek(pending.offset)
+                            pending.file.truncate()
+                    for (data, _) in chunks:
+                        pending.file.write(data)
+                    pending.seconds += time.perf_counter() - start
+                    if op == 'close':
+                        self.finish(pending)
+            except OSError as e:
+                self.failed(pending, e)
+            finally:
+                for (_, buf) in chunks:
+                    if buf is not None:
+                        self.free.put(buf)
+                self.instrumentation.record_cpu('write', time.thread_time() - cpu)
+                self.jobs.task_done()
+
+    def link(self, pending):
+        """Replaces pending.path with a hardlink to an identical file, returns
+        whether it worked. Otherwise pending.path is the file to link the next
+        copies to."""
+        pending.linked = self.dedup.link(pending.dedup_key, pending.path)
+        return pending.linked
+
+    def discard(self, pending):
+        if pending.file:
+            pending.file.close()
+            pending.file = None
+        if pending.opened and not pending.keep:
+            try:
+                os.remove(pending.path)
+            except FileNotFoundError:
+                pass
+
+    def failed(self, pending, e):
+        logging.error('writing {0} failed: {1}'.format(pending.path, e))
+        pending.error = e
+        if pending.file:
+            pending.file.close()
+            pending.file = None
+        if self.on_error:
+            self.on_error(pending.url, e)
+
+    def finish(self, pending):
+        if not self.fsync_batch or pending.dedup_key:
+            start = time.perf_counter()
+            pending.file.close()
+            pending.seconds += time.perf_counter() - start
+            if pending.dedup_key:
+                # too big to be kept in memory, at least the disk space is saved
+                self.link(pending)
+            self.done(pending)
+            return
+        pending.file.flush()
+        self.unsynced.append(pending)
+        if len(self.unsynced) >= self.fsync_batch:
+            self.sync()
+
+    def sync(self):
+        if not self.unsynced:
+            return
+        (unsynced, self.unsynced) = (self.unsynced, [])
+        start = time.perf_counter()
+        for pending in unsynced:
+            try:
+                os.fsync(pending.file.fileno())
+                pending.file.close()
+            except OSError as e:
+                self.failed(pending, e)
+        self.instrumentation.record('fsync', time.perf_counter() - start)
+        for pending in unsynced:
+            if pending.error is None:
+                self.done(pending)
+
+    def done(self, pending):
+        self.instrumentation.record('write', pending.seconds, pending.url)
+        if pending.on_done:
+            pending.on_done()
+
+
+Cookie = collections.namedtuple('Cookie', 'domain subdomains path secure expires name value')
+
+class CookieJar(dict):
+    """Cookies of a Netscape cookie file. As a dict it maps domain => name =>
+    value, lookups go through an index of the domains by reversed labels
+    (com -> example -> www) so finding the cookies of a host walks one branch,
+    in time proportional to the length of the hostname.
+
+    >>> jar = CookieJar(); jar.add(Cookie('.example.com', True, '/', False, 0, 'a', '1'))
+    >>> jar.add(Cookie('www.example.com', False, '/app', True, 0, 'b', '2'))
+    >>> jar.cookie_header('www.example.com', '/app/x', True), jar.cookie_header('www.example.com', '/', False)
+    ('b=2; a=1', 'a=1')
+    >>> jar.cookie_header('sub.www.example.com', '/app', True), jar.cookie_header('notexample.com', '/', True)
+    ('a=1', '')
+    """
+    def __init__(self):
+        super(CookieJar, self).__init__()
+        self.index = {}
+
+    def add(self, cookie):
+        self.setdefault(cookie.domain, {})[cookie.name] = cookie.value
+        node = self.index
+        for label in reversed(remove_first_dot(without_port(cookie.domain)).lower().split('.')):
+            node = node.setdefault(label, {})
+        node.setdefault(None, []).append(cookie)
+
+    def lookup(self, host, path='/', secure=False, now=None):
+        """returns the cookies to send to host for path, most specific path first"""
+        now = now or time.time()
+        res = []
+        node = self.index
+        labels = host.lower().split('.')
+        for i in range(len(labels) - 1, -1, -1):
+            node = node.get(labels[i])
+            if node is None:
+                break
+            for c in node.get(None, ()):
+                # the cookies of a parent domain only if they apply to subdomains
+                if i and not (c.subdomains or c.domain.startswith('.')):
+                    continue
+                if c.secure and not secure:
+                    continue
+                if c.expires and c.expires < now:
+                    continue
+                if not (path == c.path or path.startswith(c.path.rstrip('/') + '/') or c.path == '/'):
+                    continue
+                res.append(c)
+        res.sort(key=lambda c: len(c.path), reverse=True)
+        return res
+
+    def cookie_header(self, host, path='/', secure=False):
+        return '; '.join('{0}={1}'.format(c.name, c.value) for c in self.lookup(host, path, secure))
+
+
 def parse_cookie_file(content):
-    """returns a dict of tuples of domain => cookie => value"""
-    host_cookies = dict()
+    """returns a CookieJar, a dict of domain => cookie => value"""
+    host_cookies = CookieJar()
     #for line in content.decode().split(os.linesep):
     for line in content.split(os.linesep):
         line = line.rstrip()
+        # curl marks HttpOnly cookies with this prefix
+        if line.startswith('#HttpOnly_'):
+            line = line[len('#HttpOnly_'):]
         if not re.match("^#", line) and line:
             try:
                 fields = line.split("\t")
-                cookie = host_cookies.get(fields[0], {})
-                if len(fields) == 7:
-                    cookie[fields[5]] = fields[6]
-                else:
-                    cookie[fields[5]] = ''
-                host_cookies[fields[0]] = cookie
+                try:
+                    expires = int(fields[4])
+                except ValueError:
+                    expires = 0
+                host_cookies.add(Cookie(fields[0], fields[1].upper() == 'TRUE', fields[2] or '/',
+                    fields[3].upper() == 'TRUE', expires, fields[5], fields[6] if len(fields) == 7 else ''))
             except IndexError:
                 sys.stderr.write("warning: ignoring cookiefile entry with insufficient fields: {0}".format(line))
     return host_cookies
@@ -433,33 +1105,1597 @@ def without_port(netloc):
         return netloc[:colon_pos]
     return netloc
 
+def shard_of(url, count):
+    """The worker of --workers crawling url, all the urls of a host go to the same one"""
+    return zlib.crc32(urllib.parse.urlsplit(url).netloc.encode()) % count
+
+def with_suffix(path, suffix):
+    """Inserts suffix before the extensions of path
+
+    >>> with_suffix('out/crawl.warc.gz', '-1')
+    'out/crawl-1.warc.gz'
+    >>> with_suffix('.pwget-meta.sqlite', '-1')
+    '.pwget-meta-1.sqlite'
+    """
+    (head, tail) = os.path.split(path)
+    dots = len(tail) - len(tail.lstrip('.'))
+    (base, dot, ext) = tail[dots:].partition('.')
+    return os.path.join(head, tail[:dots] + base + suffix + dot + ext)
+
 def remove_first_dot(netloc):
     if netloc[0] == '.':
         return netloc[1:]
     return netloc
 
 
+class Histogram(object):
+    """Durations in log2 buckets starting at 1µs: constant memory however
+    many values are recorded, percentiles are exact to a factor of 2.
+
+    >>> h = Histogram()
+    >>> for ms in range(1, 101): h.record(ms / 1000.0)
+    >>> h.count, round(h.total, 3), h.max
+    (100, 5.05, 0.1)
+    >>> 0.025 < h.percentile(50) <= 0.1
+    True
+    """
+    RESOLUTION = 1e-6
+    NBUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * Histogram.NBUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def record(self, seconds):
+        i = int(seconds / Histogram.RESOLUTION).bit_length()
+        self.buckets[min(i, Histogram.NBUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for (i, n) in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, capped to max"""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(Histogram.RESOLUTION * (1 << i), self.max)
+        return self.max
+
+
+class Instrumentation(object):
+    """Per-phase timing histograms of the requests. record() is thread safe
+    and calls every hook with (phase, seconds, url).
+
+    The CPU time of a phase is added up separately, from the CPU clock of the
+    thread running it: by phase(), cpu_timed() and record_cpu()."""
+    PHASES = ('dns', 'connect', 'tls', 'ttfb', 'body', 'limit', 'decompress', 'parse',
+              'write', 'fsync', 'save', 'normalize', 'recurse', 'request')
+
+    def __init__(self):
+        self.histograms = collections.defaultdict(Histogram)
+        self.cpu = collections.Counter()
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def record(self, phase, seconds, url=None):
+        with self.lock:
+            self.histograms[phase].record(seconds)
+        for hook in self.hooks:
+            hook(phase, seconds, url)
+
+    def record_cpu(self, phase, seconds):
+        """Adds seconds of CPU time of the current thread to phase"""
+        with self.lock:
+            self.cpu[phase] += seconds
+
+    def cpu_timed(self, phase, f):
+        """f, with the CPU time of its calls added to phase"""
+        def timed(*args):
+            cpu = time.thread_time()
+            try:
+                return f(*args)
+            finally:
+                self.record_cpu(phase, time.thread_time() - cpu)
+        return timed
+
+    @contextlib.contextmanager
+    def phase(self, name, url=None):
+        start = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.record_cpu(name, time.thread_time() - cpu)
+            self.record(name, time.perf_counter() - start, url)
+
+    def summary(self):
+        """{phase: {'count', 'total', 'mean', 'p50', 'p90', 'p99', 'max', 'cpu'}} in seconds"""
+        res = collections.OrderedDict()
+        with self.lock:
+            phases = [p for p in Instrumentation.PHASES if p in self.histograms]
+            phases += sorted(set(self.histograms) - set(Instrumentation.PHASES))
+            for phase in phases:
+                h = self.histograms[phase]
+                res[phase] = {'count': h.count, 'total': h.total, 'mean': h.mean(),
+                    'p50': h.percentile(50), 'p90': h.percentile(90),
+                    'p99': h.percentile(99), 'max': h.max, 'cpu': self.cpu.get(phase, 0.0)}
+        return res
+
+    def report(self):
+        lines = ['{0:<11}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}{6:>10}{7:>10}'.format(
+            'phase', 'count', 'total s', 'cpu s', 'mean ms', 'p50 ms', 'p99 ms', 'max ms')]
+        for (phase, s) in self.summary().items():
+            lines.append('{0:<11}{1:>8}{2:>10.3f}{3:>10.3f}{4:>10.2f}{5:>10.2f}{6:>10.2f}{7:>10.2f}'.format(
+                phase, s['count'], s['total'], s['cpu'], s['mean'] * 1000, s['p50'] * 1000,
+                s['p99'] * 1000, s['max'] * 1000))
+        return '\n'.join(lines)
+
+
+class Reservoir(object):
+    """A uniform random sample of at most size of the items added to it
+    (Vitter's algorithm R), seen counts them all.
+
+    >>> r = Reservoir(10)
+    >>> for i in range(1000): r.add(i)
+    >>> len(r), r.seen
+    (10, 1000)
+    """
+    def __init__(self, size=100):
+        self.size = size
+        self.items = []
+        self.seen = 0
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return
+        i = random.randrange(self.seen)
+        if i < self.size:
+            self.items[i] = item
+
+    def merge(self, other):
+        """Adds the sample of another reservoir"""
+        seen = self.seen + other.seen
+        for item in other.items:
+            self.add(item)
+        self.seen = seen
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        if self.seen > len(self.items):
+            return '{0} (sample of {1})'.format(self.items, self.seen)
+        return repr(self.items)
+
+
+class Metrics(object):
+    """Live counters of a crawl for MetricsExporter: requests, bytes, responses
+    per status code, requests in flight, frontier size and the time to first
+    byte of every host. Rates are averaged over the last WINDOW seconds. Only
+    the first max_hosts hosts are tracked on their own, the others of a bulk
+    crawl are added up under OTHER_HOSTS."""
+    WINDOW = 10
+    MAX_HOSTS = 100
+    OTHER_HOSTS = 'other'
+
+    def __init__(self, instrumentation, frontier_size=None, max_hosts=MAX_HOSTS):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.bytes = 0
+        self.inflight = 0
+        self.status = collections.Counter()
+        self.hosts = collections.defaultdict(Histogram)
+        self.max_hosts = max_hosts
+        self.frontier_size = frontier_size or (lambda: 0)
+        # (time, requests, bytes) of the previous snapshots within the window
+        self.samples = collections.deque()
+        instrumentation.hooks.append(self.on_phase)
+
+    def on_phase(self, phase, seconds, url):
+        if phase == 'ttfb' and url:
+            host = urllib.parse.urlsplit(url).netloc
+            with self.lock:
+                if host not in self.hosts and len(self.hosts) >= self.max_hosts:
+                    host = Metrics.OTHER_HOSTS
+                self.hosts[host].record(seconds)
+
+    def request_started(self):
+        with self.lock:
+            self.inflight += 1
+
+    def request_finished(self):
+        with self.lock:
+            self.inflight -= 1
+            self.requests += 1
+
+    def response(self, status):
+        with self.lock:
+            self.status[status] += 1
+
+    def add_bytes(self, nbytes):
+        with self.lock:
+            self.bytes += nbytes
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            self.samples.append((now, self.requests, self.bytes))
+            while len(self.samples) > 2 and now - self.samples[1][0] >= Metrics.WINDOW:
+                self.samples.popleft()
+            (since, requests, nbytes) = self.samples[0] if len(self.samples) > 1 else (self.started, 0, 0)
+            elapsed = max(now - since, 1e-6)
+            snapshot = {
+                'time': now,
+                'uptime': now - self.started,
+                'requests': self.requests,
+                'bytes': self.bytes,
+                'requests_per_s': (self.requests - requests) / elapsed,
+                'bytes_per_s': (self.bytes - nbytes) / elapsed,
+                'inflight': self.inflight,
+                'status': dict((str(k), v) for (k, v) in sorted(self.status.items())),
+                'hosts': dict((host, {'count': h.count, 'sum': h.total, 'p50': h.percentile(50),
+                    'p90': h.percentile(90), 'p99': h.percentile(99), 'max': h.max})
+                    for (host, h) in self.hosts.items()),
+            }
+        snapshot['frontier'] = self.frontier_size()
+        return snapshot
+
+    @staticmethod
+    def to_json(snapshot):
+        return json.dumps(snapshot, indent=1, sort_keys=True) + '\n'
+
+    @staticmethod
+    def to_prometheus(snapshot):
+        """The snapshot in the Prometheus text exposition format"""
+        def label(value):
+            return value.replace('\\', '\\\\').replace('"', '\\"')
+
+        lines = []
+        def metric(name, kind, helptext, samples):
+            lines.append('# HELP pwget_{0} {1}'.format(name, helptext))
+            lines.append('# TYPE pwget_{0} {1}'.format(name, kind))
+            for (suffix, labels, value) in samples:
+                labels = ','.join('{0}="{1}"'.format(k, label(v)) for (k, v) in labels)
+                lines.append('pwget_{0}{1}{2} {3!r}'.format(name, suffix, '{' + labels + '}' if labels else '', value))
+
+        metric('requests_total', 'counter', 'Requests completed.', [('', (), snapshot['requests'])])
+        metric('bytes_total', 'counter', 'Body bytes downloaded.', [('', (), snapshot['bytes'])])
+        metric('requests_per_second', 'gauge', 'Recent request rate.', [('', (), snapshot['requests_per_s'])])
+        metric('bytes_per_second', 'gauge', 'Recent download rate.', [('', (), snapshot['bytes_per_s'])])
+        metric('inflight', 'gauge', 'Requests in progress.', [('', (), snapshot['inflight'])])
+        metric('frontier', 'gauge', 'Urls waiting to be crawled.', [('', (), snapshot['frontier'])])
+        metric('responses_total', 'counter', 'Responses by status code.',
+            [('', (('code', code),), n) for (code, n) in snapshot['status'].items()])
+        samples = []
+        for (host, s) in sorted(snapshot['hosts'].items()):
+            for q in ('50', '90', '99'):
+                samples.append(('', (('host', host), ('quantile', '0.' + q)), s['p' + q]))
+            samples.append(('_sum', (('host', host),), s['sum']))
+            samples.append(('_count', (('host', host),), s['count']))
+        metric('ttfb_seconds', 'summary', 'Time to first byte by host.', samples)
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter(object):
+    """Publishes the Metrics snapshots. target is either a file, rewritten
+    every interval seconds in JSON if its name ends with .json and in the
+    Prometheus text format otherwise, or [host]:port to serve them over http
+    at /metrics (Prometheus) and /metrics.json."""
+    def __init__(self, metrics, target, interval=10):
+        self.metrics = metrics
+        self.interval = interval
+        self.path = None
+        self.server = None
+        self.stopped = threading.Event()
+        m = re.match(r'^([\w.-]*):(\d+)$', target)
+        if m:
+            self.server = http.server.ThreadingHTTPServer((m.group(1) or '127.0.0.1', int(m.group(2))),
+                functools.partial(MetricsHandler, metrics))
+            self.server.daemon_threads = True
+            self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        else:
+            self.path = target
+            self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        return self.server.server_address if self.server else None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        snapshot = self.metrics.snapshot()
+        text = Metrics.to_json(snapshot) if self.path.endswith('.json') else Metrics.to_prometheus(snapshot)
+        # readers never see a half written file
+        with io.open(self.path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(self.path + '.tmp', self.path)
+
+    def close(self):
+        self.stopped.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        else:
+            self.thread.join()
+            self.write()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def __init__(self, metrics, *args, **kvargs):
+        self.metrics = metrics
+        super(MetricsHandler, self).__init__(*args, **kvargs)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            (body, content_type) = (Metrics.to_prometheus(self.metrics.snapshot()), 'text/plain; version=0.0.4')
+        elif self.path == '/metrics.json':
+            (body, content_type) = (Metrics.to_json(self.metrics.snapshot()), 'application/json')
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PooledResponse(object):
+    """An http.client.HTTPResponse which gives its connection back to the pool
+    once the body has been read completely"""
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def getheaders(self):
+        return self.response.getheaders()
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if amt is None or not data:
+            self.close()
+        return data
+
+    def readinto(self, b):
+        n = self.response.readinto(b)
+        if not n:
+            self.close()
+        return n
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.put(self.key, conn)
+        else:
+            # unread body or server closing: the connection can't be reused
+            self.response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DecodingError(ValueError):
+    """A body that isn't encoded as its Content-Encoding says"""
+
+
+class ContentDecoder(object):
+    """Decompresses a gzip, deflate or br (when the brotli module is installed)
+    encoded body chunk by chunk, decompress(b'') returns the end of the body.
+
+    >>> data = zlib.compress(b'pwget' * 1000); d = ContentDecoder('deflate')
+    >>> d.decompress(data[:10]) + d.decompress(data[10:]) + d.decompress(b'') == b'pwget' * 1000
+    True
+    """
+    ACCEPT_ENCODING = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.obj = None
+        if encoding in ('gzip', 'x-gzip'):
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'br' and brotli:
+            self.obj = brotli.Decompressor()
+        elif encoding != 'deflate':
+            raise ValueError('unsupported content encoding: {0}'.format(encoding))
+
+    @staticmethod
+    def for_response(response):
+        """A decoder for the Content-Encoding of response, None if it isn't encoded"""
+        encoding = response.getheader('Content-Encoding', '').strip().lower() if hasattr(response, 'getheader') else ''
+        if not encoding or encoding == 'identity':
+            return None
+        try:
+            return ContentDecoder(encoding)
+        except ValueError as e:
+            logging.error('{0}, saving the body as received'.format(e))
+            return None
+
+    ERRORS = (zlib.error, brotli.error) if brotli else (zlib.error,)
+
+    def decompress(self, chunk):
+        """The decoded data of chunk, raises DecodingError if it can't be decoded"""
+        try:
+            if self.encoding == 'br':
+                return self.obj.process(bytes(chunk)) if chunk else b''
+            if not chunk:
+                return self.obj.flush() if self.obj else b''
+            if self.obj is None:
+                # "deflate" is meant to be zlib wrapped, but some servers send it raw
+                self.obj = zlib.decompressobj()
+                try:
+                    return self.obj.decompress(chunk)
+                except zlib.error:
+                    self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.obj.decompress(chunk)
+        except ContentDecoder.ERRORS as e:
+            raise DecodingError('invalid {0} body: {1}'.format(self.encoding, e))
+
+
+class ConnectionPool(object):
+    """Keeps idle keep-alive http.client connections per (scheme, host, port)
+    so that consecutive requests to the same host skip the TCP/TLS handshake.
+    At most max_size idle connections are kept per host, connections idle for
+    more than idle_timeout seconds are discarded. Requests go through the
+    proxies of the http_proxy and https_proxy environment variables, except
+    to the hosts listed in no_proxy: absolute urls sent to the proxy for http,
+    a CONNECT tunnel for https."""
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 10
+    USER_AGENT = 'pwget/{0}'.format(__version__)
+
+    def __init__(self, max_size=8, idle_timeout=30, timeout=60, instrumentation=None, proxies=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.idle = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.retries = 0
+        self.sslcontext = None
+        self.instrumentation = instrumentation or Instrumentation()
+        # scheme => proxy url, plus 'no' for the hosts reached directly
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+
+    def proxy(self, parsed_url):
+        """The url of the proxy to reach parsed_url through, or None"""
+        proxy = self.proxies.get(parsed_url.scheme)
+        if not proxy or urllib.request.proxy_bypass_environment(parsed_url.hostname or '', self.proxies):
+            return None
+        return proxy if '://' in proxy else 'http://' + proxy
+
+    @staticmethod
+    def proxy_headers(proxy):
+        """The Proxy-Authorization header for the credentials in the proxy url, if any"""
+        parsed_proxy = urllib.parse.urlsplit(proxy)
+        if not parsed_proxy.username:
+            return {}
+        credentials = '{0}:{1}'.format(urllib.parse.unquote(parsed_proxy.username), urllib.parse.unquote(parsed_proxy.password or ''))
+        return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode()).decode()}
+
+    def key(self, parsed_url):
+        port = parsed_url.port
+        if not port:
+            port = 443 if parsed_url.scheme == 'https' else 80
+        return (parsed_url.scheme, parsed_url.hostname, port, self.proxy(parsed_url))
+
+    def connect(self, key):
+        (scheme, host, port, proxy) = key
+        (conn_host, conn_port) = (host, port)
+        if proxy:
+            parsed_proxy = urllib.parse.urlsplit(proxy)
+            if parsed_proxy.scheme != 'http':
+                raise urllib.error.URLError('unsupported proxy scheme: {0}'.format(proxy))
+            (conn_host, conn_port) = (parsed_proxy.hostname, parsed_proxy.port or 80)
+        if scheme == 'https':
+            if not self.sslcontext:
+                self.sslcontext = ssl.create_default_context()
+            conn = http.client.HTTPSConnection(conn_host, conn_port, timeout=self.timeout, context=self.sslcontext)
+            if proxy:
+                conn.set_tunnel(host, port, ConnectionPool.proxy_headers(proxy))
+            return conn
+        elif scheme == 'http':
+            return http.client.HTTPConnection(conn_host, conn_port, timeout=self.timeout)
+        raise urllib.error.URLError('unsupported url scheme: {0}'.format(scheme))
+
+    def create_connection(self, url, timing, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        """socket.create_connection timing the name lookup and the TCP handshake"""
+        (host, port) = address
+        start = time.perf_counter()
+        addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        resolved = time.perf_counter()
+        self.instrumentation.record('dns', resolved - start, url)
+        err = None
+        for (af, socktype, proto, _, sa) in addrinfo:
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sa)
+                timing['connected'] = time.perf_counter()
+                self.instrumentation.record('connect', timing['connected'] - resolved, url)
+                return sock
+            except OSError as e:
+                err = e
+                if sock is not None:
+                    sock.close()
+        raise err or OSError('getaddrinfo returned no address for {0}'.format(host))
+
+    def open(self, conn, url):
+        """Connects a new connection, recording the dns, connect and tls phases"""
+        timing = {}
+        conn._create_connection = functools.partial(self.create_connection, url, timing)
+        conn.connect()
+        if isinstance(conn, http.client.HTTPSConnection) and 'connected' in timing:
+            self.instrumentation.record('tls', time.perf_counter() - timing['connected'], url)
+
+    def get(self, key):
+        """returns (connection, reused)"""
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle[key]
+            while idle:
+                (conn, last_used) = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    self.hits += 1
+                    return (conn, True)
+                conn.close()
+            self.misses += 1
+        return (self.connect(key), False)
+
+    def put(self, key, conn):
+        with self.lock:
+            idle = self.idle[key]
+            if len(idle) < self.max_size:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for (conn, _) in idle:
+                    conn.close()
+            self.idle.clear()
+
+    def request(self, method, url, headers):
+        """Sends a request over a pooled connection, retrying once on a fresh
+        connection if a reused one turns out to be closed by the server"""
+        parsed_url = urllib.parse.urlsplit(url)
+        key = self.key(parsed_url)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+        proxy = key[3]
+        if proxy and parsed_url.scheme == 'http':
+            # a proxy is asked for the absolute url
+            path = '{0}://{1}{2}'.format(parsed_url.scheme, parsed_url.netloc, path)
+            headers = dict(headers, **ConnectionPool.proxy_headers(proxy))
+
+        while True:
+            (conn, reused) = self.get(key)
+            try:
+                if not reused:
+                    self.open(conn, url)
+                start = time.perf_counter()
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                self.instrumentation.record('ttfb', time.perf_counter() - start, url)
+                return PooledResponse(self, key, conn, response, url)
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                    ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                with self.lock:
+                    self.retries += 1
+            except OSError as e:
+                conn.close()
+                raise urllib.error.URLError(e)
+            except:
+                conn.close()
+                raise
+
+    def urlopen(self, request):
+        """Like urllib.request.urlopen for a urllib.request.Request: follows
+        redirects and raises urllib.error.HTTPError on error status codes. The
+        response has the request sent for its url, and the redirects followed
+        to it as (request, response, body)."""
+        url = request.full_url
+        headers = dict(request.header_items())
+        headers.setdefault('User-Agent', ConnectionPool.USER_AGENT)
+        redirects = []
+        for _ in range(ConnectionPool.MAX_REDIRECTS + 1):
+            sent = urllib.request.Request(url, headers=headers, method=request.get_method())
+            response = self.request(request.get_method(), url, headers)
+            location = response.getheader('Location')
+            if response.status in ConnectionPool.REDIRECT_CODES and location:
+                redirects.append((sent, response, response.read()))
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if response.status >= 400:
+                body = response.read()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+            response.request = sent
+            response.redirects = redirects
+            return response
+        raise urllib.error.HTTPError(url, response.status, 'too many redirects', response.headers, None)
+
+
+class FingerprintSet(object):
+    """A set of urls stored as 64 bit fingerprints in an open addressing hash
+    table backed by an array('Q'), 12 to 23 bytes per url instead of a whole
+    string and a set entry. Two urls with the same fingerprint count as the
+    same url, which takes billions of urls to happen by chance.
+
+    >>> s = FingerprintSet(); s.add('http://a/'), s.add('http://a/'), 'http://a/' in s, 'http://b/' in s, len(s)
+    (True, False, True, False, 1)
+    """
+    MAX_LOAD = 0.7
+
+    def __init__(self, capacity=1024):
+        self.table = array.array('Q', bytes(8 * FingerprintSet.table_size(capacity)))
+        self.count = 0
+
+    @staticmethod
+    def table_size(capacity):
+        return 1 << max(4, int(capacity / FingerprintSet.MAX_LOAD).bit_length())
+
+    @staticmethod
+    def fingerprint(url):
+        fp = int.from_bytes(hashlib.blake2b(url.encode('utf-8', 'surrogateescape'), digest_size=8).digest(), 'little')
+        # 0 marks an empty slot
+        return fp or 1
+
+    def add(self, url):
+        """Adds url, returns whether it was new"""
+        return self.add_fingerprint(FingerprintSet.fingerprint(url))
+
+    def add_fingerprint(self, fp):
+        table = self.table
+        mask = len(table) - 1
+        i = fp & mask
+        while True:
+            v = table[i]
+            if v == fp:
+                return False
+            if not v:
+                table[i] = fp
+                self.count += 1
+                if self.count > len(table) * FingerprintSet.MAX_LOAD:
+                    self.grow()
+                return True
+            i = (i + 1) & mask
+
+    def grow(self):
+        old = self.table
+        self.table = array.array('Q', bytes(16 * len(old)))
+        self.count = 0
+        for fp in old:
+            if fp:
+                self.add_fingerprint(fp)
+
+    def __contains__(self, url):
+        fp = FingerprintSet.fingerprint(url)
+        table = self.table
+        mask = len(table) - 1
+        i = fp & mask
+        while True:
+            v = table[i]
+            if v == fp:
+                return True
+            if not v:
+                return False
+            i = (i + 1) & mask
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return self.table.itemsize * len(self.table)
+
+
+class BloomFilter(object):
+    """Approximate set of urls for very large crawls: a fixed bit array sized
+    for capacity urls, where a url never added is reported as present with
+    probability error_rate (and then skipped by the crawler). Never gives
+    false negatives.
+
+    >>> b = BloomFilter(1000); b.add('http://a/'), b.add('http://a/'), 'http://a/' in b, 'http://b/' in b
+    (True, False, True, False)
+    """
+    def __init__(self, capacity, error_rate=1e-4):
+        self.nbits = max(64, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.nhashes = max(1, int(round(self.nbits / capacity * math.log(2))))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def positions(self, url):
+        digest = hashlib.blake2b(url.encode('utf-8', 'surrogateescape'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def add(self, url):
+        """Adds url, returns whether it was (probably) new"""
+        bits = self.bits
+        new = False
+        for p in self.positions(url):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, url):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self.positions(url))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+
+def make_seen_set(spec):
+    """Builds the seen set for a --seen-set value: set, fingerprint or bloom[:capacity]
+
+    >>> type(make_seen_set('fingerprint')).__name__, make_seen_set('bloom:1000').nhashes
+    ('FingerprintSet', 13)
+    """
+    (kind, _, arg) = spec.partition(':')
+    if kind == 'set':
+        return set()
+    elif kind == 'fingerprint':
+        return FingerprintSet()
+    elif kind == 'bloom':
+        return BloomFilter(int(arg) if arg else 10 ** 7)
+    raise ValueError('unknown seen set: {0}'.format(spec))
+
+
+class Scheduler(object):
+    """Orders the frontier: the url with the lowest priority(url, depth) is
+    crawled first, urls of equal priority in the order they were found. The
+    base class crawls in plain discovery (FIFO) order."""
+    def priority(self, url, depth):
+        return 0
+
+
+class BreadthFirstScheduler(Scheduler):
+    """Shallow pages first: the seeds, then the pages they link to, and so on"""
+    def priority(self, url, depth):
+        return depth
+
+
+class HostRoundRobinScheduler(Scheduler):
+    """Takes turns between hosts: the n-th url found on a host gets priority n,
+    so a host with many pages doesn't hold back the others"""
+    def __init__(self):
+        self.host_count = collections.Counter()
+
+    def priority(self, url, depth):
+        host = urllib.parse.urlsplit(url).netloc
+        self.host_count[host] += 1
+        return self.host_count[host]
+
+
+class PriorityScheduler(Scheduler):
+    """Orders by a user function of (url, depth) returning a number"""
+    def __init__(self, func):
+        self.func = func
+
+    def priority(self, url, depth):
+        return self.func(url, depth)
+
+
+EXPENSIVE_EXTENSIONS = frozenset(['.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.iso', '.img', '.dmg',
+    '.exe', '.msi', '.deb', '.rpm', '.tar', '.mp4', '.mkv', '.avi', '.mov', '.webm', '.mp3', '.flac', '.wav', '.pdf'])
+
+def cheap_first(url, depth):
+    """Breadth first, but every file looking like an archive, disk image or
+    media comes after all the pages
+
+    >>> cheap_first('http://h/a/b.html', 2), cheap_first('http://h/a/b.ISO', 1)
+    (2, 1000001)
+    """
+    ext = os.path.splitext(urllib.parse.urlsplit(url).path)[1].lower()
+    return depth + (1000000 if ext in EXPENSIVE_EXTENSIONS else 0)
+
+
+SCHEDULERS = {
+    'fifo': Scheduler,
+    'bfs': BreadthFirstScheduler,
+    'host': HostRoundRobinScheduler,
+    'cheap': lambda: PriorityScheduler(cheap_first),
+}
+
+
+class MemoryFrontier(object):
+    """The crawl frontier: urls waiting to be crawled, in a heap ordered by the
+    scheduler, and every url seen so far, kept in memory. Lost when the process
+    exits. seen can be any set like object with add and in, such as a
+    FingerprintSet or a BloomFilter."""
+    def __init__(self, seen=None, scheduler=None):
+        self.tocrawl = []
+        self.seen = seen if seen is not None else set()
+        self.scheduler = scheduler or BreadthFirstScheduler()
+        self.seq = 0
+
+    def add(self, url, depth=0):
+        """Queues url unless it has been seen before, returns whether it was queued"""
+        if url in self.seen:
+            return False
+        self.seen.add(url)
+        heapq.heappush(self.tocrawl, (self.scheduler.priority(url, depth), self.seq, url, depth))
+        self.seq += 1
+        return True
+
+    def skip(self, url):
+        """Marks url as seen without queueing it"""
+        self.seen.add(url)
+
+    def pop(self):
+        """Returns the next (url, depth) to crawl, raises KeyError when there is none"""
+        if not self.tocrawl:
+            raise KeyError('pop from an empty frontier')
+        (_, _, url, depth) = heapq.heappop(self.tocrawl)
+        return (url, depth)
+
+    def done(self, url):
+        pass
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __contains__(self, url):
+        return url in self.seen
+
+    def __len__(self):
+        return len(self.tocrawl)
+
+
+class SQLiteFrontier(object):
+    """The crawl frontier stored in state_dir/frontier.sqlite, so memory stays
+    bounded on huge crawls and a crawl can be resumed after a crash or Ctrl-C.
+
+    Each url has a state: PENDING, CRAWLING once popped and DONE once
+    processed. Changes are committed every checkpoint_interval seconds, on
+    restart urls left CRAWLING are crawled again while DONE ones are skipped."""
+    PENDING = 0
+    CRAWLING = 1
+    DONE = 2
+
+    def __init__(self, state_dir, scheduler=None, checkpoint_interval=5):
+        xmkdir(state_dir)
+        self.scheduler = scheduler or BreadthFirstScheduler()
+        self.db = sqlite3.connect(os.path.join(state_dir, 'frontier.sqlite'))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, state INTEGER NOT NULL, depth INTEGER NOT NULL, priority REAL NOT NULL)')
+        # pending urls are popped through this index, in O(log n)
+        self.db.execute('CREATE INDEX IF NOT EXISTS urls_order ON urls (state, priority)')
+        self.db.execute('UPDATE urls SET state = ? WHERE state = ?', (SQLiteFrontier.PENDING, SQLiteFrontier.CRAWLING))
+        self.db.commit()
+        self.pending = self.db.execute('SELECT COUNT(*) FROM urls WHERE state = ?', (SQLiteFrontier.PENDING,)).fetchone()[0]
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.monotonic()
+
+    def add(self, url, depth=0):
+        if url in self:
+            return False
+        cur = self.db.execute('INSERT OR IGNORE INTO urls (url, state, depth, priority) VALUES (?, ?, ?, ?)',
+            (url, SQLiteFrontier.PENDING, depth, self.scheduler.priority(url, depth)))
+        if cur.rowcount:
+            self.pending += 1
+            return True
+        return False
+
+    def skip(self, url):
+        self.db.execute('INSERT OR IGNORE INTO urls (url, state, depth, priority) VALUES (?, ?, 0, 0)', (url, SQLiteFrontier.DONE))
+
+    def pop(self):
+        self.maybe_checkpoint()
+        row = self.db.execute('SELECT rowid, url, depth FROM urls WHERE state = ? ORDER BY priority, rowid LIMIT 1', (SQLiteFrontier.PENDING,)).fetchone()
+        if not row:
+            raise KeyError('pop from an empty frontier')
+        self.db.execute('UPDATE urls SET state = ? WHERE rowid = ?', (SQLiteFrontier.CRAWLING, row[0]))
+        self.pending -= 1
+        return (row[1], row[2])
+
+    def done(self, url):
+        self.db.execute('UPDATE urls SET state = ? WHERE url = ?', (SQLiteFrontier.DONE, url))
+
+    def maybe_checkpoint(self):
+        if time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.db.commit()
+        self.last_checkpoint = time.monotonic()
+
+    def close(self):
+        self.checkpoint()
+        self.db.close()
+
+    def __contains__(self, url):
+        return self.db.execute('SELECT 1 FROM urls WHERE url = ?', (url,)).fetchone() is not None
+
+    def __len__(self):
+        return self.pending
+
+
+class MirrorMetadata(object):
+    """Remembers the validators (ETag, Last-Modified) and Content-Type of every
+    file saved, in an SQLite file at the root of the mirror, so a re-mirror can
+    ask the server for changed files only and an interrupted download can be
+    resumed safely. Used from several download threads.
+
+    It is also the manifest of the mirror: the size, mtime and sha256 of every
+    complete file, so the local copies are looked up in the index instead of
+    stat()ing each of them, a round trip per url on a network filesystem. A
+    manifest created by this run doesn't know the files already there, the
+    filesystem is asked about the paths it lacks until the next run.
+
+    The workers of --workers share it: each of them commits every change
+    (checkpoint_interval=0) so none holds the write lock of the others, and
+    is told by the coordinator, which created the file, whether it was
+    authoritative before the crawl."""
+    FILENAME = '.pwget-meta.sqlite'
+
+    def __init__(self, path=FILENAME, checkpoint_interval=5, authoritative=None):
+        self.lock = threading.Lock()
+        # waits for the other processes writing to the file
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(files)')]
+        # whether every file of the mirror has been saved with the manifest kept
+        self.authoritative = 'size' in columns if authoritative is None else authoritative
+        if columns and 'size' not in columns:
+            for column in ('size INTEGER', 'mtime REAL', 'sha256 TEXT'):
+                self.db.execute('ALTER TABLE files ADD COLUMN ' + column)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_type TEXT, complete INTEGER, content_encoding TEXT,'
+            ' size INTEGER, mtime REAL, sha256 TEXT)')
+        self.db.commit()
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.monotonic()
+
+    def get(self, path):
+        """returns (etag, last_modified, content_type, complete, content_encoding, size, mtime, sha256) or None"""
+        with self.lock:
+            return self.db.execute('SELECT etag, last_modified, content_type, complete, content_encoding, size, mtime, sha256 FROM files WHERE path = ?', (path,)).fetchone()
+
+    def stat(self, path, entry):
+        """(size, mtime) of the local copy of path, whose get() is entry, or None
+        when there is none. Only the files missing from the manifest, or saved
+        before it was kept, are looked up on the filesystem."""
+        if entry and entry[5] is not None:
+            return (entry[5], entry[6])
+        if entry is None and self.authoritative:
+            return None
+        return MirrorMetadata.disk_stat(path)
+
+    @staticmethod
+    def disk_stat(path):
+        """(size, mtime) of path on the filesystem or None"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def update(self, path, response, complete=True, content_encoding=None):
+        """Stores the validators of response for path, with complete=False
+        while the body is being downloaded. content_encoding is the encoding
+        the file is stored with, if it was kept compressed"""
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files (path, etag, last_modified, content_type, complete, content_encoding) VALUES (?, ?, ?, ?, ?, ?)',
+                (path, response.getheader('ETag'), response.getheader('Last-Modified'), response.getheader('Content-Type'), int(complete), content_encoding))
+            self.maybe_checkpoint()
+
+    def forget(self, path):
+        """Drops the entry of path, whose download failed"""
+        with self.lock:
+            self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+            self.maybe_checkpoint()
+
+    def set_complete(self, path, size=None, mtime=None, sha256=None):
+        """Marks path as downloaded completely, recording it in the manifest when its size is given"""
+        with self.lock:
+            self.db.execute('UPDATE files SET complete = 1, size = ?, mtime = ?, sha256 = ? WHERE path = ?', (size, mtime, sha256, path))
+            self.maybe_checkpoint()
+
+    def maybe_checkpoint(self):
+        """Commits if checkpoint_interval has passed, called with the lock held"""
+        if time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.db.commit()
+            self.last_checkpoint = time.monotonic()
+
+    def add_conditions(self, request, path):
+        """Makes request conditional on the validators stored for path if it was
+        downloaded completely, returns the stored entry or None"""
+        entry = self.get(path)
+        if entry and self.stat(path, entry) is None:
+            entry = None
+        if entry and entry[3]:
+            (etag, last_modified) = entry[:2]
+            if etag:
+                request.add_header('If-None-Match', etag)
+            if last_modified:
+                request.add_header('If-Modified-Since', last_modified)
+        return entry
+
+    def add_range(self, request, path, entry):
+        """Asks for the rest of a partially downloaded file, if the entity still
+        matches the stored validator (If-Range). Returns the offset asked from or
+        None"""
+        # an html page is parsed while downloaded, so it's fetched whole
+        if entry and (entry[3] or re.match('^text/html', entry[2] or '')):
+            return None
+        # the partial file isn't in the manifest, it's being written or was by
+        # a run without the manifest
+        local = self.stat(path, entry) if entry else MirrorMetadata.disk_stat(path)
+        size = local and local[0]
+        if not size:
+            return None
+        request.add_header('Range', 'bytes={0}-'.format(size))
+        # ranges of compressed representations can't be appended to the file
+        request.add_header('Accept-Encoding', 'identity')
+        validator = entry and (entry[0] or entry[1])
+        if validator:
+            request.add_header('If-Range', validator)
+        return size
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def surt(url):
+    """The sort-friendly url key of CDX indexes
+
+    >>> surt('http://www.Example.com:8080/a/b?q=1')
+    'com,example:8080)/a/b?q=1'
+    """
+    parsed_url = urllib.parse.urlsplit(url)
+    host = (parsed_url.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    # ip addresses aren't reversed
+    key = host if re.match(r'^[\d.]+$', host) else ','.join(reversed(host.split('.')))
+    if parsed_url.port and parsed_url.port != (443 if parsed_url.scheme == 'https' else 80):
+        key += ':{0}'.format(parsed_url.port)
+    key += ')' + (parsed_url.path or '/').lower()
+    if parsed_url.query:
+        key += '?' + parsed_url.query.lower()
+    return key
+
+
+class WarcWriter(object):
+    """Appends request/response records to WARC files instead of saving every
+    url to its own file. path names the first file: with a .gz extension each
+    record is a gzip member of its own, so records can still be read alone.
+    A new file is started once one grows over max_size, prefix-00000.warc,
+    prefix-00001.warc and so on. Every response is indexed in prefix.cdx, with
+    the file and offset of its record. With a DedupIndex, a body already
+    archived is stored as a revisit record referring to the first one.
+    Used from several download threads."""
+    MAX_SIZE = 1 << 30
+    # bodies are spooled to disk above this size, until their length is known
+    SPOOL_SIZE = 1 << 20
+    CDX_HEADER = ' CDX N b a m s k r M S V g\n'
+
+    PROFILE_IDENTICAL = 'http://netpreserve.org/warc/1.1/revisit/identical-payload-digest'
+
+    def __init__(self, path, max_size=MAX_SIZE, dedup=None):
+        self.dedup = dedup
+        self.compress = path.endswith('.gz')
+        if self.compress:
+            path = path[:-3]
+        self.prefix = path[:-5] if path.endswith('.warc') else path
+        self.suffix = '.warc.gz' if self.compress else '.warc'
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.index = 0
+        self.file = None
+        self.filename = None
+        cdx = self.prefix + '.cdx'
+        new = not os.path.exists(cdx)
+        self.cdx = io.open(cdx, 'a')
+        if new:
+            self.cdx.write(WarcWriter.CDX_HEADER)
+
+    def open_next(self):
+        # an earlier crawl's files are kept
+        while os.path.exists('{0}-{1:05}{2}'.format(self.prefix, self.index, self.suffix)):
+            self.index += 1
+        self.filename = '{0}-{1:05}{2}'.format(self.prefix, self.index, self.suffix)
+        self.file = io.open(self.filename, 'wb')
+        self.index += 1
+        info = 'software: pwget/{0}\r\nformat: WARC File Format 1.1\r\n'.format(__version__).encode()
+        self.write_record([('WARC-Type', 'warcinfo'), ('WARC-Filename', os.path.basename(self.filename)),
+            ('Content-Type', 'application/warc-fields')], [info], len(info))
+
+    @staticmethod
+    def record_id():
+        return '<urn:uuid:{0}>'.format(uuid.uuid4())
+
+    @staticmethod
+    def http_response_head(response):
+        version = getattr(getattr(response, 'response', None), 'version', 11)
+        lines = ['HTTP/{0} {1} {2}'.format('1.0' if version == 10 else '1.1', response.status, response.reason)]
+        for (k, v) in response.getheaders():
+            # the body is stored dechunked
+            if k.lower() != 'transfer-encoding':
+                lines.append('{0}: {1}'.format(k, v))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1', 'replace')
+
+    @staticmethod
+    def http_request_head(request):
+        parsed_url = urllib.parse.urlsplit(request.full_url)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+        # urllib.request.Request capitalizes only the first word of the names
+        headers = dict((k.title(), v) for (k, v) in request.header_items())
+        headers.setdefault('Host', parsed_url.netloc)
+        headers.setdefault('User-Agent', ConnectionPool.USER_AGENT)
+        lines = ['{0} {1} HTTP/1.1'.format(request.get_method(), path)]
+        lines += ['{0}: {1}'.format(k, v) for (k, v) in headers.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1', 'replace')
+
+    def write_record(self, headers, blocks, length):
+        """Writes a record of length bytes made of the blocks, returns its
+        offset and its size in the file"""
+        head = ['WARC/1.1', 'WARC-Record-ID: ' + dict(headers).get('WARC-Record-ID', WarcWriter.record_id()),
+                'WARC-Date: ' + datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')]
+        head += ['{0}: {1}'.format(k, v) for (k, v) in headers if k != 'WARC-Record-ID']
+        head.append('Content-Length: {0}'.format(length))
+        offset = self.file.tell()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if self.compress else None
+        write = (lambda b: self.file.write(compressor.compress(b))) if compressor else self.file.write
+        write(('\r\n'.join(head) + '\r\n\r\n').encode('utf-8'))
+        for block in blocks:
+            write(block)
+        write(b'\r\n\r\n')
+        if compressor:
+            self.file.write(compressor.flush())
+        return (offset, self.file.tell() - offset)
+
+    def write_redirects(self, response, request=None):
+        """Writes a request record, if request is given, and a response record
+        for every redirect followed to response"""
+        for (sent, redirect, body) in getattr(response, 'redirects', ()):
+            self.write_exchange(sent.full_url, sent if request is not None else None, redirect,
+                io.BytesIO(body), len(body), hashlib.sha1(body))
+
+    def write_exchange(self, url, request, response, spool, length, digest):
+        """Writes the request record if request is given and the response
+        record of response, whose body of length bytes is in the spool file"""
+        head = WarcWriter.http_response_head(response)
+        payload_digest = 'sha1:' + base64.b32encode(digest.digest()).decode()
+        response_id = WarcWriter.record_id()
+        def body():
+            yield head
+            spool.seek(0)
+            while True:
+                chunk = spool.read(WriteBehind.BUFFER_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+        now = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        # an empty body, as of most redirects, isn't worth a revisit
+        original = self.dedup.add((length, payload_digest), (url, now)) if self.dedup and length else None
+        with self.lock:
+            if not self.file:
+                self.open_next()
+            if request is not None:
+                request_head = WarcWriter.http_request_head(request)
+                self.write_record([('WARC-Type', 'request'), ('WARC-Target-URI', request.full_url),
+                    ('WARC-Concurrent-To', response_id), ('Content-Type', 'application/http; msgtype=request')],
+                    [request_head], len(request_head))
+            if original:
+                (offset, size) = self.write_record([('WARC-Type', 'revisit'), ('WARC-Record-ID', response_id),
+                    ('WARC-Target-URI', url), ('WARC-Profile', WarcWriter.PROFILE_IDENTICAL),
+                    ('WARC-Refers-To-Target-URI', original[0]), ('WARC-Refers-To-Date', original[1]),
+                    ('WARC-Payload-Digest', payload_digest), ('Content-Type', 'application/http; msgtype=response')],
+                    [head], len(head))
+                self.dedup.linked(length)
+                mime = 'warc/revisit'
+            else:
+                (offset, size) = self.write_record([('WARC-Type', 'response'), ('WARC-Record-ID', response_id),
+                    ('WARC-Target-URI', url), ('WARC-Payload-Digest', payload_digest),
+                    ('Content-Type', 'application/http; msgtype=response')], body(), len(head) + length)
+                mime = (response.getheader('Content-Type') or '-').split(';')[0].strip() or '-'
+            location = response.getheader('Location') if response.status in ConnectionPool.REDIRECT_CODES else None
+            redirect = urllib.parse.urljoin(url, location).replace(' ', '%20') if location else '-'
+            self.cdx.write(' '.join([surt(url), time.strftime('%Y%m%d%H%M%S', time.gmtime()), url,
+                mime.replace(' ', ''), str(response.status), payload_digest[5:], redirect, '-',
+                str(size), str(offset), os.path.basename(self.filename)]) + '\n')
+            if self.file.tell() >= self.max_size:
+                self.file.close()
+                self.file = None
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+            self.cdx.close()
+
+
+def parse_sitemap(f):
+    """Streams the entries of the sitemap or sitemap index read from f as
+    (kind, loc, lastmod), kind being 'url' or 'sitemap' and lastmod None when
+    missing. Entries are dropped from the tree once read, so a sitemap of any
+    size is parsed in constant memory.
+
+    >>> xml = (b'<?xml version="1.0"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+    ...     b'<url><loc> http://a/x </loc><lastmod>2024-01-02</lastmod></url><url><loc>http://a/y</loc></url></urlset>')
+    >>> list(parse_sitemap(io.BytesIO(xml)))
+    [('url', 'http://a/x', '2024-01-02'), ('url', 'http://a/y', None)]
+    """
+    root = None
+    for (event, elem) in xml.etree.ElementTree.iterparse(f, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event != 'end':
+            continue
+        kind = elem.tag.rpartition('}')[2]
+        if kind in ('url', 'sitemap'):
+            fields = dict((child.tag.rpartition('}')[2], (child.text or '').strip()) for child in elem)
+            if fields.get('loc'):
+                yield (kind, fields['loc'], fields.get('lastmod') or None)
+            root.clear()
+
+def parse_lastmod(lastmod):
+    """Seconds since the epoch of a sitemap lastmod (W3C datetime, UTC unless
+    it has a timezone), None if it can't be parsed
+
+    >>> parse_lastmod('2024-01-02'), parse_lastmod('2024-01-02T01:00:00Z'), parse_lastmod('2024-01-02T03:00+02:00'), parse_lastmod('soon')
+    (1704153600.0, 1704157200.0, 1704157200.0, None)
+    """
+    try:
+        date = datetime.datetime.fromisoformat(lastmod.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+class RobotsCache(object):
+    """The parsed robots.txt of every host, fetched once through the pool. A
+    host without one, or failing to serve it, gets an empty set of rules.
+    limited_reader(response, host) reads the bodies, Crawler.limited_reader
+    to keep to the bandwidth limits."""
+    def __init__(self, pool, limited_reader=None):
+        self.pool = pool
+        self.limited_reader = limited_reader or (lambda response, host: response)
+        self.hosts = {}
+
+    def get(self, root):
+        """The urllib.robotparser.RobotFileParser of the host of root, a scheme://netloc/ url"""
+        parser = self.hosts.get(root)
+        if parser is not None:
+            return parser
+        url = root + 'robots.txt'
+        parser = self.hosts[root] = urllib.robotparser.RobotFileParser(url)
+        lines = []
+        try:
+            response = self.pool.urlopen(urllib.request.Request(url))
+            lines = self.limited_reader(response, urllib.parse.urlsplit(root).netloc).read().decode('utf-8', 'replace').splitlines()
+        except urllib.error.HTTPError as e:
+            if e.code < 400 or e.code >= 500:
+                logging.warning('robots.txt of {0} unavailable: {1}'.format(root, e))
+        except (OSError, http.client.HTTPException) as e:
+            logging.warning('robots.txt of {0} unavailable: {1}'.format(root, e))
+        parser.parse(lines)
+        return parser
+
+
+class DelayQueue(object):
+    """Items ordered by the time.monotonic() time they become ready at
+
+    >>> q = DelayQueue(); q.push('b', 2); q.push('a', 1)
+    >>> q.pop_ready(0), q.pop_ready(1.5), q.next_time(), len(q)
+    (None, 'a', 2, 1)
+    """
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+
+    def push(self, item, ready_at):
+        # the sequence number keeps items of the same time in order, and
+        # spares comparing the items themselves
+        heapq.heappush(self.heap, (ready_at, self.seq, item))
+        self.seq += 1
+
+    def pop_ready(self, now):
+        """The first item ready at now, None if there is none"""
+        if self.heap and self.heap[0][0] <= now:
+            return heapq.heappop(self.heap)[2]
+        return None
+
+    def next_time(self):
+        return self.heap[0][0] if self.heap else None
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class HostRate(object):
+    def __init__(self, delay):
+        self.delay = delay
+        self.not_before = 0.0
+        self.fastest = None
+
+
+class HostThrottle(object):
+    """Spaces the requests to each host by a delay adapted AIMD style: every
+    healthy response adds SPEEDUP requests/s to the rate of the host, a 429
+    or 503 response or a time to first byte much slower than the fastest one
+    of the host multiplies its delay by BACKOFF. A Retry-After header keeps
+    the host idle for as long as asked. The delay never gets below the one
+    asked for, nor min_delay. Used from several download threads."""
+    SPEEDUP = 0.5
+    BACKOFF = 2.0
+    MIN_BACKOFF_DELAY = 0.5
+    SLOW_FACTOR = 4
+    SLOW_LATENCY = 1.0
+    MAX_RETRY_AFTER = 3600
+    CONGESTION_CODES = (429, 503)
+
+    def __init__(self, delay=0, min_delay=0, max_delay=60):
+        self.initial_delay = self.min_delay = max(delay, min_delay)
+        self.max_delay = max_delay
+        self.hosts = {}
+        self.backoffs = 0
+        self.lock = threading.Lock()
+
+    def host(self, host):
+        rate = self.hosts.get(host)
+        if rate is None:
+            rate = self.hosts[host] = HostRate(self.initial_delay)
+        return rate
+
+    def wait_time(self, host, now=None):
+        """Seconds to wait before the next request to host"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return max(0.0, self.host(host).not_before - now)
+
+    def started(self, host, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            rate = self.host(host)
+            rate.not_before = max(rate.not_before, now + rate.delay)
+
+    def feedback(self, host, status, latency=None, retry_after=None, now=None):
+        """Adapts the delay of host to a response with status received after
+        latency seconds, retry_after is its Retry-After header if any"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            rate = self.host(host)
+            slow = False
+            if latency is not None:
+                slow = rate.fastest is not None and latency > HostThrottle.SLOW_LATENCY \
+                    and latency > HostThrottle.SLOW_FACTOR * rate.fastest
+                rate.fastest = latency if rate.fastest is None else min(rate.fastest, latency)
+
+            if status in HostThrottle.CONGESTION_CODES or slow:
+                self.backoffs += 1
+                rate.delay = min(self.max_delay, max(rate.delay * HostThrottle.BACKOFF, HostThrottle.MIN_BACKOFF_DELAY))
+                rate.not_before = max(rate.not_before, now + rate.delay)
+                pause = HostThrottle.parse_retry_after(retry_after) if retry_after else None
+                if pause:
+                    rate.not_before = max(rate.not_before, now + min(pause, HostThrottle.MAX_RETRY_AFTER))
+            elif rate.delay > self.min_delay:
+                rate.delay = max(self.min_delay, 1.0 / (1.0 / rate.delay + HostThrottle.SPEEDUP))
+                if rate.delay < 0.01:
+                    rate.delay = self.min_delay
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Seconds asked by a Retry-After header, given in seconds or as a date
+
+        >>> HostThrottle.parse_retry_after('120'), HostThrottle.parse_retry_after('soon')
+        (120.0, None)
+        """
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+    def slowed_down(self):
+        """{host: delay} of the hosts currently spaced by more than min_delay"""
+        with self.lock:
+            return dict((host, rate.delay) for (host, rate) in self.hosts.items() if rate.delay > self.min_delay)
+
+
 class Tree(collections.defaultdict):
     def __init__(self, count = 0):
         super(Tree, self).__init__(Tree)
         self.count = count
 
+class TransientError(Exception):
+    """A failure worth retrying later, code is the HTTP status or the name of
+    the exception, retry_after the seconds the server asked to wait"""
+    def __init__(self, code, retry_after=None):
+        super(TransientError, self).__init__(code)
+        self.code = code
+        self.retry_after = retry_after
+
+
 class Crawler(object):
     ROOTFILENAME = '_root_'
+    ERROR_SAMPLE_SIZE = 100
+    TRANSIENT_CODES = (408, 425, 429, 500, 502, 503, 504)
+    TRIES = 3
+    RETRY_BACKOFF = 1.0
+    MAX_RETRY_BACKOFF = 300
+    SEGMENT_MIN_SIZE = 8 << 20
+    INPUT_BATCH = 1000
 
-    linkregex = re.compile('<a\s(?:.*?\s)*?href=[\'"](.*?)[\'"].*?>', re.IGNORECASE)
     def __init__(self, urls, **kvargs):
         self.seed_urls = urls
         self.seed_urls_netloc = set(map(lambda x: urllib.parse.urlparse(x).netloc, urls))
-        self.tocrawl = set(map(normalize,urls))
-        self.crawled = set([])
+        self.state_dir = kvargs.get('state_dir')
+        self.level = kvargs.get('level')
+        scheduler = kvargs.get('scheduler') or BreadthFirstScheduler()
+        if self.state_dir:
+            self.frontier = SQLiteFrontier(self.state_dir, scheduler)
+        else:
+            self.frontier = MemoryFrontier(make_seen_set(kvargs.get('seen_set') or 'set'), scheduler)
+        # (index, count) of the worker process of a --workers crawl, the links
+        # to hosts of other shards are put in the outbox
+        self.shard = kvargs.get('shard')
+        self.outbox = []
+        self.forwarded = FingerprintSet() if self.shard else None
+        # called after each url by the crawl loops, to exchange the outbox
+        self.exchange = None
+        for url in map(normalize, urls):
+            if self.owns(url):
+                self.frontier.add(url)
+        # more seed urls read from a file ('-' for stdin) as the frontier runs low
+        self.input_file = None
+        # iterators of urls to feed to the frontier in batches, in order
+        self.inputs = []
+        if kvargs.get('input_file'):
+            self.input_file = sys.stdin if kvargs['input_file'] == '-' else open(kvargs['input_file'], encoding='utf-8')
+            self.inputs.append(read_urls(self.input_file))
+        self.recurse = not kvargs.get('no_recurse')
         self.stats = Tree()
+        self.lock = threading.Lock()
 
         self.urlre = re.compile(kvargs['regex']) if kvargs.get('regex') else None
 
         for i in ['regex', 'verbose', 'cookiefile', 'mirror', 'overwrite', 'time']:
             self.__setattr__(i, kvargs.get(i, None))
 
+        self.link_attrs = kvargs.get('link_attrs')
+        self.throttle = HostThrottle(self.time or 0, kvargs.get('min_delay') or 0)
+        self.tries = kvargs.get('tries') or Crawler.TRIES
+        self.retry_backoff = kvargs.get('retry_backoff') or Crawler.RETRY_BACKOFF
+        # url => failed attempts, of the urls waiting to be retried
+        self.attempts = {}
+        self.concurrency = kvargs.get('concurrency') or 1
+        self.host_concurrency = kvargs.get('host_concurrency') or 4
+        self.instrumentation = Instrumentation()
+        self.pool = ConnectionPool(max_size=kvargs.get('pool_size') or 8, instrumentation=self.instrumentation)
+        self.robots = RobotsCache(self.pool, self.limited_reader)
+        if kvargs.get('sitemaps'):
+            hosts = set()
+            for url in map(normalize, urls):
+                netloc = urllib.parse.urlsplit(url).netloc
+                if netloc not in hosts and self.owns(url):
+                    hosts.add(netloc)
+                    self.inputs.append(self.sitemap_urls(url))
+        self.profile = kvargs.get('profile')
+        self.profilers = []
+        self.thread_profiler = threading.local()
+        self.metrics = Metrics(self.instrumentation, lambda: len(self.frontier))
+        self.exporter = None
+        if kvargs.get('metrics'):
+            self.exporter = MetricsExporter(self.metrics, kvargs['metrics'], kvargs.get('metrics_interval') or 10)
+
+        self.keep_compressed = kvargs.get('keep_compressed')
+        self.resume = kvargs.get('resume')
+        self.segments = kvargs.get('segments') or 1
+        self.segment_min_size = kvargs.get('segment_min_size') or Crawler.SEGMENT_MIN_SIZE
+        self.dedup = DedupIndex() if kvargs.get('dedup') else None
+        self.warc = WarcWriter(kvargs['warc'], kvargs.get('warc_max_size') or WarcWriter.MAX_SIZE, self.dedup) if kvargs.get('warc') else None
+        self.metadata = None
+        if Crawler.uses_metadata(kvargs):
+            # the workers of --workers share it
+            self.metadata = MirrorMetadata(checkpoint_interval=0, authoritative=kvargs.get('metadata_authoritative')) \
+                if self.shard else MirrorMetadata()
+        # --limit-rate over all downloads and --host-limit-rate for each host
+        self.limit_burst = kvargs.get('limit_burst')
+        self.bandwidth = TokenBucket(kvargs['limit_rate'], self.limit_burst) if kvargs.get('limit_rate') else None
+        self.host_limit_rate = kvargs.get('host_limit_rate')
+        self.host_bandwidth = {}
+        self.limited = bool(self.bandwidth or self.host_limit_rate)
+        self.dirs = DirectoryCache()
+        self.writer = WriteBehind(max(64, 4 * self.concurrency), kvargs.get('fsync_batch') or 0,
+            self.instrumentation, lambda url, e: self.record_error(url, type(e).__name__), self.dedup)
+
         self.host_cookies = None
         if self.cookiefile:
             if os.path.isfile(self.cookiefile):
@@ -468,67 +2704,354 @@ class Crawler(object):
                 raise RuntimeError("Crawler error: cookie file {0} not found", self.cookiefile)
 
 
-    def save_local(self, url, response, parsed_url):
+    def add_hook(self, hook):
+        """hook(phase, seconds, url) is called after every timed phase of a request"""
+        self.instrumentation.hooks.append(hook)
+
+    @staticmethod
+    def uses_metadata(options):
+        """Whether a crawl with options keeps the MirrorMetadata of the tree,
+        nothing is saved in the tree to compare or resume with a WARC"""
+        return bool((options.get('mirror') or options.get('resume')) and not options.get('warc'))
+
+    @staticmethod
+    def local_filename(parsed_url):
         localpath = url_to_localpath(parsed_url)
-        #print('Destination:',localpath)
         (localdir, localfile) = os.path.split(localpath)
         if not localfile:
             localfile = Crawler.ROOTFILENAME
-
-        new_localpath = os.path.join(localdir, localfile)
-        xmkdir(localdir)
-
-        length = response.getheader('content-length') if isinstance(response, http.client.HTTPResponse) else None
+        return os.path.join(localdir, localfile)
+
+    def save_local(self, url, response, parsed_url, tee=None, request=None, resume_from=None):
+        """Streams the body of response to its local path. If given, tee is called
+        with every chunk read and with b'' at the end, also when the file itself
+        is not written. A 206 response to a resume_from range request is written
+        at its offset, and large files can be downloaded in segments when the
+        request is given."""
+        if self.warc:
+            return self.save_warc(url, response, tee, request)
+        response = self.limited_reader(response, parsed_url.netloc)
+
+        new_localpath = Crawler.local_filename(parsed_url)
+        (localdir, localfile) = os.path.split(new_localpath)
+        self.dirs.makedirs(localdir)
+
+        length = response.getheader('content-length') if hasattr(response, 'getheader') else None
+        decoder = ContentDecoder.for_response(response)
         pb = None
         start = None
+        skip = False
+        offset = 0
 
-        if not self.overwrite and not self.mirror and os.path.exists(new_localpath):
+        content_range = getattr(response, 'status', None) == http.client.PARTIAL_CONTENT \
+            and re.match(r'bytes (\d+)-\d+/(\d+)', response.getheader('Content-Range', ''))
+        if content_range:
+            offset = int(content_range.group(1))
+            length = content_range.group(2)
+            print('{0}: resuming at {1}'.format(new_localpath, humansize(offset)))
+
+        elif not self.overwrite and not self.mirror and resume_from is None and self.local_stat(new_localpath):
             print('{0}: file exists, won\'t overwrite (use --mirror or --overwrite to change this)'.format(new_localpath))
-            return
+            skip = True
 
-        if length:
+        if length and not skip:
             length = int(length)
-            if self.mirror and os.path.exists(new_localpath)\
-                and os.stat(new_localpath).st_size == length:
+            # with stored validators the server already told us the file changed,
+            # the size of a decompressed body can't be compared to content-length
+            if self.mirror and not offset and (not decoder or self.keep_compressed)\
+                and self.same_size(new_localpath, length):
                 print('{0}: remote and local have the same size'.format(new_localpath))
-                return
-
-            pb = ProgressBar(0, length)
-            start = datetime.datetime.now()
+                skip = True
 
-        rate = Rate()
-        with io.open(new_localpath, 'wb') as fd:
-            total = 0
-            while True:
-                nread = response.read(8192)
+            # progress bars of parallel downloads would overwrite each other
+            elif self.concurrency == 1:
+                pb = ProgressBar(0, length)
+                start = datetime.datetime.now()
 
-                total += len(nread)
-                if pb:
-                    pb(total, humansize(total) + ' @ ' + rate(total) + ' ETA: ' + est_finish(start, total, length))
-                elif self.verbose:
-                    sys.stdout.write('\r')
-                    sys.stdout.write('{0} bytes read'.format(total))
+        if skip:
+            if tee:
+                # the links are still needed to recurse
+                self.metrics.add_bytes(Crawler.feed_tee(response, tee, decoder))
+            return
 
-                if nread:
-                    fd.write(nread)
+        if self.metadata:
+            self.metadata.update(new_localpath, response, complete=False,
+                content_encoding=decoder.encoding if decoder and self.keep_compressed else None)
 
-                else:
-                    if self.verbose:
-                        print('{0} saved'.format(localfile))
+        if request and not tee and not offset and self.segmentable(response, length):
+            self.save_segmented(request, response, new_localpath, length)
+            if self.metadata:
+                self.metadata.set_complete(new_localpath, length, time.time())
 
-                    return
+        else:
+            rate = Rate()
+            clock = time.perf_counter
+            # [body, decompress, parse] seconds, writing is timed by the writer,
+            # the body time includes the limit sleeps
+            spent = [0.0] * 3
+            pending = self.writer.open(new_localpath, url, offset)
+            # a resumed file is only partly seen
+            digest = hashlib.sha256() if (self.dedup or self.metadata) and not offset else None
+            stored = 0
+            total = offset
+            buf = None
+            try:
+                while True:
+                    t0 = clock()
+                    buf = self.writer.buffer()
+                    nread = response.readinto(buf)
+                    chunk = memoryview(buf)[:nread]
+                    t1 = clock()
+                    data = decoder.decompress(chunk) if decoder and (tee or not self.keep_compressed) else chunk
+                    t2 = clock()
+                    if tee and data:
+                        # the buffer is reused once written, the tee gets its own copy
+                        tee(bytes(data))
+                    t3 = clock()
+                    spent[0] += t1 - t0
+                    spent[1] += t2 - t1
+                    spent[2] += t3 - t2
+
+                    total += nread
+                    if pb:
+                        pb(total, humansize(total) + ' @ ' + rate(total) + ' ETA: ' + est_finish(start, total - offset, length - offset))
+                    elif self.verbose:
+                        sys.stdout.write('\r')
+                        sys.stdout.write('{0} bytes read'.format(total))
+
+                    # the buffer stays taken until the decompressed data is written,
+                    # so the writer queue holds at most one chunk per buffer
+                    data = chunk if self.keep_compressed else data
+                    if digest:
+                        digest.update(data)
+                        stored += len(data)
+                    self.writer.write(pending, data, buf)
+                    buf = None
+
+                    if not nread:
+                        break
+                # readinto() returns 0 when the server closes the connection early,
+                # content-length counts the bytes received also for encoded bodies
+                if length and total != length:
+                    raise http.client.IncompleteRead(b'', length - total)
+            except BaseException as e:
+                # the buffers would be lost, after nbuffers failures every download would block.
+                # A body that can't be decoded would fail the same way once resumed
+                keep = self.resume and not isinstance(e, DecodingError)
+                self.writer.abort(pending, buf, keep=keep)
+                if self.metadata and not keep:
+                    self.metadata.forget(new_localpath)
+                raise
+            self.metrics.add_bytes(total - offset)
+            dedup_key = (stored, digest.digest()) if digest and self.dedup else None
+            self.writer.close(pending, functools.partial(self.file_done, pending, stored, digest and digest.hexdigest()), dedup_key)
+
+            if tee:
+                t0 = clock()
+                tee(b'')
+                spent[2] += clock() - t0
+            if self.limited:
+                spent[0] -= response.waited
+                self.instrumentation.record('limit', response.waited, url)
+            self.instrumentation.record('body', spent[0], url)
+            if decoder:
+                self.instrumentation.record('decompress', spent[1], url)
+            if tee:
+                self.instrumentation.record('parse', spent[2], url)
+
+        if self.verbose:
+            print('{0} saved'.format(localfile))
+
+    def limit(self, host, nbytes):
+        """Sleeps as long as the --limit-rate and --host-limit-rate buckets
+        require after reading nbytes from host, returns the seconds slept"""
+        wait = self.bandwidth.take(nbytes) if self.bandwidth else 0.0
+        if self.host_limit_rate:
+            with self.lock:
+                bucket = self.host_bandwidth.get(host)
+                if bucket is None:
+                    bucket = self.host_bandwidth[host] = TokenBucket(self.host_limit_rate, self.limit_burst)
+            wait = max(wait, bucket.take(nbytes))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def limited_reader(self, response, host):
+        """response with its body read through the bandwidth limits of host,
+        when there are any"""
+        if not self.limited:
+            return response
+        return LimitedReader(response, functools.partial(self.limit, host))
+
+    def file_done(self, pending, size, sha256):
+        """Called by the writer once pending is written. sha256 is None for a
+        resumed file, whose size is only known from the file itself."""
+        if pending.linked:
+            self.dedup.linked(size)
+        if self.metadata:
+            if sha256:
+                self.metadata.set_complete(pending.path, size, time.time(), sha256)
+            else:
+                self.metadata.set_complete(pending.path)
+
+    def local_stat(self, path):
+        """(size, mtime) of the local copy of path or None, from the manifest when there is one"""
+        if self.metadata:
+            return self.metadata.stat(path, self.metadata.get(path))
+        return MirrorMetadata.disk_stat(path)
+
+    def same_size(self, path, length):
+        """Whether path, saved without validators to compare, is length bytes long locally"""
+        entry = self.metadata.get(path)
+        if entry is not None:
+            return False
+        local = self.metadata.stat(path, entry)
+        return local is not None and local[0] == length
+
+    def save_warc(self, url, response, tee=None, request=None):
+        """Appends the exchange to the WARC files, with the body as received.
+        The body is spooled first since a record starts with its length."""
+        decoder = ContentDecoder.for_response(response) if tee else None
+        clock = time.perf_counter
+        # [body, decompress and parse] seconds, the body time includes the limit sleeps
+        spent = [0.0] * 2
+        url = response.geturl() if hasattr(response, 'geturl') else url
+        response = self.limited_reader(response, urllib.parse.urlsplit(url).netloc)
+        with tempfile.SpooledTemporaryFile(WarcWriter.SPOOL_SIZE) as spool:
+            digest = hashlib.sha1()
+            total = 0
+            while True:
+                t0 = clock()
+                nread = response.read(WriteBehind.BUFFER_SIZE)
+                digest.update(nread)
+                spool.write(nread)
+                t1 = clock()
+                if tee:
+                    data = decoder.decompress(nread) if decoder else nread
+                    if data:
+                        tee(data)
+                spent[0] += t1 - t0
+                spent[1] += clock() - t1
+                total += len(nread)
+                if not nread:
+                    break
+            if tee:
+                tee(b'')
+            self.metrics.add_bytes(total)
+            if self.limited:
+                spent[0] -= response.waited
+                self.instrumentation.record('limit', response.waited, url)
+            self.instrumentation.record('body', spent[0], url)
+            if tee:
+                self.instrumentation.record('parse', spent[1], url)
+            with self.instrumentation.phase('write', url):
+                # the request of every hop, with the headers sent for its url
+                self.warc.write_redirects(response, request)
+                if request is not None:
+                    request = getattr(response, 'request', request)
+                self.warc.write_exchange(url, request, response, spool, total, digest)
+        if self.verbose:
+            print('{0} archived'.format(url))
 
+    @staticmethod
+    def feed_tee(response, tee, decoder=None):
+        """Reads response to the end only to pass it through tee, returns the
+        number of bytes read"""
+        total = 0
+        while True:
+            nread = response.read(8192)
+            total += len(nread)
+            data = decoder.decompress(nread) if decoder else nread
+            if data:
+                tee(data)
+            if not nread:
+                break
+        tee(b'')
+        return total
+
+    def segmentable(self, response, length):
+        return self.segments > 1 and length and length >= self.segment_min_size\
+            and getattr(response, 'status', None) == http.client.OK\
+            and response.getheader('Accept-Ranges') == 'bytes'\
+            and not response.getheader('Content-Encoding')
+
+    def save_segmented(self, request, response, new_localpath, length):
+        """Downloads the body in self.segments byte ranges over parallel
+        connections into a preallocated file, the first range is read from
+        response itself. If a segment fails the file is truncated to the bytes
+        downloaded contiguously from the start, so --continue can resume it."""
+        validator = response.getheader('ETag') or response.getheader('Last-Modified')
+        seglen = -(-length // self.segments)
+        ranges = [(i, min(length, i + seglen)) for i in range(0, length, seglen)]
+        written = [0] * len(ranges)
+        host = urllib.parse.urlsplit(request.full_url).netloc
+        print('{0}: downloading {1} in {2} segments'.format(new_localpath, humansize(length), len(ranges)))
+
+        def fetch(i, resp):
+            (begin, end) = ranges[i]
+            try:
+                if resp is None:
+                    req = urllib.request.Request(request.full_url, headers=dict(request.header_items()))
+                    req.add_header('Range', 'bytes={0}-{1}'.format(begin, end - 1))
+                    req.add_header('Accept-Encoding', 'identity')
+                    if validator:
+                        req.add_header('If-Range', validator)
+                    resp = self.limited_reader(self.pool.urlopen(req), host)
+                    if resp.status != http.client.PARTIAL_CONTENT \
+                            or not resp.getheader('Content-Range', '').startswith('bytes {0}-'.format(begin)):
+                        raise urllib.error.URLError('{0}: range request for segment {1} not honoured'.format(new_localpath, i))
+                pos = begin
+                while pos < end:
+                    chunk = resp.read(min(65536, end - pos))
+                    if not chunk:
+                        raise http.client.IncompleteRead(b'', end - pos)
+                    os.pwrite(fd, chunk, pos)
+                    pos += len(chunk)
+                    written[i] += len(chunk)
+                    self.metrics.add_bytes(len(chunk))
+                if self.limited:
+                    self.instrumentation.record('limit', resp.waited, request.full_url)
+            finally:
+                if resp:
+                    resp.close()
+
+        # not truncated in place, it could be hardlinked to other copies
+        if self.dedup:
+            self.dedup.forget(new_localpath)
+        try:
+            os.unlink(new_localpath)
+        except FileNotFoundError:
+            pass
+        fd = os.open(new_localpath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(fd, length)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [executor.submit(fetch, i, None) for i in range(1, len(ranges))]
+                fetch(0, response)
+                for f in futures:
+                    f.result()
+        except:
+            prefix = 0
+            for (i, (begin, end)) in enumerate(ranges):
+                prefix += written[i]
+                if begin + written[i] < end:
+                    break
+            os.ftruncate(fd, prefix)
+            raise
+        finally:
+            os.close(fd)
 
+    @staticmethod
+    def get_links(parsed_url, content, link_attrs=None):
+        extractor = LinkExtractor(link_attrs)
+        extractor.feed(content)
+        extractor.close()
+        return Crawler.resolve_links(parsed_url, extractor.links)
 
     @staticmethod
-    def get_links(parsed_url, content):
+    def resolve_links(parsed_url, links):
         res = []
         pathdir = os.path.split(parsed_url.path)[0]
-        links = Crawler.linkregex.findall(content)
-        soup = BeautifulSoup(content, features="html.parser")
-        iframes = soup.find_all('iframe')
-        for x in iframes:
-            links.append(x.attrs['src'])
         for link in links:
             if link.startswith('/'):
                 link = parsed_url.scheme + '://' + parsed_url.netloc + link
@@ -538,49 +3061,133 @@ class Crawler(object):
                 res.append(link)
             elif link.startswith('http://'):
                 res.append(link)
-            elif not re.match('^\w+://', link):
+            elif not re.match(r'^\w+://', link):
                 link = parsed_url.scheme + '://' + parsed_url.netloc + os.path.join(pathdir,link)
                 res.append(link)
             else:
                 pass
         return res
 
-    def recurse_links(self, links):
-        """Put links which are not crawled and match the url regexp in the to-crawl queue"""
+    def feed(self):
+        """Adds the next batch of --input-file urls when the frontier runs low, so
+        a long list is never read whole"""
+        while self.inputs and len(self.frontier) < Crawler.INPUT_BATCH:
+            n = 0
+            for url in itertools.islice(self.inputs[0], Crawler.INPUT_BATCH):
+                n += 1
+                self.seed_urls_netloc.add(urllib.parse.urlsplit(url).netloc)
+                if self.owns(url):
+                    self.frontier.add(url)
+            if n < Crawler.INPUT_BATCH:
+                self.inputs.pop(0)
+
+    def sitemap_urls(self, seed):
+        """The urls listed in the sitemaps of the host of seed: the ones its
+        robots.txt names, or /sitemap.xml. Sitemap indexes are followed and
+        gzipped sitemaps decompressed while they are parsed, nothing is read
+        before the frontier needs more urls. With --mirror the urls whose
+        lastmod is older than their local copy are skipped."""
+        parsed = urllib.parse.urlsplit(seed)
+        root = '{0}://{1}/'.format(parsed.scheme, parsed.netloc)
+        sitemaps = collections.deque(self.robots.get(root).site_maps() or [root + 'sitemap.xml'])
+        fetched = set()
+        while sitemaps:
+            sitemap = sitemaps.popleft()
+            if sitemap in fetched:
+                continue
+            fetched.add(sitemap)
+            try:
+                response = self.pool.urlopen(urllib.request.Request(sitemap))
+            except (OSError, http.client.HTTPException) as e:
+                logging.warning('sitemap {0} unavailable: {1}'.format(sitemap, e))
+                continue
+            f = self.limited_reader(response, parsed.netloc)
+            if urllib.parse.urlsplit(sitemap).path.endswith('.gz') or 'gzip' in response.getheader('Content-Type', ''):
+                f = gzip.GzipFile(fileobj=f)
+            try:
+                for (kind, loc, lastmod) in parse_sitemap(f):
+                    if kind == 'sitemap':
+                        sitemaps.append(loc)
+                        continue
+                    url = normalize(loc)
+                    if self.urlre and not self.mirror and not self.urlre.match(url):
+                        continue
+                    with self.lock:
+                        self.stats['sitemap urls'].count += 1
+                    if self.unchanged(url, lastmod):
+                        if self.owns(url):
+                            self.frontier.skip(url)
+                        continue
+                    yield url
+            except (xml.etree.ElementTree.ParseError, OSError, EOFError, http.client.HTTPException) as e:
+                logging.warning('failed reading sitemap {0}: {1}'.format(sitemap, e))
+            finally:
+                response.close()
+
+    def unchanged(self, url, lastmod):
+        """Whether the local copy of url was saved after its sitemap lastmod"""
+        if not self.mirror or self.warc or not lastmod:
+            return False
+        modified = parse_lastmod(lastmod)
+        if modified is None:
+            return False
+        local = self.local_stat(Crawler.local_filename(urllib.parse.urlparse(url)))
+        if local is None or local[1] < modified:
+            return False
+        with self.lock:
+            self.stats['unchanged'].count += 1
+        return True
+
+    def recurse_links(self, links, depth=1):
+        """Put links which are not crawled and match the url regexp in the to-crawl queue,
+        depth is the number of links followed from a seed url to get to them"""
+        if not self.recurse:
+            return
+        if self.level is not None and depth > self.level:
+            if self.verbose:
+                print('Not recursing links deeper than level {0}'.format(self.level))
+            return
         for link in links:
             #print(link)
-            if link not in self.crawled:
+            if link not in self.frontier:
                 #if self.verbose:
                 #    print('Check {0}'.format(link))
                 if self.urlre and self.urlre.match(link):
                     print('Recursing link {0}'.format(link))
-                    self.tocrawl.add(link)
+                    self.enqueue(link, depth)
                 elif self.mirror:
                     parsed_url = urllib.parse.urlparse(link)
                     if parsed_url.netloc in self.seed_urls_netloc:
                         print('Recursing link {0}'.format(link))
-                        self.tocrawl.add(link)
+                        self.enqueue(link, depth)
                 else:
                     if self.verbose:
                         print('Not recursing link {0}'.format(link))
 
 
+    def owns(self, url):
+        """Whether url is crawled by this process"""
+        return not self.shard or shard_of(url, self.shard[1]) == self.shard[0]
+
+    def enqueue(self, link, depth):
+        if self.owns(link):
+            self.frontier.add(link, depth)
+        elif link not in self.forwarded:
+            self.forwarded.add(link)
+            self.outbox.append((link, depth))
+
     def add_cookies(self, url_opener, parsed_url, host_cookies):
         if not host_cookies:
             return
 
         assert(isinstance(parsed_url, urllib.parse.ParseResult))
-        url_host = without_port(parsed_url.netloc)
-
         # FIXME so far ignoring the port on the cookie file
-        for (host, cookies) in host_cookies.items():
-            host = without_port(host)
-            #print('url_host', url_host)
-            if url_host == host or url_host.endswith(remove_first_dot(host)):
-                for (k, v) in cookies.items():
-                    if self.verbose:
-                        print('Using cookie "{0}: {1}" for host {2}'.format(k, v, url_host))
-                    url_opener.add_header('Cookie', '{0}={1}'.format(k,v))
+        url_host = parsed_url.hostname or ''
+        cookie = host_cookies.cookie_header(url_host, parsed_url.path or '/', parsed_url.scheme == 'https')
+        if cookie:
+            if self.verbose:
+                print('Using cookies "{0}" for host {1}'.format(cookie, url_host))
+            url_opener.add_header('Cookie', cookie)
 
     def print_stats(self):
         def rp(x):
@@ -596,78 +3203,610 @@ class Crawler(object):
                 ret.append(str(x))
             return ''.join(ret)
 
+        if 'not modified' in self.stats.keys():
+            print('Not modified: {0}'.format(self.stats['not modified'].count))
+        print('Connections: {0} reused, {1} opened, {2} retried after the server closed them'.format(
+            self.pool.hits, self.pool.misses, self.pool.retries))
+        if self.dedup and self.dedup.duplicates:
+            print('Duplicates: {0} bodies already saved under another url, {1} saved'.format(
+                self.dedup.duplicates, humansize(self.dedup.saved)))
+        if 'retries' in self.stats.keys():
+            print('Retries: {0}'.format(self.stats['retries'].count))
+        if 'sitemap urls' in self.stats.keys():
+            print('Sitemaps: {0} urls listed, {1} unchanged since the last mirror'.format(
+                self.stats['sitemap urls'].count, self.stats['unchanged'].count if 'unchanged' in self.stats else 0))
+        if self.bandwidth:
+            print('Bandwidth: limited to {0}/s, {1} read at {2}, {3:.1f}s spent waiting'.format(
+                humansize(self.bandwidth.rate), humansize(self.bandwidth.total), self.bandwidth.effective(), self.bandwidth.waited))
+        if self.throttle.backoffs:
+            print('Rate control: backed off {0} times, hosts still slowed down: {1}'.format(self.throttle.backoffs,
+                ', '.join('{0} ({1:.2f}s)'.format(h, d) for (h, d) in sorted(self.throttle.slowed_down().items())) or 'none'))
+
+        if self.instrumentation.histograms:
+            print('Request phases:')
+            print(self.instrumentation.report())
+
         if 'errors' in self.stats.keys():
             print('Errors: ')
             for (k,v) in self.stats['errors'].items():
                 print(k, rp(v))
 
 
-    def __call__(self):
-        while True:
-            try:
-                if self.time:
-                    time.sleep(self.time)
-                current_url = self.tocrawl.pop()
+    def summary(self):
+        """The counters print_stats shows, as plain data for merge()"""
+        return {
+            'errors': dict((code, (node.count, node.get('urls'))) for (code, node) in self.stats['errors'].items())
+                if 'errors' in self.stats else {},
+            'counts': dict((k, self.stats[k].count) for k in ('not modified', 'retries', 'sitemap urls', 'unchanged') if k in self.stats),
+            'histograms': dict(self.instrumentation.histograms),
+            'cpu': dict(self.instrumentation.cpu),
+            'pool': (self.pool.hits, self.pool.misses, self.pool.retries),
+            'backoffs': self.throttle.backoffs,
+            'slowed': self.throttle.slowed_down(),
+            'dedup': (self.dedup.duplicates, self.dedup.saved) if self.dedup else (0, 0),
+        }
+
+    def merge(self, summary):
+        """Adds the summary() of another crawler to the stats of this one"""
+        with self.lock:
+            for (code, (count, urls)) in summary['errors'].items():
+                node = self.stats['errors'][code]
+                node.count += count
+                if urls is not None:
+                    if 'urls' not in node:
+                        node['urls'] = Reservoir(Crawler.ERROR_SAMPLE_SIZE)
+                    node['urls'].merge(urls)
+            for (k, count) in summary['counts'].items():
+                self.stats[k].count += count
+        for (phase, histogram) in summary['histograms'].items():
+            self.instrumentation.histograms[phase].merge(histogram)
+        self.instrumentation.cpu.update(summary['cpu'])
+        (hits, misses, retries) = summary['pool']
+        self.pool.hits += hits
+        self.pool.misses += misses
+        self.pool.retries += retries
+        self.throttle.backoffs += summary['backoffs']
+        for (host, delay) in summary['slowed'].items():
+            self.throttle.host(host).delay = delay
+        if self.dedup:
+            self.dedup.duplicates += summary['dedup'][0]
+            self.dedup.saved += summary['dedup'][1]
+
+    def record_error(self, url, code):
+        with self.lock:
+            errors = self.stats['errors'][code]
+            errors.count += 1
+            # long crawls can fail on millions of urls, keep a sample of them
+            if 'urls' not in errors:
+                errors['urls'] = Reservoir(Crawler.ERROR_SAMPLE_SIZE)
+            errors['urls'].add(url)
+
+    def process(self, current_url):
+        """Download current_url, save it locally and return the normalized links found in it"""
+        self.metrics.request_started()
+        start = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            return self.download(current_url)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            # ValueError: a link with an invalid port or a body that can't be decoded
+            code = Crawler.error_code(e)
+            if not Crawler.is_transient(e):
+                logging.error('{0} failed: {1}'.format(current_url, e))
+                self.record_error(current_url, code)
+                return []
+            logging.warning('{0} failed: {1}'.format(current_url, e))
+            raise TransientError(code)
+        finally:
+            self.instrumentation.record_cpu('request', time.thread_time() - cpu)
+            self.instrumentation.record('request', time.perf_counter() - start, current_url)
+            self.metrics.request_finished()
 
-            except KeyError:
-                print('All finished.\n')
-                self.print_stats()
-                break
+    @staticmethod
+    def is_transient(e):
+        """Whether the exception e raised while fetching may not happen again:
+        the TRANSIENT_CODES statuses, timeouts and dropped connections. Invalid
+        urls, bad certificates and local filesystem errors are permanent."""
+        if isinstance(e, urllib.error.HTTPError):
+            return e.code in Crawler.TRANSIENT_CODES
+        if isinstance(e, urllib.error.URLError):
+            e = e.reason
+        if isinstance(e, socket.gaierror):
+            return e.errno == socket.EAI_AGAIN
+        return isinstance(e, (TimeoutError, ConnectionError, ssl.SSLEOFError, http.client.IncompleteRead))
 
-            parsed_url = urllib.parse.urlparse(current_url)
+    @staticmethod
+    def error_code(e):
+        """How the exception e is counted in the error stats"""
+        if isinstance(e, urllib.error.HTTPError):
+            return e.code
+        if isinstance(e, urllib.error.URLError) and isinstance(e.reason, OSError):
+            e = e.reason
+        return type(e).__name__
+
+    def retry_later(self, url, depth, error, delayed):
+        """Puts url back in delayed after a jittered exponential backoff, or
+        records its failure once it has been tried self.tries times"""
+        attempts = self.attempts.get(url, 0) + 1
+        if attempts >= self.tries:
+            self.attempts.pop(url, None)
+            logging.error('giving up on {0} after {1} tries'.format(url, attempts))
+            self.record_error(url, error.code)
+            self.frontier.done(url)
+            return
+        self.attempts[url] = attempts
+        backoff = min(Crawler.MAX_RETRY_BACKOFF, self.retry_backoff * 2 ** (attempts - 1))
+        # the jitter keeps urls failing together from being retried together
+        backoff = max(random.uniform(backoff / 2, backoff), error.retry_after or 0)
+        print('{0}: retrying in {1:.1f}s ({2})'.format(url, backoff, error.code))
+        with self.lock:
+            self.stats['retries'].count += 1
+        delayed.push((url, depth), time.monotonic() + backoff)
+
+    def process_profiled(self, current_url):
+        """process() under the profiler of the current worker thread"""
+        profiler = getattr(self.thread_profiler, 'profiler', None)
+        if profiler is None:
+            profiler = self.thread_profiler.profiler = cProfile.Profile()
+            with self.lock:
+                self.profilers.append(profiler)
+        profiler.enable()
+        try:
+            return self.process(current_url)
+        finally:
+            profiler.disable()
+
+    def download(self, current_url):
+        parsed_url = urllib.parse.urlparse(current_url)
+        try:
+            print()
+            print('GET {0}'.format(current_url))
+            request = urllib.request.Request(url = current_url)
+            request.add_header('Accept-Encoding', ContentDecoder.ACCEPT_ENCODING)
+            self.add_cookies(request, parsed_url, self.host_cookies)
+            stored = None
+            resume_from = None
+            if self.metadata:
+                stored = self.metadata.add_conditions(request, Crawler.local_filename(parsed_url))
+                # without an entry the file could be a page, whose links are only
+                # found in its whole body
+                if self.resume and (stored or not (self.recurse and (self.mirror or self.urlre))):
+                    resume_from = self.metadata.add_range(request, Crawler.local_filename(parsed_url), stored)
+            start = time.perf_counter()
+            response = self.pool.urlopen(request)
+            self.throttle.feedback(parsed_url.netloc, response.status, time.perf_counter() - start)
+            self.metrics.response(response.status)
+            length = response.getheader('content-length')
+            print('-> ', response.getcode(), response.getheader('Content-Type'), humansize(length))
+            print()
+
+        except urllib.error.HTTPError as e:
+            self.throttle.feedback(parsed_url.netloc, e.code, time.perf_counter() - start,
+                e.headers.get('Retry-After') if e.headers else None)
+            self.metrics.response(e.code)
+            if e.code == http.client.REQUESTED_RANGE_NOT_SATISFIABLE and resume_from is not None:
+                print('{0}: file already fully retrieved'.format(Crawler.local_filename(parsed_url)))
+                self.metadata.set_complete(Crawler.local_filename(parsed_url))
+                return []
+            if Crawler.is_transient(e):
+                logging.warning('urlopen failed: {0}, {1}'.format(current_url, e))
+                retry_after = e.headers.get('Retry-After') if e.headers else None
+                raise TransientError(e.code, retry_after and HostThrottle.parse_retry_after(retry_after))
+            logging.error('urlopen failed: {0}, {1}'.format(current_url, e))
+            self.record_error(current_url, e.code)
+            return []
+
+        content_type = response.getheader('Content-Type', '')
+        links = []
+
+        not_modified = response.status == http.client.NOT_MODIFIED
+        if not_modified:
+            response.close()
+            localpath = Crawler.local_filename(parsed_url)
+            # the links of an unchanged page are taken from the local copy
+            content_type = (stored and stored[2]) or ''
+            recurse = self.recurse and re.match('^text/html', content_type)
             try:
-                print()
-                print('GET {0}'.format(current_url))
-                request = urllib.request.Request(url = current_url)
-                self.add_cookies(request, parsed_url, self.host_cookies)
-                response = urllib.request.urlopen(request)
-                length = response.getheader('content-length')
-                print('-> ', response.getcode(), response.getheader('Content-Type'), humansize(length))
-                print()
-
-            except KeyboardInterrupt:
-                  self.print_stats()
-                  raise
-            except urllib.error.HTTPError as e:
-                logging.error('urlopen failed: {0}, {1}'.format(current_url, e))
-                self.stats['errors'][e.code].count += 1
-                urls = self.stats['errors'][e.code].get('urls', list())
-                urls.append(current_url)
-                self.stats['errors'][e.code]['urls'] = urls
-                continue
+                if recurse:
+                    response = io.open(localpath, 'rb')
+                else:
+                    os.stat(localpath)
+            except FileNotFoundError:
+                if stored is None:
+                    raise
+                # deleted from the mirror since its entry was stored
+                logging.warning('{0}: not modified but missing, downloading it again'.format(localpath))
+                self.metadata.forget(localpath)
+                return self.download(current_url)
+            print('{0}: not modified'.format(current_url))
+            with self.lock:
+                self.stats['not modified'].count += 1
+            if not recurse:
+                return links
+
+        # If the content is HTML we get the links while saving it and recurse
+        if self.recurse and re.match('^text/html', content_type):
+
+            # taking care of encoding
+            encoding = 'utf-8'
+            m = re.search(r'charset=([\w-]+)', content_type)
+            if m:
+                encoding = m.group(1)
+
+            tee = LinkTee(current_url, encoding, self.link_attrs)
+            parse = self.instrumentation.cpu_timed('parse', tee)
+            if not_modified:
+                stored_encoding = stored and stored[4]
+                Crawler.feed_tee(response, parse, ContentDecoder(stored_encoding) if stored_encoding else None)
+            else:
+                with self.instrumentation.phase('save', current_url):
+                    self.save_local(current_url, response, parsed_url, parse, request, resume_from)
+            with self.instrumentation.phase('normalize', current_url):
+                links = normalize_links(Crawler.resolve_links(parsed_url, dict.fromkeys(tee.links())))
 
-            headers = dict(response.getheaders())
+        else:
+            with self.instrumentation.phase('save', current_url):
+                self.save_local(current_url, response, parsed_url, request=request, resume_from=resume_from)
+
+        # returns the connection to the pool, or drops it if save_local didn't read the body
+        response.close()
+        return links
+
+    def __call__(self, crawl=None):
+        """Runs crawl, self.crawl by default, under the profiler with --profile"""
+        crawl = crawl or self.crawl
+        if not self.profile:
+            return crawl()
+
+        profiler = cProfile.Profile()
+        self.profilers.append(profiler)
+        profiler.enable()
+        try:
+            return crawl()
+        finally:
+            profiler.disable()
+            self.dump_profile()
+
+    def dump_profile(self):
+        """Merges the profiles of the main and worker threads into self.profile
+        and prints the functions taking the most cumulative time"""
+        stats = None
+        for profiler in self.profilers:
+            profiler.create_stats()
+            if not profiler.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+        if stats is None:
+            return
+        stats.dump_stats(self.profile)
+        print('Profile written to {0}, top functions by cumulative time:'.format(self.profile))
+        stats.sort_stats('cumulative').print_stats(15)
 
-            # If the content is HTML we get the links and recurse
-            if re.match('^text/html', headers['Content-Type']):
+    def crawl(self):
+        try:
+            self.run()
+        except KeyboardInterrupt:
+            self.print_stats()
+            self.close()
+            raise
+        self.finish()
+
+    def run(self):
+        """Crawls until the frontier is empty. Nothing is closed, so it can run
+        again once more urls are added."""
+        if self.concurrency > 1:
+            asyncio.run(self.crawl_async())
+            return
 
-                # taking care of encoding
-                encoding = 'utf-8'
-                m = re.match('charset=(\w+)', headers['Content-Type'])
-                if m:
-                    encoding = m.group(0)
+        delayed = DelayQueue()
+        while True:
+            try:
+                (current_url, depth) = self.next_url(delayed)
 
-                content = response.read()
-                self.crawled.add(current_url)
-                try:
-                    ###########
-                    self.recurse_links(normalize(link) for link in Crawler.get_links(parsed_url, content.decode(encoding)))
-                    ###########
+            except KeyError:
+                return
 
-                except UnicodeDecodeError as e:
-                    logging.error('Failed decoding "{0}" with charset "{1}": {2}'.format(current_url, encoding, str(e)))
-                    pass
+            try:
+                links = self.process(current_url)
+            except TransientError as e:
+                self.retry_later(current_url, depth, e, delayed)
+                continue
 
-                self.save_local(current_url, io.BytesIO(content), parsed_url)
+            self.attempts.pop(current_url, None)
+            self.frontier.done(current_url)
+            with self.instrumentation.phase('recurse', current_url):
+                self.recurse_links(links, depth + 1)
+            if self.exchange:
+                self.exchange()
+
+    def next_url(self, delayed):
+        """Pops the next (url, depth) whose host can be requested now. The urls
+        of hosts cooling down wait in delayed while other hosts are crawled, it
+        only sleeps when no host is ready. Raises KeyError at the end."""
+        max_delayed = 64 * self.host_concurrency
+        while True:
+            self.feed()
+            now = time.monotonic()
+            item = delayed.pop_ready(now)
+            if item is None and len(self.frontier) and len(delayed) < max_delayed:
+                item = self.frontier.pop()
+            if item is None:
+                if not delayed:
+                    raise KeyError('crawl finished')
+                time.sleep(max(0, delayed.next_time() - now))
+                continue
+            host = urllib.parse.urlparse(item[0]).netloc
+            wait = self.throttle.wait_time(host, now)
+            if wait <= 0:
+                self.throttle.started(host, now)
+                return item
+            delayed.push(item, now + wait)
+
+    def finish(self):
+        print('All finished.\n')
+        self.print_stats()
+        self.close()
+
+    def close(self):
+        for urls in self.inputs:
+            if hasattr(urls, 'close'):
+                urls.close()
+        if self.input_file and self.input_file is not sys.stdin:
+            self.input_file.close()
+        self.writer.shutdown()
+        if self.warc:
+            self.warc.close()
+        if self.exporter:
+            self.exporter.close()
+        self.pool.close()
+        self.frontier.close()
+        if self.metadata:
+            self.metadata.close()
+
+    async def crawl_async(self):
+        """Keeps up to self.concurrency downloads in flight, at most
+        self.host_concurrency of them against the same host.
+
+        Downloads run in a thread pool since urllib is blocking, everything
+        touching the frontier runs in the event loop thread."""
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        inflight = set()
+        host_inflight = collections.Counter()
+        # urls popped from the frontier whose host is already at its cap
+        parked = collections.defaultdict(collections.deque)
+        nparked = 0
+        max_parked = 64 * self.concurrency
+        # urls waiting to be retried after a transient failure
+        retries = DelayQueue()
+
+        # the profiler of the main thread doesn't see the worker threads before
+        # python 3.12, where cProfile starts to profile all threads at once
+        process = self.process_profiled if self.profile and sys.version_info < (3, 12) else self.process
+
+        def start(url, depth, host):
+            host_inflight[host] += 1
+            self.throttle.started(host)
+            task = loop.run_in_executor(executor, process, url)
+            task.url, task.depth, task.host = url, depth, host
+            inflight.add(task)
+
+        def ready(host):
+            return host_inflight[host] < self.host_concurrency and self.throttle.wait_time(host) <= 0
 
-            else:
-                self.crawled.add(current_url)
-                self.save_local(current_url, response, parsed_url)
+        try:
+            while True:
+                item = retries.pop_ready(time.monotonic())
+                while item is not None:
+                    parked[urllib.parse.urlparse(item[0]).netloc].append(item)
+                    nparked += 1
+                    item = retries.pop_ready(time.monotonic())
+
+                # first the parked urls whose host has a free slot and isn't cooling down
+                for host in list(parked.keys()):
+                    while parked[host] and len(inflight) < self.concurrency and ready(host):
+                        start(*parked[host].popleft(), host)
+                        nparked -= 1
+                    if not parked[host]:
+                        del parked[host]
+
+                self.feed()
+                while len(self.frontier) and len(inflight) < self.concurrency and nparked < max_parked:
+                    (url, depth) = self.frontier.pop()
+                    host = urllib.parse.urlparse(url).netloc
+                    if host not in parked and ready(host):
+                        start(url, depth, host)
+                    else:
+                        parked[host].append((url, depth))
+                        nparked += 1
+
+                # wake up when the first parked host with a free slot is ready again
+                waits = [self.throttle.wait_time(host) for host in parked
+                         if host_inflight[host] < self.host_concurrency]
+                if retries:
+                    waits.append(max(0, retries.next_time() - time.monotonic()))
+                timeout = min(waits) if waits and len(inflight) < self.concurrency else None
+
+                if not inflight:
+                    if not parked and not retries:
+                        break
+                    await asyncio.sleep(timeout or 0)
+                    continue
+
+                done, _ = await asyncio.wait(inflight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    inflight.discard(task)
+                    host_inflight[task.host] -= 1
+                    try:
+                        links = task.result()
+                    except TransientError as e:
+                        self.retry_later(task.url, task.depth, e, retries)
+                        continue
+                    self.attempts.pop(task.url, None)
+                    self.frontier.done(task.url)
+                    with self.instrumentation.phase('recurse', task.url):
+                        self.recurse_links(links, task.depth + 1)
+                if self.exchange:
+                    self.exchange()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def shard_options(options, index, count):
+    """The options of the worker of shard index out of count, every file a
+    crawl writes but the metadata of the mirror gets one per worker and the
+    bandwidth is split between them"""
+    options = dict(options)
+    if options.get('limit_rate'):
+        options['limit_rate'] /= count
+    suffix = '-{0}'.format(index)
+    if options.get('state_dir'):
+        options['state_dir'] = os.path.join(options['state_dir'], 'shard' + suffix)
+    if options.get('warc'):
+        options['warc'] = with_suffix(options['warc'], suffix)
+    if options.get('profile'):
+        options['profile'] = with_suffix(options['profile'], suffix)
+    if options.get('metrics'):
+        m = re.match(r'^([\w.-]*):(\d+)$', options['metrics'])
+        if m:
+            options['metrics'] = '{0}:{1}'.format(m.group(1), int(m.group(2)) + index)
+        else:
+            options['metrics'] = with_suffix(options['metrics'], suffix)
+    return options
+
+def crawl_shard(conn, shard, urls, options):
+    """Worker process of --workers: crawls the hosts of shard, sending the links
+    to other hosts to the coordinator on conn and receiving theirs.
+
+    Messages sent: ('links', [(url, depth)]), ('idle', batches received so far)
+    once the frontier is empty, and ('summary', Crawler.summary()) on ('stop',).
+    Messages received: ('urls', [(url, depth)]) and ('stop',)."""
+    crawler = Crawler(urls, shard=shard, **options)
+    received = 0
+
+    def receive(message):
+        nonlocal received
+        received += 1
+        for (url, depth) in message[1]:
+            if url not in crawler.frontier:
+                crawler.frontier.add(url, depth)
+
+    def exchange():
+        while conn.poll():
+            receive(conn.recv())
+        if crawler.outbox:
+            conn.send(('links', crawler.outbox))
+            crawler.outbox = []
+
+    def crawl():
+        try:
+            while True:
+                crawler.run()
+                exchange()
+                if len(crawler.frontier):
+                    continue
+                conn.send(('idle', received))
+                message = conn.recv()
+                if message[0] == 'stop':
+                    return
+                receive(message)
+        finally:
+            crawler.close()
+
+    crawler.exchange = exchange
+    crawler(crawl)
+    conn.send(('summary', crawler.summary()))
+    conn.close()
+
+def crawl_sharded(urls, workers, options):
+    """Crawls with a process per shard of the hosts, routing the links found
+    by each worker to the one owning their host. The crawl is over when every
+    worker is idle with all the urls sent to it received. Returns a Crawler
+    with the merged stats of the workers."""
+    if Crawler.uses_metadata(options):
+        # created before the workers share it, so they see it as it was
+        metadata = MirrorMetadata()
+        options = dict(options, metadata_authoritative=metadata.authoritative)
+        metadata.close()
+    conns = []
+    processes = []
+    for i in range(workers):
+        (conn, child) = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=crawl_shard, name='pwget-shard-{0}'.format(i),
+            args=(child, (i, workers), urls, shard_options(options, i, workers)))
+        p.start()
+        child.close()
+        conns.append(conn)
+        processes.append(p)
+
+    # a thread per worker sends to it, so the coordinator never blocks on a
+    # full pipe while that worker is blocked sending to the coordinator
+    outboxes = [queue.Queue() for _ in range(workers)]
+    def sender(conn, outbox):
+        for message in iter(outbox.get, None):
+            try:
+                conn.send(message)
+            except OSError:
+                pass
+    senders = [threading.Thread(target=sender, args=(conns[i], outboxes[i]), daemon=True) for i in range(workers)]
+    for t in senders:
+        t.start()
+
+    report = Crawler([], dedup=options.get('dedup'))
+    sent = [0] * workers
+    idle = [False] * workers
+    alive = [True] * workers
+    try:
+        while not all(idle):
+            for conn in multiprocessing.connection.wait([c for (c, a) in zip(conns, alive) if a]):
+                i = conns.index(conn)
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    logging.error('worker %d exited, the urls of its hosts are lost', i)
+                    alive[i] = False
+                    idle[i] = True
+                    continue
+                if message[0] == 'links':
+                    batches = collections.defaultdict(list)
+                    for (url, depth) in message[1]:
+                        batches[shard_of(url, workers)].append((url, depth))
+                    for (j, batch) in batches.items():
+                        if alive[j]:
+                            outboxes[j].put(('urls', batch))
+                            sent[j] += 1
+                            idle[j] = False
+                elif message[0] == 'idle':
+                    idle[i] = message[1] == sent[i]
+
+        for i in range(workers):
+            if alive[i]:
+                outboxes[i].put(('stop',))
+        for i in range(workers):
+            if alive[i]:
+                try:
+                    report.merge(conns[i].recv()[1])
+                except EOFError:
+                    logging.error('worker %d exited before sending its stats', i)
+    finally:
+        for outbox in outboxes:
+            outbox.put(None)
+        for p in processes:
+            p.join()
+    report.finish()
+    return report
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "vhr:c:omt:",
-            ['help', 'regex=', 'cookiefile=', 'verbose', 'overwrite', 'mirror', 'time'])
+        opts, args = getopt.getopt(sys.argv[1:], "vhr:c:omt:j:l:i:",
+            ['help', 'regex=', 'cookiefile=', 'verbose', 'overwrite', 'mirror', 'time=', 'min-delay=',
+             'jobs=', 'host-jobs=', 'pool-size=', 'state-dir=', 'follow-tags=',
+             'continue', 'segments=', 'segment-min-size=', 'keep-compressed', 'seen-set=',
+             'level=', 'order=', 'profile=', 'metrics=', 'metrics-interval=', 'tries=', 'fsync=',
+             'warc=', 'warc-max-size=', 'dedup', 'workers=', 'input-file=', 'no-recurse', 'sitemaps',
+             'limit-rate=', 'host-limit-rate=', 'limit-burst='])
     except getopt.GetoptError as err:
         print(err)
         usage()
@@ -693,6 +3832,94 @@ def main():
         elif o in ('-t', '--time'):
             options['time'] = float(a)
 
+        elif o == '--min-delay':
+            options['min_delay'] = float(a)
+
+        elif o == '--tries':
+            options['tries'] = int(a)
+
+        elif o == '--fsync':
+            options['fsync_batch'] = int(a)
+
+        elif o == '--warc':
+            options['warc'] = a
+
+        elif o == '--warc-max-size':
+            options['warc_max_size'] = int(a)
+
+        elif o == '--dedup':
+            options['dedup'] = True
+
+        elif o == '--workers':
+            options['workers'] = int(a)
+
+        elif o in ('-i', '--input-file'):
+            options['input_file'] = a
+
+        elif o == '--no-recurse':
+            options['no_recurse'] = True
+
+        elif o == '--sitemaps':
+            options['sitemaps'] = True
+
+        elif o == '--limit-rate':
+            options['limit_rate'] = parse_size(a)
+
+        elif o == '--host-limit-rate':
+            options['host_limit_rate'] = parse_size(a)
+
+        elif o == '--limit-burst':
+            options['limit_burst'] = parse_size(a)
+
+        elif o in ('-j', '--jobs'):
+            options['concurrency'] = int(a)
+
+        elif o == '--host-jobs':
+            options['host_concurrency'] = int(a)
+
+        elif o == '--pool-size':
+            options['pool_size'] = int(a)
+
+        elif o == '--state-dir':
+            options['state_dir'] = a
+
+        elif o == '--follow-tags':
+            options['link_attrs'] = parse_link_attrs(a)
+
+        elif o == '--continue':
+            options['resume'] = True
+
+        elif o == '--segments':
+            options['segments'] = int(a)
+
+        elif o == '--segment-min-size':
+            options['segment_min_size'] = int(a)
+
+        elif o == '--keep-compressed':
+            options['keep_compressed'] = True
+
+        elif o == '--seen-set':
+            options['seen_set'] = a
+
+        elif o in ('-l', '--level'):
+            options['level'] = int(a)
+
+        elif o == '--order':
+            if a not in SCHEDULERS:
+                print('unknown crawl order: {0}'.format(a))
+                usage()
+                return(1)
+            options['scheduler'] = SCHEDULERS[a]()
+
+        elif o == '--profile':
+            options['profile'] = a
+
+        elif o == '--metrics':
+            options['metrics'] = a
+
+        elif o == '--metrics-interval':
+            options['metrics_interval'] = float(a)
+
         elif o in ("-h", "--help"):
             usage()
             return(1)
@@ -700,12 +3927,19 @@ def main():
         else:
             assert False, "unhandled option"
 
-    if not len(args):
+    if not len(args) and not options.get('input_file'):
         usage()
         return(1)
 
-    crawler = Crawler(args, **options)
-    crawler()
+    workers = options.pop('workers', 1)
+    if workers > 1 and options.get('input_file') == '-':
+        print('--workers needs an --input-file every worker can read, not stdin')
+        return(1)
+    if workers > 1:
+        crawler = crawl_sharded(args, workers, options)
+    else:
+        crawler = Crawler(args, **options)
+        crawler()
     if 'errors' in crawler.stats.keys():
         return 1
     else:
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2019, Pedro Larroy Tovar
+"""Benchmarks for pwget, run with: ./pwget_bench.py [benchmark ...]
+
+Micro benchmarks of hot paths, and 'site' which crawls a synthetic site
+served from a local http.server process and can write its results as JSON
+to compare across versions."""
+
+__author__ = 'Pedro Larroy'
+
+import sys
+import re
+import time
+import getopt
+import random
+import urllib.parse
+import tracemalloc
+import os
+import io
+import json
+import shutil
+import hashlib
+import resource
+import tempfile
+import datetime
+import contextlib
+import http.server
+import multiprocessing
+
+import pwget
+
+
+def usage():
+    print('Runs pwget benchmarks:\n')
+    print('{0} [-n repeat] [benchmark] ...'.format(sys.argv[0]))
+    print()
+    print('Benchmarks: {0}'.format(', '.join(sorted(BENCHMARKS))))
+    print()
+    print('''Options:
+    -h --help:          this help
+    -n --repeat:        times to repeat each measurement, the best one is reported (default 5)
+    -o --output:        write the results of the site benchmark to this JSON file
+    -c --compare:       compare the results of the site benchmark with a previous JSON file
+
+Synthetic site options:
+    --fanout:           links to child pages per page (default 5)
+    --depth:            levels of pages below the root page (default 3)
+    --page-size:        bytes of html per page (default 16384)
+    --binaries:         binary files linked from each page (default 1)
+    --binary-size:      bytes per binary file (default 262144)
+    --delay:            seconds the server waits before each response (default 0)
+    --error-rate:       fraction of urls answered with a 500 error (default 0)
+    --jobs:             parallel downloads of the crawler (default 1)
+    ''')
+
+
+def best_of(repeat, f, *args):
+    '''Runs f(*args) repeat times and returns the fastest wall time in seconds'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def synthetic_html(nlinks, seed=0):
+    '''A page with nlinks anchors, some iframes and filler text between them'''
+    rnd = random.Random(seed)
+    parts = ['<!DOCTYPE html><html><head><title>bench</title>',
+        '<link rel="stylesheet" href="/style.css"><script src="/app.js"></script></head><body>']
+    for i in range(nlinks):
+        parts.append('<div class="item"><p>{0}</p>'.format(' '.join('lorem' for _ in range(rnd.randint(5, 40)))))
+        parts.append('<a class="link" href="/section/{0}/page{1}.html?ref={2}">link {1}</a></div>\n'.format(i % 17, i, rnd.randint(0, 9)))
+        if i % 50 == 0:
+            parts.append('<iframe width="10" src="frames/{0}.html"></iframe>'.format(i))
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+legacy_linkregex = re.compile('<a\\s(?:.*?\\s)*?href=[\'"](.*?)[\'"].*?>', re.IGNORECASE)
+
+def legacy_get_links(parsed_url, content):
+    '''get_links as it was before LinkExtractor: regex for anchors plus a full
+    BeautifulSoup parse for iframes'''
+    from bs4 import BeautifulSoup
+    links = legacy_linkregex.findall(content)
+    soup = BeautifulSoup(content, features="html.parser")
+    for x in soup.find_all('iframe'):
+        links.append(x.attrs['src'])
+    return pwget.Crawler.resolve_links(parsed_url, links)
+
+
+def bench_links(repeat, options):
+    '''Link extraction: legacy regex + BeautifulSoup against LinkExtractor'''
+    parsed_url = urllib.parse.urlparse('http://bench.example.com/dir/index.html')
+    try:
+        import bs4
+        have_bs4 = True
+    except ImportError:
+        have_bs4 = False
+        print('beautifulsoup4 not installed, skipping the legacy implementation')
+
+    print('{0:>8} {1:>10} {2:>14} {3:>14} {4:>8}'.format('links', 'size', 'legacy MB/s', 'extractor MB/s', 'speedup'))
+    for nlinks in (100, 1000, 10000):
+        content = synthetic_html(nlinks)
+        mb = len(content.encode()) / (1 << 20)
+        new = best_of(repeat, pwget.Crawler.get_links, parsed_url, content)
+        if have_bs4:
+            assert sorted(legacy_get_links(parsed_url, content)) == sorted(pwget.Crawler.get_links(parsed_url, content))
+            legacy = best_of(repeat, legacy_get_links, parsed_url, content)
+            print('{0:>8} {1:>10} {2:>14.2f} {3:>14.2f} {4:>7.2f}x'.format(nlinks, pwget.humansize(len(content)), mb / legacy, mb / new, legacy / new))
+        else:
+            print('{0:>8} {1:>10} {2:>14} {3:>14.2f} {4:>8}'.format(nlinks, pwget.humansize(len(content)), '-', mb / new, '-'))
+
+
+def synthetic_urls(n, prefix='http://bench.example.com/'):
+    '''Urls of realistic length, distinct for distinct prefixes'''
+    return ['{0}section/{1}/articles/2019/{2}/some-long-article-title-{2}.html?utm_source=feed&ref={3}'.format(prefix, i % 97, i, i % 13)
+        for i in range(n)]
+
+
+def measure_memory(f):
+    '''Returns (result of f(), bytes allocated by f and still alive)'''
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        res = f()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (res, after - before)
+
+
+def bench_seen(repeat, options, n=200000):
+    '''Seen url sets: set of strings, FingerprintSet and BloomFilter: memory, speed and false positives'''
+    urls = synthetic_urls(n)
+    others = synthetic_urls(n, 'http://other.example.com/')
+    kinds = [
+        ('set', set),
+        ('fingerprint', pwget.FingerprintSet),
+        ('bloom 1e-4', lambda: pwget.BloomFilter(n, 1e-4)),
+        ('bloom 1e-2', lambda: pwget.BloomFilter(n, 1e-2)),
+    ]
+
+    def fill(make):
+        s = make()
+        for u in urls:
+            s.add(u)
+        return s
+
+    print('{0} urls, {1:.0f} bytes per url string on average'.format(n, sum(map(len, urls)) / n))
+    print('{0:>12} {1:>12} {2:>10} {3:>12} {4:>12} {5:>14}'.format('kind', 'memory', 'B/url', 'adds/s', 'lookups/s', 'false pos.'))
+    for (name, make) in kinds:
+        (s, nbytes) = measure_memory(lambda: fill(make))
+        if isinstance(s, set):
+            # a set keeps its url strings alive
+            nbytes += sum(sys.getsizeof(u) for u in urls)
+        add_time = best_of(repeat, fill, make)
+        lookup_time = best_of(repeat, lambda: [u in s for u in others])
+        false_positives = sum(u in s for u in others)
+        print('{0:>12} {1:>12} {2:>10.1f} {3:>12.0f} {4:>12.0f} {5:>14.2e}'.format(name, pwget.humansize(nbytes), nbytes / n,
+            n / add_time, n / lookup_time, false_positives / n))
+
+
+def legacy_normalize(url):
+    '''normalize as it was before normalize_path: character walk in Path.assign
+    and list deletions in Path.normalize, no cache'''
+    x = urllib.parse.urlsplit(url)
+    path = pwget.Path(x[2])
+    path.normalize()
+    return urllib.parse.urlunparse((x[0], x[1].lower(), str(path), '', x[3], x[4]))
+
+
+def bench_normalize(repeat, options, npages=200):
+    '''Url normalization of the links of a site: legacy Path, normalize_path, cached batches'''
+    rnd = random.Random(0)
+    # every page links to the site navigation, plus some links of its own
+    navigation = ['http://Bench.example.com/section/{0}/../{0}/./index.html'.format(i) for i in range(40)]
+    pages = []
+    for p in range(npages):
+        own = ['http://bench.example.com/section/{0}/articles/../articles/{1}/page.html'.format(p % 40, rnd.randint(0, 5000)) for _ in range(60)]
+        pages.append(navigation + own + own[:20])
+    nlinks = sum(map(len, pages))
+
+    def legacy():
+        for links in pages:
+            [legacy_normalize(l) for l in links]
+
+    def uncached():
+        for links in pages:
+            [pwget.normalize.__wrapped__(l) for l in links]
+
+    def batched():
+        pwget.normalize.cache_clear()
+        for links in pages:
+            pwget.normalize_links(links)
+
+    for links in pages:
+        assert list(dict.fromkeys(map(legacy_normalize, links))) == pwget.normalize_links(links)
+
+    print('{0} pages, {1} links'.format(npages, nlinks))
+    print('{0:>26} {1:>12} {2:>8}'.format('', 'links/s', 'speedup'))
+    base = None
+    for (name, f) in (('legacy Path', legacy), ('normalize_path', uncached), ('normalize_links, cached', batched)):
+        t = best_of(repeat, f)
+        base = base or t
+        print('{0:>26} {1:>12.0f} {2:>7.2f}x'.format(name, nlinks / t, base / t))
+
+
+class SyntheticSite(object):
+    """A site generated on demand by an http.server running in its own process,
+    so it doesn't take CPU time or memory from the crawler being measured.
+
+    Page /a/b/ (depth 2) links to its fanout children /a/b/0/ ... , to its
+    binaries /a/b/bin0.dat ... , to its parent and to the root. Whether a url
+    fails with a 500 error is decided by a hash of its path, so every run of
+    the same configuration serves the same site."""
+    DEFAULTS = {
+        'fanout': 5,
+        'depth': 3,
+        'page_size': 16384,
+        'binaries': 1,
+        'binary_size': 256 << 10,
+        'delay': 0.0,
+        'error_rate': 0.0,
+    }
+
+    def __init__(self, **config):
+        self.config = dict(SyntheticSite.DEFAULTS)
+        self.config.update((k, v) for (k, v) in config.items() if k in SyntheticSite.DEFAULTS)
+        (parent_conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=SyntheticSite.serve, args=(self.config, child_conn), daemon=True)
+        self.process.start()
+        self.port = parent_conn.recv()
+        self.netloc = '127.0.0.1:{0}'.format(self.port)
+        self.url = 'http://{0}/'.format(self.netloc)
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
+
+    @staticmethod
+    def fails(path, error_rate):
+        if path == '/' or not error_rate:
+            return False
+        h = int.from_bytes(hashlib.md5(path.encode()).digest()[:4], 'little')
+        return h < error_rate * (1 << 32)
+
+    def expected(self):
+        """returns (pages, binaries) served without error"""
+        c = self.config
+        pages = ['/']
+        level = ['/']
+        for _ in range(c['depth']):
+            level = [p + '{0}/'.format(i) for p in level for i in range(c['fanout']) if not self.fails(p, c['error_rate'])]
+            pages.extend(level)
+        pages = [p for p in pages if not self.fails(p, c['error_rate'])]
+        # only the binaries of pages that were served are found
+        binaries = [p + 'bin{0}.dat'.format(j) for p in pages for j in range(c['binaries'])]
+        return (pages, [b for b in binaries if not self.fails(b, c['error_rate'])])
+
+    @staticmethod
+    def page(path, c):
+        depth = path.count('/') - 1
+        links = []
+        if depth < c['depth']:
+            links.extend('<a href="{0}{1}/">page {1}</a>'.format(path, i) for i in range(c['fanout']))
+        links.extend('<a href="bin{0}.dat">binary {0}</a>'.format(j) for j in range(c['binaries']))
+        links.append('<a href="/">home</a>')
+        if depth:
+            links.append('<a href="../">up</a>')
+        head = '<!DOCTYPE html><html><head><title>{0}</title></head><body><p>'.format(path)
+        body = '</p>{0}</body></html>'.format(' '.join(links))
+        filler = 'lorem ipsum dolor sit amet ' * (max(0, c['page_size'] - len(head) - len(body)) // 27 + 1)
+        return (head + filler[:max(0, c['page_size'] - len(head) - len(body))] + body).encode()
+
+    @staticmethod
+    def serve(config, conn):
+        binary = (hashlib.sha256(b'pwget').digest() * (config['binary_size'] // 32 + 1))[:config['binary_size']]
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body in one write, Nagle would delay keep-alive responses
+            wbufsize = 1 << 16
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if config['delay']:
+                    time.sleep(config['delay'])
+                path = urllib.parse.urlsplit(self.path).path
+                if SyntheticSite.fails(path, config['error_rate']):
+                    self.send_error(500)
+                    return
+                if path.endswith('/'):
+                    (ctype, body) = ('text/html; charset=utf-8', SyntheticSite.page(path, config))
+                elif re.match(r'.*/bin\d+\.dat$', path):
+                    (ctype, body) = ('application/octet-stream', binary)
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.daemon_threads = True
+        conn.send(server.server_port)
+        server.serve_forever()
+
+
+def crawl_site(site, jobs=1):
+    """Crawls site in a temporary directory, returns the measurements as a dict"""
+    phases = {}
+    workdir = tempfile.mkdtemp(prefix='pwget_bench')
+    oldcwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        def phase(name, f):
+            (cpu, wall) = (time.process_time(), time.perf_counter())
+            res = f()
+            phases[name] = {'cpu': time.process_time() - cpu, 'wall': time.perf_counter() - wall}
+            return res
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # the failing pages always fail, retrying them would only measure the backoff
+            crawler = phase('setup', lambda: pwget.Crawler([site.url], mirror=True, concurrency=jobs, tries=1))
+            phase('crawl', crawler)
+
+        def walk():
+            (nfiles, nbytes) = (0, 0)
+            for (dirpath, _, filenames) in os.walk(site.netloc):
+                for f in filenames:
+                    nfiles += 1
+                    nbytes += os.path.getsize(os.path.join(dirpath, f))
+            return (nfiles, nbytes)
+        (nfiles, nbytes) = phase('verify', walk)
+    finally:
+        os.chdir(oldcwd)
+        shutil.rmtree(workdir)
+
+    (pages, binaries) = site.expected()
+    wall = phases['crawl']['wall']
+    # CPU seconds of the crawl by the threads doing each part of it: the requests
+    # less their link extraction, and the writer thread
+    cpu = crawler.instrumentation.cpu
+    parse = cpu['parse'] + cpu['normalize']
+    errors = sum(v.count for v in crawler.stats['errors'].values()) if 'errors' in crawler.stats else 0
+    return {
+        'files': nfiles,
+        'expected_files': len(pages) + len(binaries),
+        'bytes': nbytes,
+        'errors': errors,
+        'pages_per_s': len(pages) / wall,
+        'files_per_s': nfiles / wall,
+        'mb_per_s': nbytes / (1 << 20) / wall,
+        # ru_maxrss is in KiB on Linux, bytes on macOS
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        'phases': phases,
+        'crawl_cpu': {'fetch': cpu['request'] - parse, 'parse': parse, 'write': cpu['write']},
+        'request_phases': crawler.instrumentation.summary(),
+    }
+
+
+def bench_site(repeat, options):
+    '''Crawl of a synthetic site served by a local http.server process'''
+    site = SyntheticSite(**options)
+    try:
+        runs = [crawl_site(site, options.get('jobs', 1)) for _ in range(repeat)]
+    finally:
+        site.close()
+    best = max(runs, key=lambda r: r['pages_per_s'])
+    result = {
+        'benchmark': 'site',
+        'pwget_version': pwget.__version__,
+        'python': sys.version.split()[0],
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': dict(site.config, jobs=options.get('jobs', 1), repeat=repeat),
+        'result': best,
+    }
+    print('{0} files ({1} expected), {2}, {3} errors'.format(best['files'], best['expected_files'], pwget.humansize(best['bytes']), best['errors']))
+    print('{0:.1f} pages/s, {1:.1f} files/s, {2:.2f} MB/s, peak RSS {3}'.format(best['pages_per_s'], best['files_per_s'],
+        best['mb_per_s'], pwget.humansize(best['peak_rss'])))
+    print('{0:>10} {1:>10} {2:>10}'.format('phase', 'cpu s', 'wall s'))
+    for (name, t) in best['phases'].items():
+        print('{0:>10} {1:>10.3f} {2:>10.3f}'.format(name, t['cpu'], t['wall']))
+        if name == 'crawl':
+            for (part, seconds) in best['crawl_cpu'].items():
+                print('{0:>10} {1:>10.3f}'.format('- ' + part, seconds))
+    return result
+
+
+def compare(old, new):
+    """Prints the ratio new / old of the throughput numbers of two site results"""
+    print('compared with pwget {0} of {1}:'.format(old['pwget_version'], old['date']))
+    if old['config'] != new['config']:
+        print('warning: different site configurations')
+    for key in ('pages_per_s', 'files_per_s', 'mb_per_s', 'peak_rss'):
+        (a, b) = (old['result'][key], new['result'][key])
+        print('{0:>12}: {1:>12.1f} -> {2:>12.1f} ({3:+.1f}%)'.format(key, a, b, (b - a) * 100 / a if a else 0))
+    old_cpu = old['result'].get('crawl_cpu', {})
+    for (part, b) in new['result']['crawl_cpu'].items():
+        if part in old_cpu:
+            a = old_cpu[part]
+            print('{0:>12}: {1:>10.3f} s -> {2:>10.3f} s ({3:+.1f}%)'.format(part + ' cpu', a, b, (b - a) * 100 / a if a else 0))
+    old_phases = old['result'].get('request_phases', {})
+    for (phase, s) in new['result'].get('request_phases', {}).items():
+        if phase in old_phases:
+            (a, b) = (old_phases[phase]['mean'] * 1000, s['mean'] * 1000)
+            print('{0:>12}: {1:>9.3f} ms -> {2:>9.3f} ms ({3:+.1f}%)'.format(phase, a, b, (b - a) * 100 / a if a else 0))
+
+
+BENCHMARKS = {
+    'links': bench_links,
+    'seen': bench_seen,
+    'normalize': bench_normalize,
+    'site': bench_site,
+}
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:o:c:", ['help', 'repeat=', 'output=', 'compare=',
+            'fanout=', 'depth=', 'page-size=', 'binaries=', 'binary-size=', 'delay=', 'error-rate=', 'jobs='])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        return(1)
+
+    repeat = 5
+    output = None
+    compare_with = None
+    options = dict()
+    for o, a in opts:
+        if o in ('-n', '--repeat'):
+            repeat = int(a)
+
+        elif o in ('-o', '--output'):
+            output = a
+
+        elif o in ('-c', '--compare'):
+            compare_with = a
+
+        elif o in ('--fanout', '--depth', '--page-size', '--binaries', '--binary-size', '--jobs'):
+            options[o[2:].replace('-', '_')] = int(a)
+
+        elif o in ('--delay', '--error-rate'):
+            options[o[2:].replace('-', '_')] = float(a)
+
+        elif o in ("-h", "--help"):
+            usage()
+            return(1)
+
+    for name in args or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            print('unknown benchmark: {0}'.format(name))
+            usage()
+            return(1)
+        print('== {0}: {1}'.format(name, BENCHMARKS[name].__doc__))
+        result = BENCHMARKS[name](repeat, options)
+        if name == 'site':
+            if compare_with:
+                with open(compare_with) as f:
+                    compare(json.load(f), result)
+            if output:
+                with open(output, 'w') as f:
+                    json.dump(result, f, indent=2)
+        print()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
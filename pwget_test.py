@@ -8,12 +8,176 @@ import os
 import sys
 import shutil
 import io
+import tempfile
+import socket
+import hashlib
+import re
+import gzip
+import random
+import threading
+import functools
+import time
+import collections
+import struct
+import http.server
 
 import pwget
+import pwget_bench
 import unittest
 import doctest
 
 
+class LocalSite:
+    """Serves a dict of path => bytes on localhost, counting the requests per path.
+    The status codes listed in failures[path] are answered first, one per request.
+    cuts[path] = (nbytes, reset) stops sending the body of path after nbytes,
+    closing the connection or resetting it. encodings[path] labels the body of
+    path with a Content-Encoding it isn't encoded with."""
+    def __init__(self, pages, redirects={}):
+        self.pages = pages
+        self.redirects = redirects
+        self.failures = {}
+        self.cuts = {}
+        self.encodings = {}
+        self.retry_after = None
+        self.hits = collections.Counter()
+        self.not_modified = collections.Counter()
+        self.ranges = []
+        self.compress = False
+        site = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                site.hits[self.path] += 1
+                if site.failures.get(self.path):
+                    self.send_response(site.failures[self.path].pop(0))
+                    if site.retry_after is not None:
+                        self.send_header('Retry-After', site.retry_after)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if self.path in site.redirects:
+                    self.send_response(302)
+                    self.send_header('Location', site.redirects[self.path])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = site.pages.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+                gzipped = site.compress and 'gzip' in self.headers.get('Accept-Encoding', '')
+                if gzipped:
+                    etag = etag[:-1] + '-gzip"'
+                if self.headers.get('If-None-Match') == etag:
+                    site.not_modified[self.path] += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                ctype = 'text/html' if self.path.endswith('/') or self.path.endswith('.html') else 'application/octet-stream'
+                m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+                if m and self.headers.get('If-Range', etag) == etag:
+                    site.ranges.append((self.path, self.headers['Range']))
+                    (begin, end) = (int(m.group(1)), int(m.group(2) or len(body) - 1))
+                    if begin >= len(body):
+                        self.send_error(416)
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(begin, end, len(body)))
+                    body = body[begin:end + 1]
+                else:
+                    if gzipped:
+                        body = gzip.compress(body)
+                    self.send_response(200)
+                    if gzipped:
+                        self.send_header('Content-Encoding', 'gzip')
+                    elif self.path in site.encodings:
+                        self.send_header('Content-Encoding', site.encodings[self.path])
+                self.send_header('ETag', etag)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.path in site.cuts:
+                    (nbytes, reset) = site.cuts[self.path]
+                    self.wfile.write(body[:nbytes])
+                    self.close_connection = True
+                    if reset:
+                        # let the client read the headers, then drop the connection
+                        time.sleep(0.05)
+                        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                        self.connection.close()
+                    return
+                self.wfile.write(body)
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.netloc = '127.0.0.1:{0}'.format(self.server.server_port)
+        self.url = 'http://{0}/'.format(self.netloc)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def localpath(self, path):
+        """Where the crawler saves path"""
+        localpath = os.path.join(self.netloc, path[1:])
+        if path.endswith('/'):
+            localpath = os.path.join(localpath, pwget.Crawler.ROOTFILENAME)
+        return localpath
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def tree_site(fanout, depth):
+    """Pages linking to fanout children each, depth levels deep, plus a binary per page"""
+    pages = {}
+    def add(path, level):
+        children = [path + '{0}/'.format(i) for i in range(fanout)] if level < depth else []
+        links = ''.join('<a href="{0}">c</a>'.format(c) for c in children)
+        links += '<a href="{0}data.bin">d</a><a href="/">root</a>'.format(path)
+        pages[path] = '<html><body>{0}</body></html>'.format(links).encode()
+        pages[path + 'data.bin'] = os.urandom(64)
+        for c in children:
+            add(c, level + 1)
+    add('/', 0)
+    return pages
+
+
+class TempDirTest(unittest.TestCase):
+    """Runs each test inside an empty temporary directory, where the crawler saves its files"""
+    def setUp(self):
+        self.oldcwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.oldcwd)
+        shutil.rmtree(self.tmpdir)
+
+
+class LocalSiteTest(TempDirTest):
+    """Serves tree_site(FANOUT, DEPTH) as self.site during each test"""
+    FANOUT = 2
+    DEPTH = 1
+    REDIRECTS = {}
+
+    def setUp(self):
+        super().setUp()
+        self.site = LocalSite(tree_site(self.FANOUT, self.DEPTH), self.REDIRECTS)
+
+    def tearDown(self):
+        self.site.close()
+        super().tearDown()
+
+
 class CrawlerTest(unittest.TestCase):
     def setUp(self):
         self.assertFalse(os.path.isdir("google.com"))
@@ -27,10 +191,1073 @@ class CrawlerTest(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree("google.com")
 
+class ConcurrentCrawlerTest(LocalSiteTest):
+    FANOUT = 3
+    DEPTH = 2
+
+    def test_each_url_fetched_once(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, concurrency=8, host_concurrency=3)
+        crawler()
+        self.assertEqual(set(self.site.hits.keys()), set(self.site.pages.keys()))
+        self.assertEqual(set(self.site.hits.values()), {1})
+        for path, body in self.site.pages.items():
+            with open(self.site.localpath(path), 'rb') as f:
+                self.assertEqual(f.read(), body)
+
+    def saved_tree(self):
+        """{path: bytes} of the files saved under the current directory"""
+        tree = {}
+        for (root, _, files) in os.walk(self.site.netloc):
+            for name in files:
+                with open(os.path.join(root, name), 'rb') as f:
+                    tree[os.path.join(root, name)] = f.read()
+        return tree
+
+    def test_same_result_as_sequential(self):
+        results = []
+        for concurrency in (1, 8):
+            os.mkdir(str(concurrency))
+            os.chdir(str(concurrency))
+            self.site.hits.clear()
+            crawler = pwget.Crawler([self.site.url], mirror=True, concurrency=concurrency)
+            crawler()
+            self.assertEqual(set(self.site.hits.values()), {1})
+            results.append((set(crawler.frontier.seen), self.saved_tree()))
+            os.chdir(self.tmpdir)
+        self.assertEqual(results[0][0], {'http://{0}{1}'.format(self.site.netloc, p) for p in self.site.pages})
+        self.assertEqual(results[0], results[1])
+
+
+class ConnectionPoolTest(LocalSiteTest):
+    REDIRECTS = {'/moved': '/0/'}
+
+    def test_crawl_reuses_connection(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True)
+        crawler()
+        self.assertEqual(crawler.pool.misses, 1)
+        self.assertEqual(crawler.pool.hits, len(self.site.pages) - 1)
+
+    def test_idle_timeout(self):
+        pool = pwget.ConnectionPool(idle_timeout=0)
+        for _ in range(2):
+            with pool.urlopen(pwget.urllib.request.Request(self.site.url)) as r:
+                r.read()
+        self.assertEqual((pool.hits, pool.misses), (0, 2))
+
+    def test_broken_connection_is_retried(self):
+        pool = pwget.ConnectionPool()
+        pool.urlopen(pwget.urllib.request.Request(self.site.url)).read()
+        # simulate the server dropping the idle keep-alive connection
+        for (conn, _) in pool.idle[pool.key(pwget.urllib.parse.urlsplit(self.site.url))]:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(pool.urlopen(pwget.urllib.request.Request(self.site.url)).read(), self.site.pages['/'])
+        self.assertEqual(pool.retries, 1)
+
+    def test_redirect_and_error(self):
+        pool = pwget.ConnectionPool(max_size=1)
+        self.assertEqual(pool.urlopen(pwget.urllib.request.Request(self.site.url + 'moved')).read(), self.site.pages['/0/'])
+        with self.assertRaises(pwget.urllib.error.HTTPError) as cm:
+            pool.urlopen(pwget.urllib.request.Request(self.site.url + 'missing'))
+        self.assertEqual(cm.exception.code, 404)
+        self.assertEqual(pool.misses, 1)
+
+
+    def test_proxy(self):
+        proxy = LocalSite({'http://example.invalid/x': b'via proxy'})
+        try:
+            pool = pwget.ConnectionPool(proxies={'http': 'http://u:p@' + proxy.netloc, 'no': '127.0.0.1'})
+            self.assertEqual(pool.urlopen(pwget.urllib.request.Request('http://example.invalid/x')).read(), b'via proxy')
+            # no_proxy hosts are reached directly
+            self.assertEqual(pool.urlopen(pwget.urllib.request.Request(self.site.url)).read(), self.site.pages['/'])
+            self.assertEqual(dict(proxy.hits), {'http://example.invalid/x': 1})
+        finally:
+            proxy.close()
+
+    def test_https_proxy_tunnel(self):
+        pool = pwget.ConnectionPool(proxies={'https': 'proxy.invalid:3128'})
+        conn = pool.connect(pool.key(pwget.urllib.parse.urlsplit('https://example.invalid/')))
+        self.assertEqual((conn.host, conn.port), ('proxy.invalid', 3128))
+        self.assertEqual((conn._tunnel_host, conn._tunnel_port), ('example.invalid', 443))
+
+
+class InstrumentationTest(LocalSiteTest):
+    def test_hook_sees_every_phase(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, concurrency=2)
+        phases = collections.defaultdict(list)
+        crawler.add_hook(lambda phase, seconds, url: phases[phase].append(url))
+        crawler()
+        npages = len(self.site.pages)
+        for phase in ('ttfb', 'body', 'write', 'save', 'recurse', 'request'):
+            self.assertEqual(len(phases[phase]), npages, phase)
+        # the binaries aren't parsed
+        for phase in ('parse', 'normalize'):
+            self.assertEqual(len(phases[phase]), npages // 2, phase)
+        self.assertEqual(phases['dns'], phases['connect'])
+        self.assertEqual(len(phases['dns']), crawler.pool.misses)
+        self.assertEqual(set(phases['request']), set(self.site.url + p[1:] for p in self.site.pages))
+        summary = crawler.instrumentation.summary()
+        self.assertEqual(summary['request']['count'], npages)
+        self.assertLessEqual(summary['ttfb']['p50'], summary['ttfb']['max'])
+
+    def test_cpu_time(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, concurrency=2)
+        crawler()
+        cpu = crawler.instrumentation.cpu
+        for phase in ('request', 'parse', 'normalize', 'save', 'write'):
+            self.assertGreater(cpu[phase], 0, phase)
+        self.assertLess(cpu['parse'] + cpu['normalize'], cpu['request'])
+        self.assertEqual(crawler.instrumentation.summary()['write']['cpu'], cpu['write'])
+
+    def test_profile(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, concurrency=2, profile='crawl.prof')
+        crawler()
+        stats = pwget.pstats.Stats('crawl.prof')
+        self.assertTrue(any(name == 'download' for (_, _, name) in stats.stats))
+
+
+class MetricsTest(LocalSiteTest):
+    def test_json_file(self):
+        crawler = pwget.Crawler([self.site.url, self.site.url + 'missing'], mirror=True, concurrency=2, metrics='metrics.json')
+        crawler()
+        with open('metrics.json') as f:
+            metrics = pwget.json.load(f)
+        self.assertEqual(metrics['requests'], len(self.site.pages) + 1)
+        self.assertEqual(metrics['status'], {'200': len(self.site.pages), '404': 1})
+        self.assertEqual(metrics['bytes'], sum(map(len, self.site.pages.values())))
+        self.assertEqual((metrics['inflight'], metrics['frontier']), (0, 0))
+        self.assertEqual(metrics['hosts'][self.site.netloc]['count'], len(self.site.pages) + 1)
+
+    def test_http_endpoint(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, metrics='127.0.0.1:0')
+        crawler()
+        exporter = pwget.MetricsExporter(crawler.metrics, '127.0.0.1:0')
+        try:
+            url = 'http://{0}:{1}/metrics'.format(*exporter.address)
+            with pwget.urllib.request.urlopen(url) as r:
+                text = r.read().decode()
+            with pwget.urllib.request.urlopen(url + '.json') as r:
+                self.assertEqual(pwget.json.load(r)['requests'], len(self.site.pages))
+        finally:
+            exporter.close()
+        self.assertIn('pwget_requests_total {0}\n'.format(len(self.site.pages)), text)
+        self.assertIn('pwget_responses_total{{code="200"}} {0}\n'.format(len(self.site.pages)), text)
+        self.assertIn('pwget_ttfb_seconds_count{{host="{0}"}} {1}\n'.format(self.site.netloc, len(self.site.pages)), text)
+
+    def test_hosts_capped(self):
+        metrics = pwget.Metrics(pwget.Instrumentation(), max_hosts=3)
+        for i in range(10):
+            metrics.on_phase('ttfb', 0.1, 'http://host{0}/'.format(i))
+        metrics.on_phase('ttfb', 0.1, 'http://host0/a')
+        hosts = metrics.snapshot()['hosts']
+        self.assertEqual(sorted(hosts), ['host0', 'host1', 'host2', 'other'])
+        self.assertEqual((hosts['host0']['count'], hosts['other']['count']), (2, 7))
+
+    def test_failing_urls_are_sampled(self):
+        crawler = pwget.Crawler([])
+        for i in range(1000):
+            crawler.record_error('http://host/{0}'.format(i), 404)
+        errors = crawler.stats['errors'][404]
+        self.assertEqual(errors.count, 1000)
+        self.assertEqual(len(errors['urls']), pwget.Crawler.ERROR_SAMPLE_SIZE)
+        self.assertEqual(errors['urls'].seen, 1000)
+
+
+class HostThrottleTest(unittest.TestCase):
+    def test_aimd(self):
+        throttle = pwget.HostThrottle(delay=1)
+        throttle.started('a', now=0)
+        self.assertEqual(throttle.wait_time('a', now=0.5), 0.5)
+        self.assertEqual(throttle.wait_time('b', now=0.5), 0)
+        throttle.feedback('a', 200, latency=0.1, now=1)
+        # never shorter than the delay asked for
+        self.assertEqual(throttle.hosts['a'].delay, 1)
+        throttle.feedback('a', 200, latency=2.0, now=1)
+        self.assertAlmostEqual(throttle.hosts['a'].delay, 2)
+        throttle.feedback('a', 429, retry_after='30', now=1)
+        self.assertAlmostEqual(throttle.hosts['a'].delay, 4)
+        self.assertEqual(throttle.wait_time('a', now=1), 30)
+        self.assertEqual(throttle.backoffs, 2)
+        throttle.feedback('a', 200, latency=0.1, now=1)
+        self.assertAlmostEqual(throttle.hosts['a'].delay, 1 / 0.75)
+        for _ in range(3):
+            throttle.feedback('a', 200, latency=0.1, now=1)
+        self.assertEqual(throttle.hosts['a'].delay, 1)
+
+    def test_healthy_host_reaches_min_delay(self):
+        throttle = pwget.HostThrottle(min_delay=0.1)
+        throttle.feedback('a', 503)
+        self.assertEqual(throttle.slowed_down(), {'a': pwget.HostThrottle.MIN_BACKOFF_DELAY})
+        for _ in range(100):
+            throttle.feedback('a', 200, latency=0.01)
+        self.assertEqual(throttle.hosts['a'].delay, 0.1)
+        self.assertEqual(throttle.slowed_down(), {})
+
+
+class RateControlTest(TempDirTest):
+    def setUp(self):
+        super().setUp()
+        self.slow = LocalSite(tree_site(2, 1))
+        self.slow.failures['/0/'] = [429]
+        self.slow.retry_after = '1'
+        self.other = LocalSite(tree_site(4, 2))
+
+    def tearDown(self):
+        self.slow.close()
+        self.other.close()
+        super().tearDown()
+
+    def crawl(self, concurrency):
+        # one request at a time per host, so none is in flight when the 429 arrives
+        crawler = pwget.Crawler([self.slow.url, self.other.url], mirror=True, concurrency=concurrency, host_concurrency=1)
+        fetched = []
+        crawler.add_hook(lambda phase, seconds, url: phase == 'request' and fetched.append((time.monotonic(), url)))
+        crawler()
+        throttled = next(t for (t, url) in fetched if url == self.slow.url + '0/')
+        after = [t for (t, url) in fetched if url.startswith(self.slow.url) and t > throttled]
+        # the other host is crawled while the throttled one cools down
+        self.assertTrue(any(throttled < t < min(after) for (t, url) in fetched if url.startswith(self.other.url)))
+        self.assertGreaterEqual(min(after) - throttled, 0.9)
+        # the throttled page is retried
+        self.assertEqual(len(fetched), len(self.slow.pages) + len(self.other.pages) + 1)
+        self.assertNotIn('errors', crawler.stats)
+
+    def test_sequential(self):
+        self.crawl(1)
+
+    def test_concurrent(self):
+        self.crawl(3)
+
+
+class LimitRateTest(TempDirTest):
+    def setUp(self):
+        super().setUp()
+        self.site = LocalSite({'/': b'<a href="/a.bin">a</a><a href="/b.bin">b</a>',
+            '/a.bin': os.urandom(96 << 10), '/b.bin': os.urandom(96 << 10)})
+
+    def tearDown(self):
+        self.site.close()
+        super().tearDown()
+
+    def test_global_limit(self):
+        start = time.monotonic()
+        crawler = pwget.Crawler([self.site.url], mirror=True, concurrency=2, limit_rate=256 << 10, limit_burst=64 << 10)
+        crawler()
+        elapsed = time.monotonic() - start
+        # 192 KiB at 256 KiB/s, less the 64 KiB burst
+        self.assertGreater(elapsed, 0.4)
+        self.assertGreater(crawler.instrumentation.histograms['limit'].total, 0.3)
+        self.assertEqual(crawler.bandwidth.total, len(self.site.pages['/']) + (192 << 10))
+
+    def test_small_pages_not_delayed(self):
+        crawler = pwget.Crawler([self.site.url], level=0, limit_rate=64 << 10)
+        crawler()
+        self.assertEqual(crawler.instrumentation.histograms['limit'].total, 0)
+
+    def test_every_body_limited(self):
+        base = self.site.url
+        self.site.pages['/robots.txt'] = 'Sitemap: {0}sitemap.xml\n'.format(base).encode()
+        self.site.pages['/sitemap.xml'] = ('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            '<url><loc>{0}b.bin</loc></url></urlset>').format(base).encode()
+        # a page saved already, read for its links only
+        os.makedirs(self.site.netloc)
+        with open(self.site.localpath('/'), 'wb') as f:
+            f.write(b'old')
+        crawler = pwget.Crawler([base], regex=base, sitemaps=True, limit_rate=1 << 30)
+        crawler()
+        self.assertEqual(set(self.site.hits), set(self.site.pages))
+        self.assertEqual(crawler.bandwidth.total, sum(len(body) for body in self.site.pages.values()))
+
+    def test_host_limit(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, host_limit_rate=512 << 10, limit_burst=32 << 10)
+        crawler()
+        bucket = crawler.host_bandwidth[self.site.netloc]
+        self.assertGreater(bucket.waited, 0.2)
+        self.assertIsNone(crawler.bandwidth)
+
+
+class RetryTest(LocalSiteTest):
+    def crawl(self, urls, **kvargs):
+        crawler = pwget.Crawler(urls, mirror=True, retry_backoff=0.01, **kvargs)
+        crawler()
+        return crawler
+
+    def test_transient_errors_are_retried(self):
+        for concurrency in (1, 3):
+            self.site.failures['/0/'] = [502, 500]
+            self.site.hits.clear()
+            crawler = self.crawl([self.site.url], concurrency=concurrency, overwrite=True)
+            self.assertEqual(self.site.hits['/0/'], 3)
+            self.assertEqual(crawler.stats['retries'].count, 2)
+            self.assertNotIn('errors', crawler.stats)
+            with open(self.site.localpath('/0/data.bin'), 'rb') as f:
+                self.assertEqual(f.read(), self.site.pages['/0/data.bin'])
+
+    def test_gives_up_after_tries(self):
+        self.site.failures['/0/'] = [500] * 5
+        crawler = self.crawl([self.site.url, self.site.url + 'missing'], tries=2)
+        self.assertEqual(self.site.hits['/0/'], 2)
+        self.assertEqual(self.site.hits['/missing'], 1)
+        self.assertEqual(crawler.stats['errors'][500].count, 1)
+        self.assertEqual(crawler.stats['errors'][404].count, 1)
+        self.assertEqual(self.site.hits['/1/'], 1)
+
+    def test_connection_errors_are_recorded(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            url = 'http://127.0.0.1:{0}/'.format(s.getsockname()[1])
+        crawler = self.crawl([url, self.site.url], concurrency=2, tries=2)
+        self.assertEqual(crawler.stats['errors']['ConnectionRefusedError'].count, 1)
+        self.assertEqual(crawler.stats['retries'].count, 1)
+        self.assertEqual(self.site.hits['/1/'], 1)
+
+    def test_permanent_errors_are_not_retried(self):
+        # a file in the way of the directory of /1/
+        os.makedirs(self.site.netloc)
+        with open(os.path.join(self.site.netloc, '1'), 'wb'):
+            pass
+        crawler = self.crawl([self.site.url, 'http://127.0.0.1:99999/', 'http://h:abc/', self.site.url + 'with space'])
+        self.assertNotIn('retries', crawler.stats)
+        self.assertEqual(crawler.stats['errors']['ValueError'].count, 2)
+        self.assertEqual(crawler.stats['errors']['InvalidURL'].count, 1)
+        self.assertEqual(self.site.hits['/1/'], 1)
+        self.assertEqual(self.site.hits['/0/data.bin'], 1)
+
+
+class StreamingSaveTest(TempDirTest):
+    def test_links_of_existing_file_are_followed(self):
+        site = LocalSite(tree_site(2, 1))
+        try:
+            os.makedirs(site.netloc)
+            with open(site.localpath('/'), 'wb') as f:
+                f.write(b'old')
+            crawler = pwget.Crawler([site.url], regex=site.url)
+            crawler()
+            self.assertEqual(set(site.hits.keys()), set(site.pages.keys()))
+            with open(site.localpath('/'), 'rb') as f:
+                self.assertEqual(f.read(), b'old')
+        finally:
+            site.close()
+
+    def test_invalid_link_is_skipped(self):
+        site = LocalSite({'/': b'<a href="http://[x">x</a><a href="/a.html">a</a>', '/a.html': b'a'})
+        try:
+            crawler = pwget.Crawler([site.url], mirror=True)
+            crawler()
+            self.assertEqual(set(site.hits.keys()), {'/', '/a.html'})
+            self.assertEqual(len(crawler.stats['errors']), 0)
+        finally:
+            site.close()
+
+    def test_tee_sees_whole_body(self):
+        chunks = []
+        body = os.urandom(100000)
+        crawler = pwget.Crawler([])
+        crawler.save_local('http://h/f', io.BytesIO(body), pwget.urllib.parse.urlparse('http://h/f'), chunks.append)
+        self.assertEqual(chunks[-1], b'')
+        self.assertEqual(b''.join(chunks), body)
+        # the file is written in the background
+        crawler.writer.flush()
+        with open('h/f', 'rb') as f:
+            self.assertEqual(f.read(), body)
+
+
+class WriteBehindTest(TempDirTest):
+    def test_buffers_are_reused(self):
+        writer = pwget.WriteBehind(nbuffers=2)
+        pending = writer.open('f')
+        for i in range(20):
+            buf = writer.buffer()
+            buf[:4] = '{0:04}'.format(i).encode()
+            writer.write(pending, memoryview(buf)[:4], buf)
+        writer.close(pending)
+        writer.shutdown()
+        self.assertEqual(writer.allocated, 2)
+        with open('f', 'rb') as f:
+            self.assertEqual(f.read(), b''.join('{0:04}'.format(i).encode() for i in range(20)))
+
+    def test_fsync_batch(self):
+        done = []
+        writer = pwget.WriteBehind(fsync_batch=3)
+        for name in 'abcd':
+            pending = writer.open(name)
+            writer.write(pending, name.encode())
+            writer.close(pending, functools.partial(done.append, name))
+        writer.flush()
+        self.assertEqual(done, ['a', 'b', 'c', 'd'])
+        self.assertEqual(writer.instrumentation.histograms['fsync'].count, 2)
+        writer.shutdown()
+
+    def test_errors_are_reported(self):
+        errors = []
+        writer = pwget.WriteBehind(on_error=lambda url, e: errors.append((url, type(e))))
+        with open('file', 'w'):
+            pass
+        pending = writer.open(os.path.join('file', 'f'), 'http://h/file/f')
+        writer.write(pending, b'x')
+        writer.close(pending, lambda: errors.append('done'))
+        writer.shutdown()
+        self.assertEqual(errors, [('http://h/file/f', NotADirectoryError)])
+
+    def test_abort_releases_buffers(self):
+        writer = pwget.WriteBehind(nbuffers=4)
+        pending = writer.open('f')
+        buf = writer.buffer()
+        writer.write(pending, memoryview(buf)[:10], buf)
+        writer.abort(pending, writer.buffer())
+        writer.shutdown()
+        self.assertEqual(writer.free.qsize(), writer.allocated)
+        self.assertFalse(os.path.exists('f'))
+
+    def test_failed_downloads_release_buffers(self):
+        pages = dict(('/f{0}'.format(i), os.urandom(100000)) for i in range(80))
+        pages['/'] = ''.join('<a href="{0}">f</a>'.format(p) for p in pages).encode()
+        site = LocalSite(pages)
+        site.cuts = dict((p, (70000, True)) for p in pages if p != '/')
+        try:
+            crawler = pwget.Crawler([site.url], mirror=True, concurrency=8, tries=1)
+            crawler()
+        finally:
+            site.close()
+        self.assertEqual(crawler.writer.free.qsize(), crawler.writer.allocated)
+        self.assertEqual(sum(node.count for node in crawler.stats['errors'].values()), 80)
+
+    def test_directory_cache(self):
+        dirs = pwget.DirectoryCache()
+        dirs.makedirs(os.path.join('a', 'b', 'c'))
+        self.assertTrue(os.path.isdir(os.path.join('a', 'b', 'c')))
+        self.assertIn('a', dirs.known)
+        dirs.makedirs('a')
+
+
+class WarcTest(LocalSiteTest):
+    def records(self, cdx):
+        """{url: (WARC headers, HTTP head, body)} of the responses in the cdx index"""
+        res = {}
+        with open(cdx) as f:
+            self.assertEqual(f.readline(), pwget.WarcWriter.CDX_HEADER)
+            for line in f:
+                (_, _, url, mime, status, digest, _, _, size, offset, filename) = line.split()
+                with open(filename, 'rb') as warc:
+                    warc.seek(int(offset))
+                    record = warc.read(int(size))
+                if filename.endswith('.gz'):
+                    record = gzip.decompress(record)
+                (warc_head, http_head, body) = record.split(b'\r\n\r\n', 2)
+                self.assertTrue(warc_head.startswith(b'WARC/1.1\r\nWARC-Record-ID: '))
+                self.assertIn('WARC-Target-URI: {0}'.format(url).encode(), warc_head)
+                self.assertIn('WARC-Payload-Digest: sha1:{0}'.format(digest).encode(), warc_head)
+                self.assertTrue(body.endswith(b'\r\n\r\n'))
+                res[url] = (warc_head, http_head, body[:-4])
+        return res
+
+    def test_gzipped_records(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, concurrency=2, warc='crawl.warc.gz')
+        crawler()
+        self.assertFalse(os.path.exists(self.site.netloc))
+        self.assertEqual(sorted(f for f in os.listdir('.')), ['crawl-00000.warc.gz', 'crawl.cdx'])
+        records = self.records('crawl.cdx')
+        self.assertEqual(set(records), set(self.site.url + p[1:] for p in self.site.pages))
+        for (path, body) in self.site.pages.items():
+            (_, http_head, stored) = records[self.site.url + path[1:]]
+            self.assertTrue(http_head.startswith(b'HTTP/1.1 200 OK\r\n'))
+            self.assertEqual(stored, body)
+        with gzip.open('crawl-00000.warc.gz', 'rb') as f:
+            content = f.read()
+        self.assertEqual(content.count(b'WARC-Type: request\r\n'), len(self.site.pages))
+        self.assertEqual(content.count(b'WARC-Type: warcinfo\r\n'), 1)
+
+    def test_redirect_hops(self):
+        self.site.redirects['/moved'] = '/0/'
+        pwget.Crawler([self.site.url + 'moved'], warc='crawl.warc', no_recurse=True)()
+        with open('crawl-00000.warc', 'rb') as f:
+            heads = [dict(re.findall(r'(\S+): (.*?)\r\n', h)) for h in re.findall(r'WARC/1.1\r\n(.*?\r\n)\r\n', f.read().decode('latin-1'), re.S)]
+        responses = dict((h['WARC-Record-ID'], h['WARC-Target-URI']) for h in heads if h['WARC-Type'] == 'response')
+        requests = [(h['WARC-Concurrent-To'], h['WARC-Target-URI']) for h in heads if h['WARC-Type'] == 'request']
+        self.assertEqual([url for (_, url) in requests], [self.site.url + 'moved', self.site.url + '0/'])
+        for (response_id, url) in requests:
+            self.assertEqual(responses[response_id], url)
+        with open('crawl.cdx') as f:
+            entries = [line.split() for line in f.readlines()[1:]]
+        self.assertEqual([(e[2], e[4], e[6]) for e in entries],
+            [(self.site.url + 'moved', '302', self.site.url + '0/'), (self.site.url + '0/', '200', '-')])
+
+    def test_rotation(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, warc='crawl', warc_max_size=1000)
+        crawler()
+        self.assertGreater(len([f for f in os.listdir('.') if f.endswith('.warc')]), 2)
+        self.assertEqual(len(self.records('crawl.cdx')), len(self.site.pages))
+        # a second crawl adds files instead of overwriting them
+        nfiles = len(os.listdir('.'))
+        pwget.Crawler([self.site.url], warc='crawl')()
+        self.assertEqual(len(os.listdir('.')), nfiles + 1)
+        self.assertEqual(len(self.records('crawl.cdx')), len(self.site.pages))
+
+
+class DedupTest(TempDirTest):
+    def setUp(self):
+        super().setUp()
+        (small, big) = (os.urandom(1000), os.urandom(300000))
+        links = ''.join('<a href="/{0}">x</a>'.format(p) for p in ('a', 'b', 'c?q=1', 'big1', 'big2', 'other'))
+        self.site = LocalSite({'/': links.encode(), '/a': small, '/b': small, '/c?q=1': small,
+            '/big1': big, '/big2': big, '/other': os.urandom(1000)})
+
+    def tearDown(self):
+        self.site.close()
+        super().tearDown()
+
+    def test_hardlinks(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, concurrency=2, dedup=True)
+        crawler()
+        for (path, body) in self.site.pages.items():
+            with open(self.site.localpath(path), 'rb') as f:
+                self.assertEqual(f.read(), body)
+        inode = lambda p: os.stat(self.site.localpath(p)).st_ino
+        self.assertEqual(len(set(map(inode, ['/a', '/b', '/c?q=1']))), 1)
+        self.assertEqual(inode('/big1'), inode('/big2'))
+        self.assertNotEqual(inode('/other'), inode('/a'))
+        self.assertEqual(crawler.dedup.duplicates, 3)
+        self.assertEqual(crawler.dedup.saved, 2 * 1000 + 300000)
+        self.assertFalse([f for f in os.listdir(self.site.netloc) if f.endswith('.pwget-link')])
+
+    def test_changed_copy_is_unlinked(self):
+        pwget.Crawler([self.site.url], mirror=True, dedup=True)()
+        old = self.site.pages['/b']
+        self.site.pages['/a'] = os.urandom(2000)
+        pwget.Crawler([self.site.url], mirror=True, dedup=True)()
+        for (path, body) in (('/a', self.site.pages['/a']), ('/b', old), ('/c?q=1', old)):
+            with open(self.site.localpath(path), 'rb') as f:
+                self.assertEqual(f.read(), body, path)
+        self.assertNotEqual(os.stat(self.site.localpath('/a')).st_ino, os.stat(self.site.localpath('/b')).st_ino)
+
+    def test_copy_closed_before_the_first(self):
+        # an earlier run's copy is where the first file goes
+        with open('a', 'wb') as f:
+            f.write(b'stale')
+        writer = pwget.WriteBehind(dedup=pwget.DedupIndex())
+        body = b'new'
+        key = (len(body), hashlib.sha256(body).digest())
+        (a, b) = (writer.open('a', 'http://h/a'), writer.open('b', 'http://h/b'))
+        writer.write(a, body)
+        writer.write(b, body)
+        writer.close(b, None, key)
+        writer.close(a, None, key)
+        writer.shutdown()
+        for path in ('a', 'b'):
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), body, path)
+        self.assertEqual(os.stat('a').st_ino, os.stat('b').st_ino)
+
+    def test_warc_revisits(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, dedup=True, warc='crawl.warc')
+        crawler()
+        with open('crawl.cdx') as f:
+            mimes = [line.split()[3] for line in f.readlines()[1:]]
+        self.assertEqual(mimes.count('warc/revisit'), 3)
+        self.assertEqual(crawler.dedup.saved, 2 * 1000 + 300000)
+        self.assertLess(os.path.getsize('crawl-00000.warc'), 300000 + 20000)
+
+
+class InputFileTest(LocalSiteTest):
+    FANOUT = 3
+    DEPTH = 2
+
+    def setUp(self):
+        super().setUp()
+        self.listed = sorted(p for p in self.site.pages if p.endswith('data.bin') or p.count('/') == 3)
+        with open('urls.txt', 'w') as f:
+            f.write('# bulk list\n\n')
+            f.writelines('http://{0}{1}\n'.format(self.site.netloc, p) for p in self.listed)
+        self.batch = pwget.Crawler.INPUT_BATCH
+        pwget.Crawler.INPUT_BATCH = 3
+
+    def tearDown(self):
+        pwget.Crawler.INPUT_BATCH = self.batch
+        super().tearDown()
+
+    def test_list_only(self):
+        for concurrency in (1, 4):
+            self.site.hits.clear()
+            crawler = pwget.Crawler([], input_file='urls.txt', no_recurse=True, overwrite=True, concurrency=concurrency)
+            sizes = []
+            crawler.add_hook(lambda phase, s, url: sizes.append(len(crawler.frontier)))
+            crawler()
+            self.assertEqual(sorted(self.site.hits), self.listed)
+            self.assertEqual(set(self.site.hits.values()), {1})
+            self.assertLessEqual(max(sizes), 2 * pwget.Crawler.INPUT_BATCH)
+
+    def test_invalid_lines_skipped(self):
+        with open('urls.txt', 'w') as f:
+            f.write('http://[oops/\nhttp://{0}/0/\nhttp://[x\n'.format(self.site.netloc))
+        with self.assertLogs(level='ERROR') as logs:
+            pwget.Crawler([], input_file='urls.txt', no_recurse=True)()
+        self.assertEqual(list(self.site.hits), ['/0/'])
+        self.assertEqual([m.split(':')[2] for m in logs.output], ['input line 1', 'input line 3'])
+
+    def test_recurse_from_listed(self):
+        crawler = pwget.Crawler([], input_file='urls.txt', mirror=True)
+        crawler()
+        self.assertEqual(set(self.site.hits), set(self.site.pages))
+
+
+class SitemapTest(TempDirTest):
+    def setUp(self):
+        super().setUp()
+        self.site = LocalSite({'/': b'<a href="/linked">l</a>', '/linked': b'l', '/old': b'o', '/new': b'n'})
+        base = self.site.url
+        entry = '<url><loc>{0}{1}</loc><lastmod>{2}</lastmod></url>'
+        urlset = '<?xml version="1.0"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{0}</urlset>'
+        self.site.pages['/robots.txt'] = 'User-agent: *\nDisallow:\nSitemap: {0}index.xml\n'.format(base).encode()
+        self.site.pages['/index.xml'] = ('<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            '<sitemap><loc>{0}a.xml.gz</loc></sitemap><sitemap><loc>{0}b.xml</loc></sitemap></sitemapindex>').format(base).encode()
+        self.site.pages['/a.xml.gz'] = gzip.compress(urlset.format(entry.format(base, 'old', '2001-01-01')).encode())
+        self.site.pages['/b.xml'] = urlset.format(entry.format(base, 'new', '2999-01-01T00:00:00Z')
+            + entry.format(base, 'linked', '2001-01-01')).encode()
+
+    def tearDown(self):
+        self.site.close()
+        super().tearDown()
+
+    def test_discovery_and_lastmod(self):
+        crawler = pwget.Crawler([self.site.url], mirror=True, sitemaps=True)
+        crawler()
+        for path in ('/', '/linked', '/old', '/new', '/robots.txt', '/index.xml', '/a.xml.gz', '/b.xml'):
+            self.assertEqual(self.site.hits[path], 1, path)
+        self.assertEqual(crawler.stats['sitemap urls'].count, 3)
+
+        # a mirror run skips the urls not modified since their lastmod
+        self.site.hits.clear()
+        crawler = pwget.Crawler([self.site.url], mirror=True, sitemaps=True)
+        crawler()
+        self.assertEqual(self.site.hits['/new'], 1)
+        self.assertEqual(self.site.hits['/old'], 0)
+        self.assertEqual(self.site.hits['/linked'], 0)
+        self.assertEqual(crawler.stats['unchanged'].count, 2)
+
+    def test_no_robots(self):
+        del self.site.pages['/robots.txt']
+        self.site.pages['/sitemap.xml'] = self.site.pages.pop('/b.xml')
+        crawler = pwget.Crawler([self.site.url], mirror=True, sitemaps=True)
+        crawler()
+        self.assertEqual(self.site.hits['/new'], 1)
+        self.assertEqual(self.site.hits['/robots.txt'], 1)
+        self.assertNotIn('errors', crawler.stats)
+
+
+class ShardTest(TempDirTest):
+    def setUp(self):
+        super().setUp()
+        self.sites = [LocalSite(tree_site(2, 1)) for _ in range(4)]
+        # every root links to the next site and to a page missing on it
+        for (site, next_site) in zip(self.sites, self.sites[1:] + self.sites[:1]):
+            site.pages['/'] += '<a href="{0}0/">n</a><a href="{0}missing">m</a>'.format(next_site.url).encode()
+
+    def tearDown(self):
+        for site in self.sites:
+            site.close()
+        super().tearDown()
+
+    def test_hosts_split_between_workers(self):
+        report = pwget.crawl_sharded([s.url for s in self.sites], 3, {'mirror': True, 'concurrency': 2})
+        for site in self.sites:
+            self.assertEqual(set(site.hits.keys()), set(site.pages.keys()) | {'/missing'})
+            self.assertEqual(set(site.hits.values()), {1})
+            for (path, body) in site.pages.items():
+                with open(site.localpath(path), 'rb') as f:
+                    self.assertEqual(f.read(), body)
+        npages = sum(len(s.pages) + 1 for s in self.sites)
+        self.assertEqual(report.instrumentation.histograms['request'].count, npages)
+        self.assertEqual(report.stats['errors'][404].count, 4)
+        self.assertEqual(report.stats['errors'][404]['urls'].seen, 4)
+
+    def test_shared_metadata(self):
+        pwget.crawl_sharded([s.url for s in self.sites], 3, {'mirror': True, 'concurrency': 2})
+        self.assertEqual([f for f in os.listdir('.') if f.endswith('.sqlite')], [pwget.MirrorMetadata.FILENAME])
+        for site in self.sites:
+            site.hits.clear()
+        # a crawl without --workers finds what the workers saved
+        crawler = pwget.Crawler([s.url for s in self.sites], mirror=True)
+        crawler()
+        npages = sum(len(s.pages) for s in self.sites)
+        self.assertEqual(crawler.stats['not modified'].count, npages)
+
+    def test_shard_options(self):
+        options = pwget.shard_options({'warc': 'out/crawl.warc.gz', 'metrics': ':9100', 'state_dir': 'st', 'limit_rate': 3000}, 2, 3)
+        self.assertEqual(options['warc'], 'out/crawl-2.warc.gz')
+        self.assertEqual(options['metrics'], ':9102')
+        self.assertEqual(options['state_dir'], os.path.join('st', 'shard-2'))
+        self.assertNotIn('metadata_path', options)
+        self.assertEqual(options['limit_rate'], 1000)
+
+
+class ConditionalMirrorTest(LocalSiteTest):
+    def test_remirror_only_fetches_changes(self):
+        pwget.Crawler([self.site.url], mirror=True)()
+        # same size, different content: the size check alone would miss it
+        self.site.pages['/0/data.bin'] = bytes(reversed(self.site.pages['/0/data.bin']))
+        self.site.hits.clear()
+        crawler = pwget.Crawler([self.site.url], mirror=True)
+        crawler()
+        # unchanged html pages are still recursed from their local copy
+        self.assertEqual(set(self.site.hits.keys()), set(self.site.pages.keys()))
+        self.assertEqual(sum(self.site.not_modified.values()), len(self.site.pages) - 1)
+        self.assertEqual(crawler.stats['not modified'].count, len(self.site.pages) - 1)
+        with open(self.site.localpath('/0/data.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.site.pages['/0/data.bin'])
+
+
+    def test_truncated_body_is_not_complete(self):
+        self.site.cuts['/0/data.bin'] = (10, False)
+        crawler = pwget.Crawler([self.site.url], mirror=True, retry_backoff=0.01)
+        crawler()
+        self.assertEqual(self.site.hits['/0/data.bin'], pwget.Crawler.TRIES)
+        self.assertIn('IncompleteRead', crawler.stats['errors'])
+        self.assertFalse(os.path.exists(self.site.localpath('/0/data.bin')))
+        # the next mirror fetches it whole
+        del self.site.cuts['/0/data.bin']
+        pwget.Crawler([self.site.url], mirror=True)()
+        with open(self.site.localpath('/0/data.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.site.pages['/0/data.bin'])
+
+
+class ManifestTest(LocalSiteTest):
+    def stats_of_mirror(self):
+        """Files of the mirror stat()ed by a re-mirror, directories are checked once each"""
+        stated = []
+        stat = os.stat
+        def counting_stat(path, *args, **kvargs):
+            if str(path).startswith(self.site.netloc):
+                stated.append(path)
+            return stat(path, *args, **kvargs)
+        os.stat = counting_stat
+        try:
+            pwget.Crawler([self.site.url], mirror=True)()
+        finally:
+            os.stat = stat
+        return [p for p in stated if not os.path.isdir(p)]
+
+    def test_entries(self):
+        pwget.Crawler([self.site.url], mirror=True)()
+        metadata = pwget.MirrorMetadata()
+        for (path, body) in self.site.pages.items():
+            entry = metadata.get(self.site.localpath(path))
+            self.assertEqual(entry[5], len(body))
+            self.assertEqual(entry[7], hashlib.sha256(body).hexdigest())
+            self.assertEqual(metadata.stat(self.site.localpath(path), entry)[0], len(body))
+        self.assertIsNone(metadata.stat('missing', None))
+        metadata.close()
+
+    def test_remirror_without_stat(self):
+        # the first run creates the manifest, the files already there are unknown to it
+        pwget.Crawler([self.site.url], mirror=True)()
+        self.site.pages['/new.bin'] = b'new'
+        self.site.pages['/'] += b'<a href="/new.bin">n</a>'
+        # only the files answered 304 are looked up, to check they are still there
+        unchanged = [self.site.localpath(p) for p in self.site.pages if p.endswith('data.bin')]
+        self.assertEqual(sorted(self.stats_of_mirror()), sorted(unchanged))
+        self.assertEqual(self.site.hits['/new.bin'], 1)
+
+    def test_deleted_page(self):
+        pwget.Crawler([self.site.url], mirror=True)()
+        os.remove(self.site.localpath('/0/'))
+        os.remove(self.site.localpath('/1/data.bin'))
+        self.site.hits.clear()
+        crawler = pwget.Crawler([self.site.url], mirror=True)
+        crawler()
+        # the files answered 304 are fetched again, the links of the page followed
+        self.assertEqual(self.site.hits['/0/'], 2)
+        self.assertEqual(self.site.hits['/0/data.bin'], 1)
+        self.assertEqual(self.site.hits['/1/data.bin'], 2)
+        self.assertEqual(len(crawler.stats['errors']), 0)
+        metadata = pwget.MirrorMetadata()
+        for path in ('/0/', '/1/data.bin'):
+            with open(self.site.localpath(path), 'rb') as f:
+                self.assertEqual(f.read(), self.site.pages[path])
+            self.assertIsNotNone(metadata.get(self.site.localpath(path)))
+        metadata.close()
+
+    def test_legacy_metadata(self):
+        import sqlite3
+        db = sqlite3.connect(pwget.MirrorMetadata.FILENAME)
+        db.execute('CREATE TABLE files (path TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_type TEXT, complete INTEGER, content_encoding TEXT)')
+        db.execute("INSERT INTO files VALUES ('a', '\"x\"', NULL, 'text/plain', 1, NULL)")
+        db.commit()
+        db.close()
+        metadata = pwget.MirrorMetadata()
+        self.assertFalse(metadata.authoritative)
+        entry = metadata.get('a')
+        self.assertIsNone(metadata.stat('a', entry))
+        with open('a', 'wb') as f:
+            f.write(b'abc')
+        self.assertEqual(metadata.stat('a', entry)[0], 3)
+        metadata.close()
+        self.assertTrue(pwget.MirrorMetadata().authoritative)
+
+
+class CompressionTest(LocalSiteTest):
+    def setUp(self):
+        super().setUp()
+        self.site.compress = True
+
+    def saved(self, path):
+        with open(self.site.localpath(path), 'rb') as f:
+            return f.read()
+
+    def test_decompressed(self):
+        pwget.Crawler([self.site.url], mirror=True)()
+        self.assertEqual(set(self.site.hits.keys()), set(self.site.pages.keys()))
+        for (path, body) in self.site.pages.items():
+            self.assertEqual(self.saved(path), body)
+
+    def test_keep_compressed(self):
+        pwget.Crawler([self.site.url], mirror=True, keep_compressed=True)()
+        self.assertEqual(set(self.site.hits.keys()), set(self.site.pages.keys()))
+        for (path, body) in self.site.pages.items():
+            self.assertEqual(gzip.decompress(self.saved(path)), body)
+        # unchanged pages are parsed from the compressed local copy
+        self.site.hits.clear()
+        pwget.Crawler([self.site.url], mirror=True, keep_compressed=True)()
+        self.assertEqual(set(self.site.hits.keys()), set(self.site.pages.keys()))
+        self.assertEqual(sum(self.site.not_modified.values()), len(self.site.pages))
+
+
+    def test_corrupt_body(self):
+        self.site.compress = False
+        self.site.encodings['/0/data.bin'] = 'gzip'
+        for concurrency in (1, 4):
+            os.mkdir(str(concurrency))
+            os.chdir(str(concurrency))
+            self.site.hits.clear()
+            crawler = pwget.Crawler([self.site.url], mirror=True, concurrency=concurrency)
+            crawler()
+            # the error is the url's own, the crawl goes on
+            self.assertEqual(set(self.site.hits.keys()), set(self.site.pages.keys()))
+            self.assertEqual(self.site.hits['/0/data.bin'], 1)
+            self.assertEqual(crawler.stats['errors']['DecodingError'].count, 1)
+            self.assertFalse(os.path.exists(self.site.localpath('/0/data.bin')))
+            self.assertEqual(self.saved('/1/data.bin'), self.site.pages['/1/data.bin'])
+            metadata = pwget.MirrorMetadata()
+            self.assertIsNone(metadata.get(self.site.localpath('/0/data.bin')))
+            metadata.close()
+            os.chdir(self.tmpdir)
+
+
+class ResumeTest(TempDirTest):
+    def setUp(self):
+        super().setUp()
+        self.body = os.urandom(300000)
+        self.site = LocalSite({'/big.bin': self.body})
+        self.url = self.site.url + 'big.bin'
+        os.makedirs(self.site.netloc)
+
+    def tearDown(self):
+        self.site.close()
+        super().tearDown()
+
+    def saved(self):
+        with open(self.site.localpath('/big.bin'), 'rb') as f:
+            return f.read()
+
+    def test_continue_partial_file(self):
+        with open(self.site.localpath('/big.bin'), 'wb') as f:
+            f.write(self.body[:1000])
+        pwget.Crawler([self.url], resume=True)()
+        self.assertEqual(self.site.ranges, [('/big.bin', 'bytes=1000-')])
+        self.assertEqual(self.saved(), self.body)
+        # complete now: the next run doesn't ask for a range
+        pwget.Crawler([self.url], resume=True, overwrite=True)()
+        self.assertEqual(len(self.site.ranges), 1)
+
+    def test_continue_file_missing_from_manifest(self):
+        # a manifest kept by an earlier run, the partial file was saved without it
+        pwget.MirrorMetadata().close()
+        with open(self.site.localpath('/big.bin'), 'wb') as f:
+            f.write(self.body[:1000])
+        pwget.Crawler([self.url], resume=True)()
+        self.assertEqual(self.site.ranges, [('/big.bin', 'bytes=1000-')])
+        self.assertEqual(self.saved(), self.body)
+
+    def test_continue_over_plain_run(self):
+        site = LocalSite(tree_site(2, 1))
+        try:
+            pwget.Crawler([site.url], regex='.*', level=0)()
+            pwget.Crawler([site.url], mirror=True, resume=True)()
+            # the pages saved without metadata are fetched whole and recursed
+            self.assertEqual(site.ranges, [])
+            self.assertEqual(set(site.hits), set(site.pages))
+        finally:
+            site.close()
+
+    def test_changed_entity_is_downloaded_again(self):
+        pwget.Crawler([self.url], resume=True)()
+        meta = pwget.MirrorMetadata()
+        meta.db.execute('UPDATE files SET complete = 0, etag = ?', ('"stale"',))
+        meta.close()
+        with open(self.site.localpath('/big.bin'), 'wb') as f:
+            f.write(b'x' * 1000)
+        pwget.Crawler([self.url], resume=True)()
+        self.assertEqual(self.site.ranges, [])
+        self.assertEqual(self.saved(), self.body)
+
+    def test_segmented(self):
+        crawler = pwget.Crawler([self.url], segments=4, segment_min_size=1000)
+        crawler()
+        self.assertEqual(self.saved(), self.body)
+        self.assertEqual(sorted(r for (_, r) in self.site.ranges),
+            ['bytes=150000-224999', 'bytes=225000-299999', 'bytes=75000-149999'])
+
+
+class SeenSetTest(TempDirTest):
+    def urls(self, n, prefix='http://host/'):
+        return ['{0}{1}'.format(prefix, i) for i in range(n)]
+
+    def test_fingerprint_set_grows(self):
+        s = pwget.FingerprintSet(capacity=16)
+        urls = self.urls(5000)
+        self.assertTrue(all(s.add(u) for u in urls))
+        self.assertFalse(any(s.add(u) for u in urls))
+        self.assertEqual(len(s), 5000)
+        self.assertTrue(all(u in s for u in urls))
+        self.assertFalse(any(u in s for u in self.urls(5000, 'http://other/')))
+        self.assertLess(s.nbytes, 5000 * 24)
+
+    def test_bloom_filter_error_rate(self):
+        b = pwget.BloomFilter(10000, error_rate=0.01)
+        urls = self.urls(10000)
+        for u in urls:
+            b.add(u)
+        self.assertTrue(all(u in b for u in urls))
+        false_positives = sum(u in b for u in self.urls(10000, 'http://other/'))
+        self.assertLess(false_positives, 200)
+
+    def test_crawl_with_fingerprints(self):
+        site = LocalSite(tree_site(2, 1))
+        try:
+            crawler = pwget.Crawler([site.url], mirror=True, seen_set='fingerprint')
+            crawler()
+            self.assertEqual(len(crawler.frontier.seen), len(site.pages))
+            self.assertEqual(set(site.hits.values()), {1})
+        finally:
+            site.close()
+
+
+class SchedulerTest(TempDirTest):
+    def drain(self, frontier):
+        res = []
+        while len(frontier):
+            res.append(frontier.pop())
+        return res
+
+    def check(self, scheduler, added, expected):
+        for frontier in (pwget.MemoryFrontier(scheduler=scheduler()), pwget.SQLiteFrontier('state', scheduler())):
+            for (url, depth) in added:
+                frontier.add(url, depth)
+            self.assertEqual([url for (url, _) in self.drain(frontier)], expected)
+            frontier.close()
+            shutil.rmtree('state', ignore_errors=True)
+
+    def test_breadth_first(self):
+        self.check(pwget.BreadthFirstScheduler, [('http://a/2', 2), ('http://a/0', 0), ('http://a/1', 1), ('http://a/1b', 1)],
+            ['http://a/0', 'http://a/1', 'http://a/1b', 'http://a/2'])
+
+    def test_host_round_robin(self):
+        self.check(pwget.HostRoundRobinScheduler, [('http://a/1', 1), ('http://a/2', 1), ('http://a/3', 1), ('http://b/1', 1), ('http://b/2', 1)],
+            ['http://a/1', 'http://b/1', 'http://a/2', 'http://b/2', 'http://a/3'])
+
+    def test_priority(self):
+        self.check(lambda: pwget.PriorityScheduler(pwget.cheap_first), [('http://a/x.zip', 0), ('http://a/y.html', 3)],
+            ['http://a/y.html', 'http://a/x.zip'])
+
+    def test_level(self):
+        site = LocalSite(tree_site(2, 3))
+        try:
+            pwget.Crawler([site.url], mirror=True, level=1)()
+            self.assertEqual(set(site.hits.keys()), {'/', '/0/', '/1/', '/data.bin'})
+        finally:
+            site.close()
+
+
+class SQLiteFrontierTest(TempDirTest):
+    def test_resume(self):
+        frontier = pwget.SQLiteFrontier('state')
+        for url in ['http://a/1', 'http://a/2', 'http://a/3', 'http://a/1']:
+            frontier.add(url)
+        self.assertEqual(len(frontier), 3)
+        frontier.done(frontier.pop()[0])
+        frontier.pop()
+        # interrupted while crawling the second url
+        frontier.close()
+
+        frontier = pwget.SQLiteFrontier('state')
+        self.assertEqual(len(frontier), 2)
+        self.assertIn('http://a/1', frontier)
+        self.assertFalse(frontier.add('http://a/1'))
+        self.assertEqual([frontier.pop(), frontier.pop()], [('http://a/2', 0), ('http://a/3', 0)])
+        self.assertRaises(KeyError, frontier.pop)
+        frontier.close()
+
+    def test_finished_crawl_is_not_refetched(self):
+        site = LocalSite(tree_site(2, 1))
+        try:
+            pwget.Crawler([site.url], mirror=True, state_dir='state')()
+            hits = sum(site.hits.values())
+            self.assertEqual(hits, len(site.pages))
+            pwget.Crawler([site.url], mirror=True, state_dir='state')()
+            self.assertEqual(sum(site.hits.values()), hits)
+        finally:
+            site.close()
+
+
+class SyntheticSiteTest(unittest.TestCase):
+    def test_crawl(self):
+        site = pwget_bench.SyntheticSite(fanout=3, depth=2, page_size=2000, binaries=2, binary_size=5000, error_rate=0.2)
+        try:
+            res = pwget_bench.crawl_site(site, jobs=4)
+        finally:
+            site.close()
+        self.assertEqual(res['files'], res['expected_files'])
+        self.assertGreater(res['errors'], 0)
+        self.assertEqual(set(res['phases'].keys()), {'setup', 'crawl', 'verify'})
+
+
 class parse_cookie_fileTest(unittest.TestCase):
     def test(self):
         self.assertEqual(pwget.parse_cookie_file(".youtube.com\tTRUE\t/\tFALSE\t1687629793\tPREF\tfv=11.2.202&al=en&f1=50000000"), {'.youtube.com': {'PREF': 'fv=11.2.202&al=en&f1=50000000'}})
 
+class GetLinksTest(unittest.TestCase):
+    def test(self):
+        parsed_url = pwget.urllib.parse.urlparse('http://host/dir/page.html')
+        content = '<a href="/abs">x</a><!-- <a href="commented"> --><a href=rel.html>y</a><iframe src="#top"></iframe><a href="ftp://other/">z</a>'
+        self.assertEqual(pwget.Crawler.get_links(parsed_url, content),
+            ['http://host/abs', 'http://host/dir/rel.html', 'http://host/dir/page.html#top'])
+
+
+class CookieJarTest(unittest.TestCase):
+    COOKIES = '\n'.join([
+        '# Netscape HTTP Cookie File',
+        '.example.com\tTRUE\t/\tFALSE\t0\tsession\ts1',
+        '#HttpOnly_www.example.com\tFALSE\t/\tTRUE\t4102444800\tsecure\ts2',
+        'www.example.com\tFALSE\t/\tFALSE\t1000\texpired\tx',
+        'other.org\tFALSE\t/\tFALSE\t0\tother\to',
+    ])
+
+    def test_single_combined_header(self):
+        crawler = pwget.Crawler([])
+        crawler.host_cookies = pwget.parse_cookie_file(self.COOKIES)
+        request = pwget.urllib.request.Request('https://www.example.com/page')
+        crawler.add_cookies(request, pwget.urllib.parse.urlparse(request.full_url), crawler.host_cookies)
+        self.assertEqual(request.get_header('Cookie'), 'session=s1; secure=s2')
+        request = pwget.urllib.request.Request('http://www.example.com/page')
+        crawler.add_cookies(request, pwget.urllib.parse.urlparse(request.full_url), crawler.host_cookies)
+        self.assertEqual(request.get_header('Cookie'), 'session=s1')
+
+    def test_many_domains(self):
+        jar = pwget.CookieJar()
+        for i in range(10000):
+            jar.add(pwget.Cookie('host{0}.example.com'.format(i), False, '/', False, 0, 'n', str(i)))
+        self.assertEqual(jar.cookie_header('host1234.example.com'), 'n=1234')
+        self.assertEqual(jar.cookie_header('example.com'), '')
+
+
 class NormalizeTest(unittest.TestCase):
     def test(self):
         self.assertEqual(pwget.normalize('http://host/a/b/..'), 'http://host/a/')
@@ -38,6 +1265,15 @@ class NormalizeTest(unittest.TestCase):
         self.assertEqual(pwget.normalize('http://host'), 'http://host')
         self.assertEqual(pwget.normalize('http://host/'), 'http://host/')
 
+    def test_normalize_path_matches_path(self):
+        parts = ['a', 'b', '..', '.', '', 'x.html']
+        rnd = random.Random(0)
+        for _ in range(20000):
+            s = ''.join(rnd.choice(['/', '']) + rnd.choice(parts) for _ in range(rnd.randint(0, 7)))
+            p = pwget.Path(s)
+            p.normalize()
+            self.assertEqual(pwget.normalize_path(s), str(p), s)
+
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(pwget))